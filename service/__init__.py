@@ -20,9 +20,8 @@ and SQL database
 """
 import sys
 from flask import Flask
-from flask_restx import Api
 from service import config
-from service.common import log_handlers
+from service.common import log_handlers, request_timing, compression, assets, rate_limit, passwords
 
 
 # NOTE: Do not change the order of this code
@@ -41,6 +40,7 @@ def create_app():
     # Create Flask application
     app = Flask(__name__)
     app.config.from_object(config)
+    passwords.init_passwords(app)
 
     app.url_map.strict_slashes = False
 
@@ -51,11 +51,13 @@ def create_app():
     # Initialize Plugins
     # pylint: disable=import-outside-toplevel
     global api
-    api = Api(
+    api = request_timing.TimedApi(
         app,
         version="1.0.0",
         title="Customer REST API Service",
-        description="This is a Customer server.",
+        description="This is a Customer server. Besides JSON, it answers in MessagePack or CBOR "
+        "when the Accept header asks for application/msgpack or application/cbor, and reads "
+        "request bodies sent with those Content-Types.",
         default="customers",
         default_label="Customers operations",
         doc="/apidocs",  # default also could use doc='/apidocs/'
@@ -74,6 +76,11 @@ def create_app():
         # pylint: disable=wrong-import-position, wrong-import-order, unused-import, cyclic-import
         from service import routes, models  # noqa: F401 E402
         from service.common import error_handlers, cli_commands  # noqa: F401, E402
+        from service.common import idempotency, statement_cache, media_types  # noqa: E402
+
+        # Count the reuse of compiled statements and limit the prepared ones
+        # before the first connection is opened
+        statement_cache.init_statement_cache(app)
 
         try:
             db.create_all()
@@ -83,8 +90,38 @@ def create_app():
             sys.exit(4)
 
         # Set up logging for production
+        request_timing.init_request_timing(app, api)
         log_handlers.init_logging(app, "gunicorn.error")
 
+        # Compress large responses and serve the precompressed static assets
+        compression.init_compression(app)
+        assets.init_assets(app)
+
+        # Answer in MessagePack or CBOR to the clients that accept them
+        media_types.init_media_types(app, api)
+
+        # Shed requests from clients that exceed their budget
+        rate_limit.init_rate_limiting(app)
+
+        # Answer retried writes from their stored responses
+        idempotency.init_idempotency(app)
+
+        # Cache the customers and tell the caches of the other processes
+        # about the customer writes
+        from service.common import event_stream, invalidation, cache  # noqa: E402
+
+        invalidation.init_invalidation(app)
+        cache.init_cache(app)
+
+        # Push the customer writes to the clients of /customers/events
+        event_stream.init_event_stream(app)
+
+        # Index the customers in memory for the fuzzy and typo-tolerant filters
+        from service.common import inverted_index, typo_index  # noqa: E402
+
+        inverted_index.init_search_index(app)
+        typo_index.init_typo_index(app)
+
         app.logger.info(70 * "*")
         app.logger.info("  S E R V I C E   R U N N I N G  ".center(70, "*"))
         app.logger.info(70 * "*")
@@ -0,0 +1,142 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Static Assets
+
+This module precompresses and fingerprints the static assets at build
+time and serves them with long-lived caching headers
+
+Usage:
+    python -m service.common.assets
+"""
+import os
+import json
+import hashlib
+import mimetypes
+from flask import send_from_directory
+from service.common import compression
+
+DIST_FOLDER = "dist"
+MANIFEST_FILE = "manifest.json"
+ASSET_FOLDERS = ["js", "css"]
+ONE_YEAR = 365 * 24 * 60 * 60
+
+# Extension of the precompressed file for each content coding
+ENCODED_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+
+
+def build_assets(static_folder: str, level: int = 9) -> dict:
+    """
+    Writes fingerprinted and precompressed copies of the static assets
+
+    Args:
+        static_folder (str): the folder the app serves static files from
+        level (int): the compression level to use
+
+    Returns:
+        dict: the manifest of logical names to fingerprinted names
+    """
+    dist_folder = os.path.join(static_folder, DIST_FOLDER)
+    os.makedirs(dist_folder, exist_ok=True)
+    manifest = {}
+    for folder in ASSET_FOLDERS:
+        source_folder = os.path.join(static_folder, folder)
+        if not os.path.isdir(source_folder):
+            continue
+        for filename in sorted(os.listdir(source_folder)):
+            with open(os.path.join(source_folder, filename), "rb") as source:
+                data = source.read()
+            digest = hashlib.sha256(data).hexdigest()[:12]
+            stem, ext = os.path.splitext(filename)
+            fingerprinted = f"{stem}.{digest}{ext}"
+            _write(os.path.join(dist_folder, fingerprinted), data)
+            for encoding, suffix in ENCODED_SUFFIXES.items():
+                if encoding == "br" and compression.brotli is None:
+                    continue
+                _write(
+                    os.path.join(dist_folder, fingerprinted + suffix),
+                    compression.compress(data, encoding, level),
+                )
+            manifest[f"{folder}/{filename}"] = f"{DIST_FOLDER}/{fingerprinted}"
+
+    with open(os.path.join(dist_folder, MANIFEST_FILE), "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    return manifest
+
+
+def _write(path: str, data: bytes):
+    """Writes the bytes to a file"""
+    with open(path, "wb") as file:
+        file.write(data)
+
+
+def load_manifest(static_folder: str) -> dict:
+    """Loads the asset manifest, or an empty one if assets were not built"""
+    path = os.path.join(static_folder, DIST_FOLDER, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def rewrite_asset_urls(html: str, manifest: dict) -> str:
+    """Points the static asset references in a page at their fingerprinted copies"""
+    for logical, fingerprinted in manifest.items():
+        html = html.replace(f"static/{logical}", f"static/{fingerprinted}")
+    return html
+
+
+def send_dist_file(static_folder: str, filename: str):
+    """Sends a fingerprinted asset, precompressed when the client allows it"""
+    dist_folder = os.path.join(static_folder, DIST_FOLDER)
+    response = None
+    for encoding in compression.accepted_encodings():
+        encoded = filename + ENCODED_SUFFIXES[encoding]
+        if os.path.exists(os.path.join(dist_folder, encoded)):
+            response = send_from_directory(
+                dist_folder, encoded, mimetype=mimetypes.guess_type(filename)[0]
+            )
+            response.headers["Content-Encoding"] = encoding
+            break
+    if response is None:
+        response = send_from_directory(dist_folder, filename)
+    response.vary.add("Accept-Encoding")
+    response.cache_control.public = True
+    response.cache_control.max_age = ONE_YEAR
+    response.cache_control.immutable = True
+    return response
+
+
+def init_assets(app):
+    """Serves fingerprinted assets from the static folder when they were built"""
+    static_view = app.view_functions["static"]
+    prefix = DIST_FOLDER + "/"
+
+    def static(filename):
+        if filename.startswith(prefix) and filename != prefix + MANIFEST_FILE:
+            return send_dist_file(app.static_folder, filename[len(prefix):])
+        return static_view(filename=filename)
+
+    app.view_functions["static"] = static
+    app.config["ASSET_MANIFEST"] = load_manifest(app.static_folder)
+    app.logger.info("Static assets established (%d built)", len(app.config["ASSET_MANIFEST"]))
+
+
+if __name__ == "__main__":  # pragma: no cover
+    STATIC_FOLDER = os.path.join(os.path.dirname(os.path.dirname(__file__)), "static")
+    for name, path in build_assets(STATIC_FOLDER).items():
+        print(f"{name} -> {path}")
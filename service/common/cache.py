@@ -0,0 +1,446 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Customer Cache
+
+Keeps serialized Customers, encoded as JSON, and the ids that list
+queries returned in front of the database. CACHE_BACKEND picks where:
+
+    memory  a dictionary in each worker process, least recently used first out
+    shared  fixed-size slots in a memory-mapped file that all the gunicorn
+            workers of a pod share, so it is held once per pod rather than
+            once per worker and a customer read by one worker is a hit in all
+
+The shared cache is set-associative: the digest of a key picks a stripe
+of CACHE_SHARED_WAYS slots and the key can only live in those, so a read
+only looks at and locks one stripe. When a stripe is full the slot used
+least recently is replaced. Values larger than a slot are not cached.
+
+Every write bumps a generation counter before it deletes the keys it
+changed, and a value read from the database is only stored if the
+generation has not moved since the read started, so a read that raced a
+write cannot put the old row back. Cached lists are only used at the
+generation they were read at, so any write retires all of them. Entries also expire after CACHE_TTL
+seconds, less while the invalidations of the other pods are not heard.
+"""
+import os
+import json
+import mmap
+import time
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from flask import current_app
+from service.models import add_write_listener
+from service.common import invalidation
+
+try:  # fcntl is only available on POSIX systems
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+STAT_NAMES = ("hits", "misses", "stores", "evictions", "oversized")
+
+
+def digest(key: str) -> bytes:
+    """Returns the 16 byte digest that identifies a key"""
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+
+
+######################################################################
+# In-process backend
+######################################################################
+class MemoryCache:
+    """Keeps the values in a dictionary in least recently used order"""
+
+    def __init__(self, max_entries=10000, max_value_size=65536):
+        self.max_entries = max_entries
+        self.max_value_size = max_value_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._stats = dict.fromkeys(STAT_NAMES, 0)
+
+    def get(self, key, now=None):
+        """Returns the value of a key, or None when it is not cached or expired"""
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[1]
+
+    def set(self, key, value, ttl, generation=None, now=None):
+        """
+        Stores the value of a key for ttl seconds
+
+        Returns:
+            bool: False when the value is too large or the generation moved
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            if len(value) > self.max_value_size:
+                self._stats["oversized"] += 1
+                return False
+            if generation is not None and generation != self._generation:
+                return False
+            self._entries[key] = (now + ttl, value)
+            self._entries.move_to_end(key)
+            self._stats["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+        return True
+
+    def delete(self, key):
+        """Removes a key"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Removes every key"""
+        with self._lock:
+            self._entries.clear()
+
+    def generation(self):
+        """Returns the write generation"""
+        return self._generation
+
+    def bump(self):
+        """Moves the write generation on, before a write deletes its keys"""
+        with self._lock:
+            self._generation += 1
+
+    def stats(self):
+        """Returns the counters, the number of entries and their size"""
+        with self._lock:
+            values = [value for _, value in self._entries.values()]
+            return dict(
+                self._stats, entries=len(values), bytes=sum(map(len, values)), generation=self._generation
+            )
+
+
+######################################################################
+# Shared memory backend
+######################################################################
+class SharedMemoryCache:
+    """
+    Keeps the values in fixed-size slots of a memory-mapped file
+
+    The file starts with a header that holds the layout and the write
+    generation, followed by the stripes. A stripe is its counters and
+    then its slots, and it is guarded by a threading lock in each process
+    and a byte range lock between the processes.
+    """
+
+    MAGIC = b"CUSTCACH"
+    HEADER = struct.Struct("<8sQIII")  # magic, generation, stripes, ways, slot size
+    GENERATION = struct.Struct("<Q")
+    GENERATION_OFFSET = 8
+    COUNTERS = struct.Struct("<" + "Q" * len(STAT_NAMES))
+    SLOT = struct.Struct("<16sddI")  # key digest, expires at, used at, value length
+
+    def __init__(self, path, size=8 * 1024 * 1024, ways=8, slot_size=2048):
+        if fcntl is None:  # pragma: no cover
+            raise RuntimeError("The shared cache requires fcntl")
+        self.ways = ways
+        self.slot_size = slot_size
+        self.max_value_size = slot_size - self.SLOT.size
+        self._stripe_size = self.COUNTERS.size + ways * slot_size
+        self.stripes = max(1, (size - self.HEADER.size) // self._stripe_size)
+        self._size = self.HEADER.size + self.stripes * self._stripe_size
+        self._header_lock = threading.Lock()
+        self._locks = [threading.Lock() for _ in range(self.stripes)]
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size != self._size:
+            os.ftruncate(self._fd, self._size)
+        self._map = mmap.mmap(self._fd, self._size)
+        self._format()
+
+    @contextmanager
+    def _locked(self, lock, offset, length):
+        """Holds a byte range of the file against the other threads and processes"""
+        with lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, length, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, length, offset)
+
+    def _format(self):
+        """Empties the file unless it already holds a cache with the same layout"""
+        with self._locked(self._header_lock, 0, self.HEADER.size):
+            magic, generation, stripes, ways, slot_size = self.HEADER.unpack_from(self._map, 0)
+            if (magic, stripes, ways, slot_size) != (self.MAGIC, self.stripes, self.ways, self.slot_size):
+                self._map[:] = bytes(self._size)
+                self.HEADER.pack_into(self._map, 0, self.MAGIC, generation, self.stripes, self.ways, self.slot_size)
+
+    def _stripe(self, key_digest):
+        """Returns the index and the offset of the stripe of a key"""
+        stripe = int.from_bytes(key_digest[:8], "little") % self.stripes
+        return stripe, self.HEADER.size + stripe * self._stripe_size
+
+    def _count(self, offset, name):
+        """Increments a counter of a stripe, the caller holds its lock"""
+        counters = list(self.COUNTERS.unpack_from(self._map, offset))
+        counters[STAT_NAMES.index(name)] += 1
+        self.COUNTERS.pack_into(self._map, offset, *counters)
+
+    def _slots(self, offset):
+        """Yields the offset and header of each slot of a stripe"""
+        for way in range(self.ways):
+            slot = offset + self.COUNTERS.size + way * self.slot_size
+            yield slot, self.SLOT.unpack_from(self._map, slot)
+
+    def get(self, key, now=None):
+        """Returns the value of a key, or None when it is not cached or expired"""
+        now = time.time() if now is None else now
+        key_digest = digest(key)
+        stripe, offset = self._stripe(key_digest)
+        with self._locked(self._locks[stripe], offset, self._stripe_size):
+            for slot, (owner, expires_at, _, length) in self._slots(offset):
+                if owner == key_digest and expires_at > now:
+                    self.SLOT.pack_into(self._map, slot, owner, expires_at, now, length)
+                    self._count(offset, "hits")
+                    start = slot + self.SLOT.size
+                    return bytes(self._map[start:start + length])
+            self._count(offset, "misses")
+        return None
+
+    def set(self, key, value, ttl, generation=None, now=None):
+        """
+        Stores the value of a key for ttl seconds
+
+        Returns:
+            bool: False when the value is too large or the generation moved
+        """
+        now = time.time() if now is None else now
+        key_digest = digest(key)
+        stripe, offset = self._stripe(key_digest)
+        with self._locked(self._locks[stripe], offset, self._stripe_size):
+            if len(value) > self.max_value_size:
+                self._count(offset, "oversized")
+                return False
+            # checked under the stripe lock, which the write's delete waits for
+            if generation is not None and generation != self.generation():
+                return False
+            slot, live = self._victim(offset, key_digest, now)
+            self.SLOT.pack_into(self._map, slot, key_digest, now + ttl, now, len(value))
+            start = slot + self.SLOT.size
+            self._map[start:start + len(value)] = value
+            self._count(offset, "stores")
+            if live:
+                self._count(offset, "evictions")
+        return True
+
+    def _victim(self, offset, key_digest, now):
+        """
+        Returns the slot to store a key in and whether it evicts another key
+
+        That is the key's own slot, else an expired one, else the one used
+        least recently.
+        """
+        oldest = None
+        for slot, (owner, expires_at, used_at, _) in self._slots(offset):
+            if owner == key_digest or expires_at <= now:
+                return slot, False
+            if oldest is None or used_at < oldest[1]:
+                oldest = (slot, used_at)
+        return oldest[0], True
+
+    def delete(self, key):
+        """Removes a key"""
+        key_digest = digest(key)
+        stripe, offset = self._stripe(key_digest)
+        with self._locked(self._locks[stripe], offset, self._stripe_size):
+            for slot, (owner, *_) in self._slots(offset):
+                if owner == key_digest:
+                    self.SLOT.pack_into(self._map, slot, bytes(16), 0.0, 0.0, 0)
+
+    def clear(self):
+        """Removes every key"""
+        for stripe in range(self.stripes):
+            offset = self.HEADER.size + stripe * self._stripe_size
+            with self._locked(self._locks[stripe], offset, self._stripe_size):
+                for slot, _ in self._slots(offset):
+                    self.SLOT.pack_into(self._map, slot, bytes(16), 0.0, 0.0, 0)
+
+    def generation(self):
+        """Returns the write generation"""
+        return self.GENERATION.unpack_from(self._map, self.GENERATION_OFFSET)[0]
+
+    def bump(self):
+        """Moves the write generation on, before a write deletes its keys"""
+        with self._locked(self._header_lock, 0, self.HEADER.size):
+            self.GENERATION.pack_into(self._map, self.GENERATION_OFFSET, self.generation() + 1)
+
+    def stats(self, now=None):
+        """Returns the counters, the number of live entries and their size, for the whole pod"""
+        now = time.time() if now is None else now
+        totals = dict.fromkeys(STAT_NAMES, 0)
+        entries = size = 0
+        for stripe in range(self.stripes):
+            offset = self.HEADER.size + stripe * self._stripe_size
+            with self._locked(self._locks[stripe], offset, self._stripe_size):
+                for name, value in zip(STAT_NAMES, self.COUNTERS.unpack_from(self._map, offset)):
+                    totals[name] += value
+                for _, (_, expires_at, _, length) in self._slots(offset):
+                    if expires_at > now:
+                        entries += 1
+                        size += length
+        return dict(totals, entries=entries, bytes=size, generation=self.generation())
+
+    def close(self):
+        """Releases the memory map"""
+        self._map.close()
+        os.close(self._fd)
+
+
+######################################################################
+# Helpers
+######################################################################
+def cached(key, compute):
+    """
+    Returns the cached value of a key, or computes, caches and returns it
+
+    Args:
+        key (str): identifies the value
+        compute (callable): returns the value as plain JSON data, None is
+            not cached
+    """
+    cache = current_app.extensions.get("cache")
+    if cache is None:
+        return compute()
+    value = cache.get(key)
+    if value is not None:
+        return json.loads(value)
+    generation = cache.generation()
+    result = compute()
+    if result is not None:
+        ttl = invalidation.ttl(current_app, current_app.config["CACHE_TTL"])
+        cache.set(key, _encode(result), ttl, generation)
+    return result
+
+
+def customer_key(customer_id):
+    """Returns the cache key of a Customer"""
+    return f"customer:{customer_id}"
+
+
+def _encode(value):
+    """Encodes plain data as compact JSON"""
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+
+def cached_list(query_key, compute, find_many):
+    """
+    Returns the results of a list query, from the ids cached for it when
+    nothing was written since they were
+
+    The ids are stored under the query's key with the write generation
+    they were read at, and the Customers themselves under their own keys,
+    so a list is one lookup for its ids and one per Customer. Any write
+    moves the generation on, which retires every cached list at once.
+
+    Args:
+        query_key (tuple): the normalized conditions and options of the query
+        compute (callable): runs the query and returns the serialized Customers
+        find_many (callable): returns the serialized Customers with some ids
+    """
+    cache = current_app.extensions.get("cache")
+    max_results = current_app.config["CACHE_LIST_MAX_RESULTS"]
+    if cache is None or not max_results:
+        return compute()
+    key = "list:" + hashlib.blake2b(repr(query_key).encode("utf-8"), digest_size=16).hexdigest()
+    generation = cache.generation()
+    value = cache.get(key)
+    if value is not None:
+        entry = json.loads(value)
+        if entry["generation"] == generation:
+            customers = _customers(cache, entry["ids"], find_many, generation)
+            if customers is not None:
+                return customers
+    results = compute()
+    if len(results) <= max_results:
+        ttl = invalidation.ttl(current_app, current_app.config["CACHE_TTL"])
+        ids = [customer["id"] for customer in results]
+        if cache.set(key, _encode({"generation": generation, "ids": ids}), ttl, generation):
+            for customer in results:
+                cache.set(customer_key(customer["id"]), _encode(customer), ttl, generation)
+    return results
+
+
+def _customers(cache, ids, find_many, generation):
+    """Returns the Customers with the ids in order, or None if one is gone"""
+    customers = {}
+    for customer_id in ids:
+        value = cache.get(customer_key(customer_id))
+        if value is not None:
+            customers[customer_id] = json.loads(value)
+    missing = [customer_id for customer_id in ids if customer_id not in customers]
+    if missing:
+        ttl = invalidation.ttl(current_app, current_app.config["CACHE_TTL"])
+        for customer in find_many(missing):
+            customers[customer["id"]] = customer
+            cache.set(customer_key(customer["id"]), _encode(customer), ttl, generation)
+    if len(customers) < len(ids):
+        return None
+    return [customers[customer_id] for customer_id in ids]
+
+
+def create_cache(config):
+    """Returns the cache backend the config asks for, or None"""
+    backend = config["CACHE_BACKEND"]
+    if backend == "shared":
+        return SharedMemoryCache(
+            config["CACHE_SHARED_PATH"],
+            config["CACHE_SHARED_SIZE"],
+            config["CACHE_SHARED_WAYS"],
+            config["CACHE_SLOT_SIZE"],
+        )
+    if backend == "memory":
+        return MemoryCache(config["CACHE_MAX_ENTRIES"], config["CACHE_SLOT_SIZE"] - SharedMemoryCache.SLOT.size)
+    return None
+
+
+def init_cache(app):
+    """Creates the cache and drops the Customers that are written"""
+    cache = create_cache(app.config)
+    if cache is None:
+        app.logger.info("Customer cache disabled")
+        return
+
+    def on_write(_action, data):
+        cache.bump()
+        cache.delete(customer_key(data["id"]))
+
+    def on_invalidation(_action, customer_id):
+        cache.bump()
+        if customer_id is None:
+            cache.clear()
+        else:
+            cache.delete(customer_key(customer_id))
+
+    add_write_listener(on_write)
+    invalidation.subscribe(app, on_invalidation)
+    app.extensions["cache"] = cache
+    app.logger.info("Customer cache established (%s)", type(cache).__name__)
@@ -16,8 +16,14 @@
 """
 Flask CLI Command Extensions
 """
+import json
+from datetime import timedelta
+from functools import partial
+import click
 from flask import current_app as app  # Import Flask application
-from service.models import db
+from service.models import db, Customer, CustomerTombstone, create_search_index, utcnow
+from service.routes import customer_filters, filter_customers
+from service.common import assets, cache, index_advice, media_types, statement_cache
 
 
 ######################################################################
@@ -34,3 +40,203 @@ def db_create():
     db.drop_all()
     db.create_all()
     db.session.commit()
+
+
+######################################################################
+# Command to add the full text search column and index
+# Usage:
+#   flask db-search-index
+######################################################################
+@app.cli.command("db-search-index")
+def db_search_index():
+    """
+    Adds the search_vector column and its GIN index to an existing
+    Postgres database
+    """
+    if create_search_index():
+        db.session.commit()
+        print("Full text search index created")
+    else:
+        print("Full text search needs Postgres, searches will run in Python")
+
+
+######################################################################
+# Command to add the indexes declared on the models
+# Usage:
+#   flask db-indexes
+######################################################################
+@app.cli.command("db-indexes")
+def db_indexes():
+    """
+    Creates the indexes declared on the models that an existing database
+    does not have yet
+    """
+    missing = index_advice.missing_indexes()
+    for index in sorted(Customer.__table__.indexes, key=lambda index: index.name):
+        if index.name in missing:
+            index.create(db.engine)
+            print(f"{index.name} created")
+        else:
+            print(f"{index.name} is in place")
+
+
+######################################################################
+# Command to purge the old tombstones of deleted customers
+# Usage:
+#   flask db-purge-tombstones
+######################################################################
+@app.cli.command("db-purge-tombstones")
+def db_purge_tombstones():
+    """
+    Deletes the tombstones older than TOMBSTONE_RETENTION_DAYS, run it
+    from a daily job
+    """
+    before = utcnow() - timedelta(days=app.config["TOMBSTONE_RETENTION_DAYS"])
+    count = CustomerTombstone.purge(before)
+    print(f"Purged {count} tombstones from before {before.isoformat()}")
+
+
+######################################################################
+# Command to show the statistics of the customer cache
+# Usage:
+#   flask cache-stats
+######################################################################
+@app.cli.command("cache-stats")
+def cache_stats():
+    """
+    Prints the statistics of the customer cache, those of the shared
+    cache cover every worker of the pod
+    """
+    backend = cache.create_cache(app.config)
+    if backend is None:
+        print("The customer cache is disabled")
+        return
+    stats = backend.stats()
+    lookups = stats["hits"] + stats["misses"]
+    for name, value in stats.items():
+        print(f"{name}: {value}")
+    print(f"hit rate: {stats['hits'] / lookups if lookups else 0:.1%}")
+
+
+######################################################################
+# Command to measure what the cached statements save
+# Usage:
+#   flask db-statement-benchmark
+######################################################################
+@app.cli.command("db-statement-benchmark")
+@click.option("--repeat", default=2000, help="Executions of each statement")
+def db_statement_benchmark(repeat):
+    """
+    Times the hot queries built on every call against the statements
+    built once, the writes are rolled back
+    """
+    # pylint: disable=protected-access
+    customer_id = db.session.execute(db.select(db.func.min(Customer.id))).scalar()
+    if customer_id is None:
+        print("There are no customers to query")
+        return
+    table = Customer.__table__
+    values = {"first_name": "Benchmark", "updated_at": utcnow()}
+    queries = {
+        "find": (
+            lambda: db.session.execute(db.select(Customer).where(Customer.id == customer_id)).scalar_one_or_none(),
+            lambda: Customer.find(customer_id),
+        ),
+        "update": (
+            lambda: db.session.execute(
+                db.update(table)
+                .where(table.c.id == customer_id, Customer._unique_clause(customer_id, values))
+                .values(values)
+                .returning(*table.c)
+            ).one_or_none(),
+            lambda: Customer._update_row(customer_id, values),
+        ),
+    }
+    print(f"{'query':<8}{'built us':>10}{'cpu':>8}{'cached us':>11}{'cpu':>8}{'cpu saved':>11}")
+    try:
+        for name, (built, cached) in queries.items():
+            built_time = statement_cache.measure(built, repeat)
+            cached_time = statement_cache.measure(cached, repeat)
+            print(
+                f"{name:<8}{built_time[0]:>10.1f}{built_time[1]:>8.1f}{cached_time[0]:>11.1f}{cached_time[1]:>8.1f}"
+                f"{built_time[1] - cached_time[1]:>11.1f}"
+            )
+    finally:
+        db.session.rollback()
+    stats = statement_cache.stats(app)
+    print(f"compiled cache: {stats['hits']} hits, {stats['misses']} misses, {stats['compiled']} statements")
+
+
+######################################################################
+# Command to compare JSON with the binary media types
+# Usage:
+#   flask media-type-benchmark
+######################################################################
+@app.cli.command("media-type-benchmark")
+@click.option("--count", default=100, help="Customers in the encoded list")
+@click.option("--repeat", default=200, help="Encodings and decodings of each format")
+def media_type_benchmark(count, repeat):
+    """
+    Encodes and decodes a list of customers as JSON and as the installed
+    binary media types, and prints their sizes and times
+    """
+    customers = [customer.serialize() for customer in db.session.execute(db.select(Customer).limit(count)).scalars()]
+    if not customers:
+        print("There are no customers to encode")
+        return
+    codecs = {media_types.JSON: (lambda data: json.dumps(data).encode("utf-8"), json.loads)}
+    codecs.update(media_types.CODECS)
+    print(f"{len(customers)} customers")
+    print(f"{'media type':<22}{'bytes':>9}{'encode us':>11}{'decode us':>11}")
+    for mediatype, (encode, decode) in codecs.items():
+        body = encode(customers)
+        encode_time = statement_cache.measure(partial(encode, customers), repeat)[1]
+        decode_time = statement_cache.measure(partial(decode, body), repeat)[1]
+        print(f"{mediatype:<22}{len(body):>9}{encode_time:>11.1f}{decode_time:>11.1f}")
+
+
+######################################################################
+# Command to check that the list queries use the indexes
+# Usage:
+#   flask db-index-advice
+######################################################################
+@app.cli.command("db-index-advice")
+def db_index_advice():
+    """
+    EXPLAINs the customer list queries on the current data and reports
+    sequential scans and missing indexes
+    """
+    count = db.session.execute(db.select(db.func.count(Customer.id))).scalar()
+    print(f"{Customer.__tablename__} has {count} rows")
+    values = index_advice.sample_values()
+    if values is None:
+        print("There are no customers to build the queries from")
+        return
+    scans = 0
+    for advice in index_advice.advise(
+        lambda args: filter_customers(customer_filters.parse(args))[0], values
+    ):
+        scans += advice.sequential_scan
+        print(f"{'SCAN' if advice.sequential_scan else 'OK':<5}{advice.shape}: ?{advice.query_string}")
+        for step in advice.plan:
+            print(f"       {step}")
+        if advice.advice:
+            print(f"       -> {advice.advice}")
+    print(f"{scans} of {len(index_advice.QUERY_SHAPES)} queries scan the {Customer.__tablename__} table")
+    missing = index_advice.missing_indexes()
+    if missing:
+        print(f"Missing indexes: {', '.join(missing)} (run flask db-indexes)")
+
+
+######################################################################
+# Command to precompress and fingerprint the static assets
+# Usage:
+#   flask assets-build
+######################################################################
+@app.cli.command("assets-build")
+def assets_build():
+    """
+    Writes fingerprinted, precompressed copies of the static assets
+    """
+    for name, path in assets.build_assets(app.static_folder).items():
+        print(f"{name} -> {path}")
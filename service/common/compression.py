@@ -0,0 +1,78 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Response Compression
+
+This module negotiates gzip (and brotli when it is installed) encoding
+for API responses that are larger than a configurable threshold
+"""
+import gzip
+from flask import current_app, request
+
+try:  # brotli is optional
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+
+def accepted_encodings():
+    """Returns the content codings the client accepts, highest q-value first"""
+    offered = ["br", "gzip"] if brotli is not None else ["gzip"]
+    quality = {coding: request.accept_encodings.quality(coding) for coding in offered}
+    # sorted keeps brotli first when the client likes both equally
+    return sorted((coding for coding in offered if quality[coding] > 0), key=lambda coding: -quality[coding])
+
+
+def compress(data: bytes, encoding: str, level: int) -> bytes:
+    """Compresses the data with the given content coding"""
+    if encoding == "br":
+        # brotli quality goes from 0 to 11, gzip levels from 0 to 9
+        return brotli.compress(data, quality=min(level, 11))
+    return gzip.compress(data, compresslevel=min(level, 9), mtime=0)
+
+
+def compress_response(response):
+    """Compresses a response when the client and the payload allow it"""
+    config = current_app.config
+    if (
+        not config.get("COMPRESS_ENABLED", True)
+        or response.direct_passthrough
+        or response.status_code < 200
+        or response.status_code in (204, 304)
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in config.get("COMPRESS_MIMETYPES", [])
+    ):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encodings = accepted_encodings()
+    if not encodings:
+        return response
+    data = response.get_data()
+    if len(data) < config.get("COMPRESS_MIN_SIZE", 0):
+        return response
+
+    encoding = encodings[0]
+    response.set_data(compress(data, encoding, config.get("COMPRESS_LEVEL", 6)))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def init_compression(app):
+    """Registers the response compression hook with the app"""
+    app.after_request(compress_response)
+    app.logger.info("Response compression established")
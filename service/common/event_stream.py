@@ -0,0 +1,214 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Customer Event Stream
+
+Pushes the writes of Customers to the clients of GET /customers/events
+as Server-Sent Events, so dashboards see changes without polling:
+
+    id: 5f0c2a9e-42
+    event: update
+    data: {"id":7,"username":"alice",...}
+
+The events come from the write listeners of the model, one per create,
+update, activate, deactivate and delete. Each is encoded once and kept
+in a ring buffer of the last EVENTS_BUFFER_SIZE events, so a client that
+reconnects with the Last-Event-ID header is sent the events it missed.
+An id that has left the buffer, or that was given out by another process,
+gets a reset event instead: the client should reload the customers.
+
+Every client has its own queue of EVENTS_QUEUE_SIZE events and one that
+falls that far behind is disconnected, so a write never waits on a slow
+client. Streams also end after EVENTS_MAX_DURATION seconds and browsers
+reconnect with their last id, so no client holds a worker thread for good.
+
+The writes of this process come from the write listeners of the model.
+On Postgres, once a client connects, the writes of the other processes
+and pods come from the invalidation bus, which only carries their ids,
+so those customers are read back before they are sent. Ids and buffers
+are still per process, so a client that reconnects to another process
+gets a reset. Without Postgres a stream only sees the writes of its own
+process. Each client holds a thread, for example of
+gunicorn --worker-class gthread --threads 64.
+"""
+import json
+import time
+import uuid
+import queue
+import threading
+from collections import deque
+from service.models import db, Customer, add_write_listener
+from service.common import invalidation
+
+# how long browsers wait before reconnecting, in milliseconds
+RETRY_MS = 3000
+KEEP_ALIVE = ": keep-alive\n\n"
+
+
+def format_event(event_id, name, data):
+    """Encodes an event in the text/event-stream format"""
+    event = f"id: {event_id}\n" if event_id else ""
+    return f"{event}event: {name}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+class Subscriber:  # pylint: disable=too-few-public-methods
+    """A connected client and the events waiting to be sent to it"""
+
+    def __init__(self, size):
+        self.queue = queue.Queue(size)
+        self.dropped = False
+
+
+class EventBroker:
+    """Buffers the Customer events and fans them out to the connected clients"""
+
+    def __init__(self, buffer_size, queue_size, max_clients, on_first_client=None):
+        # event ids start with a token of the process so ids from another
+        # process, or from before a restart, are not taken for ours
+        self.epoch = uuid.uuid4().hex[:8]
+        self.queue_size = queue_size
+        self.max_clients = max_clients
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._buffer = deque(maxlen=buffer_size)
+        self._subscribers = set()
+        self._last = 0
+        self._on_first_client = on_first_client
+
+    def publish(self, action, data):
+        """Buffers an event and queues it for every client, a write listener"""
+        data = {name: value for name, value in data.items() if name != "password"}
+        with self._lock:
+            self._last += 1
+            event = format_event(f"{self.epoch}-{self._last}", action, data)
+            self._buffer.append((self._last, event))
+            slow = []
+            for subscriber in self._subscribers:
+                try:
+                    subscriber.queue.put_nowait(event)
+                except queue.Full:
+                    slow.append(subscriber)
+            for subscriber in slow:
+                subscriber.dropped = True
+                self._subscribers.discard(subscriber)
+            self.dropped += len(slow)
+
+    def subscribe(self, last_event_id=None):
+        """
+        Connects a client
+
+        The first client calls on_first_client, once.
+
+        Args:
+            last_event_id (str): the id of the last event the client received
+
+        Returns:
+            tuple: the Subscriber and the events it missed, or (None, None)
+            when EVENTS_MAX_CLIENTS are already connected
+        """
+        with self._lock:
+            if len(self._subscribers) >= self.max_clients:
+                return None, None
+            subscriber = Subscriber(self.queue_size)
+            self._subscribers.add(subscriber)
+            missed = self._missed(last_event_id)
+            first, self._on_first_client = self._on_first_client, None
+        if first is not None:
+            first()
+        return subscriber, missed
+
+    def unsubscribe(self, subscriber):
+        """Disconnects a client"""
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    @property
+    def clients(self):
+        """Returns the number of connected clients"""
+        return len(self._subscribers)
+
+    def _missed(self, last_event_id):
+        """Returns the buffered events after an id, or a reset event"""
+        if not last_event_id:
+            return []
+        epoch, _, number = last_event_id.partition("-")
+        oldest = self._buffer[0][0] if self._buffer else self._last + 1
+        if epoch == self.epoch and number.isdigit() and oldest - 1 <= int(number) <= self._last:
+            return [event for sequence, event in self._buffer if sequence > int(number)]
+        reason = "The events since Last-Event-ID are no longer available, reload the customers"
+        return [format_event(f"{self.epoch}-{self._last}", "reset", {"reason": reason})]
+
+    def stream(self, subscriber, backlog, heartbeat, max_duration):
+        """
+        Yields the events of a client until it disconnects, is dropped or
+        has been connected for max_duration seconds
+
+        A comment is sent every heartbeat seconds without events so proxies
+        keep the connection open and a closed one is noticed.
+        """
+        deadline = time.monotonic() + max_duration
+        try:
+            yield f"retry: {RETRY_MS}\n\n"
+            yield from backlog
+            while not subscriber.dropped:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                try:
+                    yield subscriber.queue.get(timeout=min(heartbeat, remaining))
+                except queue.Empty:
+                    yield KEEP_ALIVE
+            yield format_event(None, "dropped", {"reason": "The client fell too far behind"})
+        finally:
+            self.unsubscribe(subscriber)
+
+
+def relay(app, broker, action, customer_id):
+    """Publishes a write of another process, an invalidation handler"""
+    if customer_id is None:
+        # the writes sent while the bus was disconnected are lost
+        broker.publish(action, {"reason": "Events may have been missed, reload the customers"})
+        return
+    if action == "delete":
+        broker.publish(action, {"id": customer_id})
+        return
+    with app.app_context():
+        try:
+            customer = Customer.find(customer_id)
+            data = None if customer is None else customer.serialize()
+        finally:
+            db.session.remove()
+    # a customer deleted since is followed by its delete event
+    if data is not None:
+        broker.publish(action, data)
+
+
+def init_event_stream(app):
+    """Creates the event broker and publishes the Customer writes of every process to it"""
+
+    def relay_other_processes():
+        invalidation.subscribe(app, lambda action, customer_id: relay(app, broker, action, customer_id))
+
+    broker = EventBroker(
+        app.config["EVENTS_BUFFER_SIZE"],
+        app.config["EVENTS_QUEUE_SIZE"],
+        app.config["EVENTS_MAX_CLIENTS"],
+        relay_other_processes,
+    )
+    add_write_listener(broker.publish)
+    app.extensions["event_stream"] = broker
+    app.logger.info("Event stream established")
@@ -0,0 +1,148 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Idempotency Keys
+
+A client that retries a create or an update after a timeout sends the
+same Idempotency-Key header again. The first request with a key claims
+it and its response is stored, so a retry is answered from the store
+with one SELECT: it is not validated again, no password is hashed and
+nothing is written.
+
+Keys are scoped to the client, the method and the path, and a key sent
+again with a different body, or asking for a different media type in
+its Accept header, is rejected since the stored response could not
+answer it. A retry that arrives while the
+first request is still being processed gets 409 Conflict. Server errors
+are not stored so the request can be retried.
+"""
+import time
+import hashlib
+import itertools
+from flask import current_app, g, request
+from service.models import db, IdempotencyRecord
+from service.common import status
+from service.common.rate_limit import client_identity
+from service.common.media_types import JSON, REQUEST_MEDIA_TYPES
+
+HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+
+_saves = itertools.count(1)
+
+
+def _digest(*parts) -> str:
+    """Hashes the parts into a fixed-size hex key"""
+    digest = hashlib.blake2b(digest_size=32)
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _error(code, name, message):
+    """Returns an error response in the format of the error handlers"""
+    current_app.logger.warning(message)
+    return {"status_code": code, "error": name, "message": message}, code
+
+
+def _applies():
+    """Returns True if the request carries a key for an idempotent endpoint"""
+    config = current_app.config
+    if not config["IDEMPOTENCY_ENABLED"] or HEADER not in request.headers:
+        return False
+    return request.method in config["IDEMPOTENT_ENDPOINTS"].get(request.endpoint, ())
+
+
+def check_idempotency_key():
+    """Answers a retried request from the store, or claims its key"""
+    if not _applies():
+        return None
+    key = request.headers[HEADER]
+    if not key or len(key) > MAX_KEY_LENGTH:
+        return _error(
+            status.HTTP_400_BAD_REQUEST,
+            "Bad Request",
+            f"{HEADER} must be 1 to {MAX_KEY_LENGTH} characters",
+        )
+
+    record_id = _digest(client_identity(), request.method, request.path, key)
+    mediatype = request.accept_mimetypes.best_match(REQUEST_MEDIA_TYPES, default=JSON)
+    fingerprint = _digest(request.query_string, request.get_data(), mediatype)
+    now = time.time()
+    record = IdempotencyRecord.find_live(record_id, now)
+    if record is None:
+        expires_at = now + current_app.config["IDEMPOTENCY_LOCK_TIMEOUT"]
+        if IdempotencyRecord.claim(record_id, fingerprint, expires_at, now):
+            g.idempotency_record = record_id
+            return None
+        record = IdempotencyRecord.find_live(record_id, now)
+    return _replay(record, fingerprint)
+
+
+def _replay(record, fingerprint):
+    """Returns the stored response of a record"""
+    if record is not None and record.fingerprint != fingerprint:
+        return _error(
+            status.HTTP_422_UNPROCESSABLE_ENTITY,
+            "Unprocessable Entity",
+            f"{HEADER} was already used for a different request",
+        )
+    if record is None or record.status == IdempotencyRecord.PENDING:
+        return _error(
+            status.HTTP_409_CONFLICT,
+            "Conflict",
+            f"A request with this {HEADER} is still being processed",
+        )
+    headers = {REPLAYED_HEADER: "true"}
+    if record.location:
+        headers["Location"] = record.location
+    return current_app.response_class(
+        record.body, status=record.status, content_type=record.content_type, headers=headers
+    )
+
+
+def store_response(response):
+    """Stores the response of the request that claimed a key"""
+    record_id = g.pop("idempotency_record", None)
+    if record_id is None:
+        return response
+    now = time.time()
+    try:
+        if response.status_code >= 500:
+            IdempotencyRecord.release(record_id)
+        else:
+            expires_at = now + current_app.config["IDEMPOTENCY_TTL"]
+            IdempotencyRecord.save(record_id, response, expires_at)
+        if next(_saves) % current_app.config["IDEMPOTENCY_PURGE_EVERY"] == 0:
+            IdempotencyRecord.purge(now)
+    except Exception:  # pylint: disable=broad-except
+        # the key stays claimed until its lock times out
+        db.session.rollback()
+        current_app.logger.exception("Could not store the response for an %s", HEADER)
+    return response
+
+
+def init_idempotency(app):
+    """Registers the Idempotency-Key hooks"""
+    app.before_request(check_idempotency_key)
+    app.after_request(store_response)
+    app.logger.info(
+        "Idempotency keys established (%s)",
+        "enabled" if app.config["IDEMPOTENCY_ENABLED"] else "disabled",
+    )
@@ -0,0 +1,164 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Index Advice
+
+EXPLAINs the query shapes that the customer list can generate, with
+values taken from the current data, and reports the ones the planner
+answers with a sequential scan of the customer table along with the
+indexes declared on the model that the database does not have.
+
+The planner picks a sequential scan whenever it is cheaper, which is
+always the case for a small table, so the advice is only meaningful on
+a database with realistic data.
+"""
+from typing import NamedTuple
+from sqlalchemy import inspect
+from werkzeug.datastructures import MultiDict
+from service.models import db, Customer
+from service.common.query_plans import capture_plan
+
+# (description, query string) with {placeholders} filled from the data
+QUERY_SHAPES = [
+    ("active customers", "active=true"),
+    ("gender", "gender={gender}"),
+    ("active and gender", "active=true&gender={gender}"),
+    ("active, gender and last name prefix", "active=true&gender={gender}&last_name={last_name}*"),
+    ("exact username", 'username="{username_exact}"'),
+    ("username prefix", "username={username}*"),
+    ("email prefix", "email={email}*"),
+    ("last name prefix", "last_name={last_name}*"),
+    ("batch of ids", "id={ids}"),
+    ("range of ids", "id__gte={low_id}&id__lt={high_id}"),
+    ("last name substring", "last_name={last_name}"),
+]
+
+SUBSTRING_ADVICE = (
+    "substring filters cannot use a B-tree index: use a prefix (abc*), "
+    "SEARCH_INDEX_ENABLED or /customers/search"
+)
+
+
+class Advice(NamedTuple):
+    """The plan of one query shape"""
+
+    shape: str
+    query_string: str
+    plan: list
+    sequential_scan: bool
+    advice: str
+
+
+def explain(statement):
+    """
+    EXPLAINs a statement
+
+    Returns:
+        tuple: the steps of the plan and whether it scans the customer table
+    """
+    plan = capture_plan(statement)
+    if db.engine.dialect.name == "postgresql":
+        steps = _postgres_steps(plan[0]["Plan"])
+        scan = any(step == f"Seq Scan on {Customer.__tablename__}" for step in steps)
+    else:
+        steps = plan
+        scan = any(step == f"SCAN {Customer.__tablename__}" for step in steps)
+    return steps, scan
+
+
+def _postgres_steps(node):
+    """Flattens a Postgres JSON plan into one line per node"""
+    step = node["Node Type"]
+    if "Index Name" in node:
+        step += f" using {node['Index Name']}"
+    if "Relation Name" in node:
+        step += f" on {node['Relation Name']}"
+    steps = [step]
+    for child in node.get("Plans", []):
+        steps.extend(_postgres_steps(child))
+    return steps
+
+
+def existing_indexes():
+    """
+    Returns the names of the indexes on the customer table
+
+    The catalogs are read directly because SQLite's reflection skips the
+    expression indexes.
+    """
+    table = Customer.__tablename__
+    dialect = db.engine.dialect.name
+    if dialect == "postgresql":
+        sql = "SELECT indexname FROM pg_indexes WHERE tablename = :table"
+    elif dialect == "sqlite":
+        sql = "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table"
+    else:
+        return {index["name"] for index in inspect(db.engine).get_indexes(table)}
+    return set(db.session.execute(db.text(sql), {"table": table}).scalars())
+
+
+def missing_indexes():
+    """Returns the names of the declared indexes the database does not have"""
+    existing = existing_indexes()
+    return sorted(index.name for index in Customer.__table__.indexes if index.name not in existing)
+
+
+def sample_values():
+    """Returns values from the current data to fill in the query shapes"""
+    customers = db.session.execute(db.select(Customer).order_by(Customer.id).limit(3)).scalars().all()
+    if not customers:
+        return None
+    first = customers[0]
+    ids = [customer.id for customer in customers]
+    return {
+        "gender": first.gender.name.lower(),
+        "last_name": first.last_name[:3],
+        "username": first.username[:3],
+        "username_exact": first.username,
+        "email": first.email[:3],
+        "ids": ",".join(str(customer_id) for customer_id in ids),
+        "low_id": ids[0],
+        "high_id": ids[-1],
+    }
+
+
+def advise(build_query, values):
+    """
+    EXPLAINs every query shape
+
+    Args:
+        build_query (callable): makes the list query for the parsed arguments
+        values (dict): the sample values for the shapes
+
+    Returns:
+        list: the Advice for each shape
+    """
+    missing = missing_indexes()
+    results = []
+    for shape, template in QUERY_SHAPES:
+        query_string = template.format(**values)
+        args = MultiDict(pair.split("=", 1) for pair in query_string.split("&"))
+        steps, scan = explain(build_query(args).statement)
+        advice = ""
+        if scan and "substring" in shape:
+            advice = SUBSTRING_ADVICE
+        elif scan and missing:
+            advice = "some declared indexes are missing, run flask db-indexes"
+        elif scan:
+            advice = "no index suits this filter on the current data"
+        results.append(Advice(shape, query_string, steps, scan, advice))
+    return results
@@ -0,0 +1,175 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Cache Invalidation
+
+Keeps the in-process caches of every worker of every pod in step with
+the writes made by the others. Once a cache subscribes, each write of a
+Customer NOTIFYs INVALIDATION_CHANNEL from the write statement itself,
+see announce_writes:
+
+    {"origin": "<process>", "action": "update", "id": 7}
+
+and a thread in every process LISTENs on its own connection and hands
+the writes of the other processes to the handlers the caches subscribed,
+which evict or reload the customer. The process's own writes already
+reached its caches through the write listeners. Without subscribers the
+writes send nothing and no connection is held.
+
+Notifications sent while a listener is disconnected are lost, so while
+it is down caches should expire their entries after ttl(), at most
+INVALIDATION_FALLBACK_TTL seconds, and after it reconnects the handlers
+are called with a reset so they drop everything. Without Postgres there
+is nothing to listen to and the caches keep their own TTLs.
+"""
+import json
+import uuid
+import atexit
+import select
+import logging
+import threading
+from service.models import db, announce_writes
+
+try:  # the Postgres driver is only installed for Postgres
+    import psycopg
+    from psycopg import sql
+except ImportError:  # pragma: no cover
+    psycopg = None
+
+logger = logging.getLogger("flask.app")
+
+RESET = "reset"
+
+
+class InvalidationBus:
+    """Sends the writes of this process and receives those of the others"""
+
+    def __init__(self, channel, heartbeat, retry, connect=None):
+        self.origin = uuid.uuid4().hex
+        self.connect = connect
+        self.thread = None
+        self.channel = channel
+        self.heartbeat = heartbeat
+        self.retry = retry
+        self.connected = False
+        self.received = 0
+        self._handlers = []
+        self._stopped = threading.Event()
+
+    def subscribe(self, handler):
+        """Calls handler(action, customer_id) for the writes of the other processes"""
+        self._handlers.append(handler)
+
+    def receive(self, payload):
+        """Hands a notification to the handlers unless it came from this process"""
+        message = json.loads(payload)
+        if message["origin"] == self.origin:
+            return
+        self.received += 1
+        self._dispatch(message["action"], message["id"])
+
+    def _dispatch(self, action, customer_id):
+        """Calls the handlers, a failing handler does not stop the others"""
+        for handler in list(self._handlers):
+            try:
+                handler(action, customer_id)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Invalidation handler %r failed for %s", handler, action)
+
+    def listen(self, connect):
+        """
+        Receives notifications until stopped, reconnecting when the connection drops
+
+        Args:
+            connect (callable): opens an autocommit psycopg connection
+        """
+        first = True
+        while not self._stopped.is_set():
+            try:
+                with connect() as connection:
+                    connection.add_notify_handler(lambda notify: self.receive(notify.payload))
+                    connection.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.channel)))
+                    self.connected = True
+                    logger.info("Listening for invalidations on %s", self.channel)
+                    if not first:
+                        # the notifications sent while disconnected are lost
+                        self._dispatch(RESET, None)
+                    first = False
+                    self._poll(connection)
+            except Exception as reason:  # pylint: disable=broad-except
+                logger.warning("Invalidation listener disconnected: %s", reason)
+            self.connected = False
+            self._stopped.wait(self.retry)
+
+    def _poll(self, connection):
+        """Waits for notifications, a query delivers them and checks the connection"""
+        while not self._stopped.is_set():
+            select.select([connection], [], [], self.heartbeat)
+            connection.execute("SELECT 1")
+
+    def start(self, connect):
+        """Starts the listener thread"""
+        self.thread = threading.Thread(target=self.listen, args=(connect,), name="invalidation", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+        return self.thread
+
+    def stop(self):
+        """Stops the listener thread after its current wait"""
+        self._stopped.set()
+
+
+######################################################################
+# Helpers for the caches
+######################################################################
+def subscribe(app, handler):
+    """
+    Calls handler(action, customer_id) for the writes of the other processes
+
+    The first subscriber makes the writes announce themselves and starts
+    listening for those of the others.
+    """
+    bus = app.extensions.get("invalidation")
+    if bus is None:
+        return
+    bus.subscribe(handler)
+    if bus.thread is None:
+        announce_writes(bus.channel, bus.origin)
+        bus.start(bus.connect)
+        app.logger.info("Cache invalidation established on %s", bus.channel)
+
+
+def ttl(app, seconds):
+    """Returns how long a cache entry may live, shortened while invalidations are not received"""
+    bus = app.extensions.get("invalidation")
+    if bus is None or bus.connected:
+        return seconds
+    return min(seconds, app.config["INVALIDATION_FALLBACK_TTL"])
+
+
+def init_invalidation(app):
+    """Prepares the bus that the caches subscribe to, it starts with the first subscriber"""
+    if not app.config["INVALIDATION_ENABLED"] or db.engine.dialect.name != "postgresql" or psycopg is None:
+        app.logger.info("Cache invalidation disabled")
+        return
+    url = db.engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+    app.extensions["invalidation"] = InvalidationBus(
+        app.config["INVALIDATION_CHANNEL"],
+        app.config["INVALIDATION_HEARTBEAT"],
+        app.config["INVALIDATION_RETRY"],
+        lambda: psycopg.connect(url, autocommit=True),
+    )
@@ -0,0 +1,298 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+In-process Inverted Index
+
+Maps the lowercased character n-grams of the searchable Customer fields
+to sorted arrays of customer ids. Every n-gram of a substring is also an
+n-gram of the value containing it, so intersecting the posting lists of
+the n-grams of a search term gives a superset of the customers whose
+field contains the term. The database then only has to check those ids
+instead of scanning the table with ILIKE.
+
+The index is built at startup by streaming the table and is kept up to
+date by the model's write listeners. Each worker process holds its own
+copy, which reloads the customers the other workers write when their
+invalidations are received, and SEARCH_INDEX_REFRESH rebuilds it
+periodically in case some were missed.
+"""
+import sys
+import bisect
+import threading
+from abc import ABC, abstractmethod
+from array import array
+from service.models import db, Customer, add_write_listener
+from service.common import invalidation
+
+DEFAULT_FIELDS = ("username", "email", "address", "first_name", "last_name")
+
+
+class StreamedIndex(ABC):
+    """
+    Base of the indexes that are loaded from the table and follow its writes
+
+    Subclasses keep their structures in _index and _unindex, and create an
+    empty copy of themselves in _empty so load can build the new index off
+    to the side and swap it in with _swap.
+    """
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self._lock = threading.RLock()
+        self._documents = {}
+        self._replay = None
+
+    def add(self, customer_id, values):
+        """Indexes a customer, replacing what was indexed for it before"""
+        with self._lock:
+            if self._replay is not None:
+                self._replay.append((customer_id, values))
+            self._remove(customer_id)
+            document = {field: values.get(field) for field in self.fields}
+            self._index(customer_id, document)
+            self._documents[customer_id] = document
+
+    def remove(self, customer_id):
+        """Removes a customer from the index"""
+        with self._lock:
+            if self._replay is not None:
+                self._replay.append((customer_id, None))
+            self._remove(customer_id)
+
+    def _remove(self, customer_id):
+        """Removes a customer, the caller holds the lock"""
+        document = self._documents.pop(customer_id, None)
+        if document is not None:
+            self._unindex(customer_id, document)
+
+    def load(self, rows):
+        """
+        Rebuilds the index from (id, value, ...) rows in id order
+
+        Writes that arrive while the rows are streamed are replayed on top
+        of the new index so they are not lost when it replaces the old one.
+        """
+        with self._lock:
+            self._replay = []
+        fresh = self._empty()
+        try:
+            for row in rows:
+                fresh.add(row[0], dict(zip(self.fields, row[1:])))
+        finally:
+            with self._lock:
+                replay, self._replay = self._replay, None
+        with self._lock:
+            self._swap(fresh)
+            for customer_id, values in replay:
+                if values is None:
+                    self._remove(customer_id)
+                else:
+                    self.add(customer_id, values)
+
+    def _swap(self, fresh):
+        """Takes over the structures of a freshly loaded index"""
+        self._documents = fresh._documents
+
+    @abstractmethod
+    def _empty(self):
+        """Returns an empty index with the same settings"""
+
+    @abstractmethod
+    def _index(self, customer_id, document):
+        """Adds a document to the structures"""
+
+    @abstractmethod
+    def _unindex(self, customer_id, document):
+        """Removes a document from the structures"""
+
+
+class InvertedIndex(StreamedIndex):
+    """An n-gram index from field values to sorted customer ids"""
+
+    def __init__(self, fields=DEFAULT_FIELDS, gram_size=3):
+        super().__init__(fields)
+        self.gram_size = gram_size
+        self._postings = {}
+
+    def grams(self, value):
+        """Returns the set of n-grams of a value"""
+        value = (value or "").lower()
+        size = self.gram_size
+        return {value[i:i + size] for i in range(len(value) - size + 1)}
+
+    def _empty(self):
+        return InvertedIndex(self.fields, self.gram_size)
+
+    def _swap(self, fresh):
+        super()._swap(fresh)
+        self._postings = fresh._postings
+
+    def _index(self, customer_id, document):
+        for field, value in document.items():
+            for gram in self.grams(value):
+                postings = self._postings.setdefault((field, gram), array("I"))
+                # ids mostly arrive in order, so this is usually an append
+                bisect.insort(postings, customer_id)
+
+    def _unindex(self, customer_id, document):
+        for field, value in document.items():
+            for gram in self.grams(value):
+                postings = self._postings[(field, gram)]
+                del postings[bisect.bisect_left(postings, customer_id)]
+                if not postings:
+                    del self._postings[(field, gram)]
+
+    def candidates(self, field, value):
+        """
+        Returns the sorted ids whose field may contain the value
+
+        Returns:
+            list: the candidate ids, or None when the value is shorter than
+            an n-gram and the index cannot narrow the search
+        """
+        grams = self.grams(value)
+        if not grams:
+            return None
+        with self._lock:
+            lists = [self._postings.get((field, gram)) for gram in grams]
+            if not all(lists):
+                return []
+            lists.sort(key=len)
+            return [
+                customer_id
+                for customer_id in lists[0]
+                if all(_contains(postings, customer_id) for postings in lists[1:])
+            ]
+
+    def stats(self):
+        """Returns the size of the index and an estimate of its memory use"""
+        with self._lock:
+            size = sys.getsizeof(self._postings) + sys.getsizeof(self._documents)
+            for (field, gram), postings in self._postings.items():
+                size += sys.getsizeof((field, gram)) + sys.getsizeof(gram)
+                size += sys.getsizeof(postings)
+            for document in self._documents.values():
+                size += sys.getsizeof(document)
+                size += sum(sys.getsizeof(value) for value in document.values())
+            return {
+                "customers": len(self._documents),
+                "grams": len(self._postings),
+                "postings": sum(len(postings) for postings in self._postings.values()),
+                "bytes": size,
+            }
+
+
+def _contains(postings, customer_id):
+    """Binary searches a sorted posting list"""
+    i = bisect.bisect_left(postings, customer_id)
+    return i < len(postings) and postings[i] == customer_id
+
+
+######################################################################
+# Flask integration
+######################################################################
+def build_index(app, index):
+    """Loads every customer into the index, streaming the table"""
+    columns = [getattr(Customer, field) for field in index.fields]
+    statement = (
+        db.select(Customer.id, *columns)
+        .order_by(Customer.id)
+        .execution_options(yield_per=1000)
+    )
+    with app.app_context():
+        try:
+            index.load(db.session.execute(statement))
+        finally:
+            db.session.remove()
+    stats = index.stats()
+    app.logger.info(
+        "%s built: %s, %.1f KiB",
+        type(index).__name__,
+        ", ".join(f"{count} {name}" for name, count in stats.items() if name != "bytes"),
+        stats["bytes"] / 1024,
+    )
+
+
+def refresh_interval(app, interval):
+    """
+    Returns when to rebuild an index next
+
+    Without invalidations the writes of the other workers and pods only
+    reach the index when it is rebuilt, so it is rebuilt at least every
+    INVALIDATION_FALLBACK_TTL seconds, as while the listener is down.
+    """
+    if "invalidation" not in app.extensions:
+        return min(interval, app.config["INVALIDATION_FALLBACK_TTL"])
+    return invalidation.ttl(app, interval)
+
+
+def _schedule_refresh(app, index, interval):
+    """Rebuilds the index every interval seconds"""
+
+    def refresh():
+        try:
+            build_index(app, index)
+        except Exception:  # pylint: disable=broad-except
+            app.logger.exception("%s refresh failed", type(index).__name__)
+        _schedule_refresh(app, index, interval)
+
+    timer = threading.Timer(refresh_interval(app, interval), refresh)
+    timer.daemon = True
+    timer.start()
+
+
+def reload_customer(app, index, customer_id):
+    """Reindexes a customer written by another process, or everything after a reset"""
+    if customer_id is None:
+        build_index(app, index)
+        return
+    columns = [getattr(Customer, field) for field in index.fields]
+    statement = db.select(*columns).where(Customer.id == customer_id)
+    with app.app_context():
+        try:
+            row = db.session.execute(statement).first()
+        finally:
+            db.session.remove()
+    if row is None:
+        index.remove(customer_id)
+    else:
+        index.add(customer_id, dict(zip(index.fields, row)))
+
+
+def maintain_index(app, name, index, refresh):
+    """Builds an index, keeps it up to date and stores it in app.extensions"""
+
+    def on_write(action, data):
+        if action == "delete":
+            index.remove(data["id"])
+        else:
+            index.add(data["id"], data)
+
+    add_write_listener(on_write)
+    invalidation.subscribe(app, lambda _action, customer_id: reload_customer(app, index, customer_id))
+    build_index(app, index)
+    app.extensions[name] = index
+    if refresh:
+        _schedule_refresh(app, index, refresh)
+
+
+def init_search_index(app):
+    """Builds the search index and keeps it up to date"""
+    if not app.config["SEARCH_INDEX_ENABLED"]:
+        return
+    index = InvertedIndex(gram_size=app.config["SEARCH_INDEX_GRAM_SIZE"])
+    maintain_index(app, "search_index", index, app.config["SEARCH_INDEX_REFRESH"])
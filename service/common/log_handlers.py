@@ -19,18 +19,163 @@ Log Handlers
 
 This module contains utility functions to set up logging
 consistently
+
+Request threads only put log records on a queue, a background listener
+thread formats them and writes them through gunicorn's handlers, so a
+slow stdout does not slow the requests down. Records are stamped with
+the request id, method, path and route while they are still in the
+request thread, and every request ends with one line that holds its
+latency, the time it spent in the database and, when the request was
+sampled by request_timing, the time of each of its phases.
+
+High-volume INFO lines can be sampled with LOG_SAMPLE_RATES, which maps
+the start of a message to the fraction of its records that are kept.
 """
+import json
+import time
+import queue
+import atexit
+import random
 import logging
+from logging.handlers import QueueHandler, QueueListener
+from flask import current_app, g, has_request_context, request
+from service.common import request_timing
+
+# the logger of the model module, which is not the app's logger
+MODEL_LOGGER = "flask.app"
+TEXT_FORMAT = "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+# record attributes that the JSON records carry when they are set
+CONTEXT_FIELDS = ("request_id", "method", "path", "route", "status", "latency_ms", "db_ms", "timings")
+
+
+######################################################################
+# Formatting, sampling and queueing
+######################################################################
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, DATE_FORMAT),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fraction of the INFO and DEBUG records of some messages"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = tuple(rates.items())
+
+    def filter(self, record):
+        if record.levelno > logging.INFO:
+            return True
+        message = str(record.msg)
+        for prefix, rate in self.rates:
+            if message.startswith(prefix):
+                return random.random() < rate
+        return True
+
+
+class RequestContextFilter(logging.Filter):
+    """Stamps records with the request they were logged for"""
+
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = g.get("request_id")
+            record.method = request.method
+            record.path = request.path
+            record.route = request.endpoint
+        return True
 
 
+class NonBlockingQueueHandler(QueueHandler):
+    """A QueueHandler that drops records instead of waiting when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        """Renders the message and traceback so the record can cross threads"""
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+######################################################################
+# Request log line
+######################################################################
+def log_request(response):
+    """Logs the status, latency and database time of the request"""
+    started = g.get("request_started")
+    if started is not None:
+        current_app.logger.info(
+            "Request finished",
+            extra={
+                "status": response.status_code,
+                "latency_ms": round((time.perf_counter() - started) * 1000, 2),
+                "db_ms": round(g.get("db_time", 0.0) * 1000, 2),
+                "timings": request_timing.summary(),
+            },
+        )
+    return response
+
+
+######################################################################
+# Setup
+######################################################################
 def init_logging(app, logger_name: str):
     """Set up logging for production"""
     app.logger.propagate = False
     gunicorn_logger = logging.getLogger(logger_name)
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
+    handlers = gunicorn_logger.handlers
     # Make all log formats consistent
-    formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z")
-    for handler in app.logger.handlers:
+    if app.config["LOG_FORMAT"] == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT, DATE_FORMAT)
+    for handler in handlers:
         handler.setFormatter(formatter)
+
+    if app.config["LOG_ASYNC"]:
+        handler = NonBlockingQueueHandler(queue.Queue(app.config["LOG_QUEUE_SIZE"]))
+        listener = QueueListener(handler.queue, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        handlers = [handler]
+    for handler in handlers:
+        handler.addFilter(RequestContextFilter())
+        handler.addFilter(SamplingFilter(app.config["LOG_SAMPLE_RATES"]))
+
+    for logger in (app.logger, logging.getLogger(MODEL_LOGGER)):
+        logger.propagate = False
+        logger.handlers = list(handlers)
+        logger.setLevel(gunicorn_logger.level)
+
+    app.after_request(log_request)
     app.logger.info("Logging handler established")
@@ -0,0 +1,130 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Binary Media Types
+
+Lets the other services exchange customers as MessagePack or CBOR, which
+are smaller than JSON and cheaper to encode and decode:
+
+    application/msgpack  MessagePack, when msgpack is installed
+    application/cbor     CBOR (RFC 8949), when cbor2 is installed
+
+The responses of the API are negotiated from the Accept header by the
+flask-restx representations registered here, JSON stays the default.
+POST, PUT and PATCH bodies may be sent in the same formats with the
+matching Content-Type, read_body decodes them.
+"""
+from flask import make_response, request
+from service.models import DataValidationError
+from service.common.request_timing import phase
+
+try:  # msgpack is optional
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+try:  # cbor2 is optional
+    import cbor2
+except ImportError:  # pragma: no cover
+    cbor2 = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+CBOR = "application/cbor"
+
+
+def _codecs():
+    """Returns the (encode, decode) functions of the installed binary media types"""
+    codecs = {}
+    if msgpack is not None:
+        codecs[MSGPACK] = (msgpack.packb, msgpack.unpackb)
+    if cbor2 is not None:
+        codecs[CBOR] = (cbor2.dumps, cbor2.loads)
+    return codecs
+
+
+CODECS = _codecs()
+
+# What the decoders raise for a malformed body, msgpack raises ValueErrors
+DECODE_ERRORS = (ValueError, cbor2.CBORDecodeError) if cbor2 is not None else (ValueError,)
+
+# The Content-Types of the request bodies, JSON first
+REQUEST_MEDIA_TYPES = [JSON] + list(CODECS)
+
+
+# The values JSON can hold, the binary media types also have bytes, dates...
+JSON_TYPES = (str, bool, int, float, type(None))
+
+
+def _check_json(value):
+    """Raises a DataValidationError when a decoded value could not be JSON"""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if not isinstance(key, str):
+                raise DataValidationError(f"The keys of the body must be strings, not {type(key).__name__}")
+            _check_json(item)
+    elif isinstance(value, list):
+        for item in value:
+            _check_json(item)
+    elif not isinstance(value, JSON_TYPES):
+        raise DataValidationError(f"The body may not hold a value of type {type(value).__name__}")
+
+
+def read_body():
+    """Returns the decoded body of the request, JSON or a binary media type"""
+    codec = CODECS.get(request.mimetype)
+    if codec is None:
+        return request.get_json()
+    with phase("parse"):
+        try:
+            data = codec[1](request.get_data())
+        except DECODE_ERRORS as error:
+            raise DataValidationError(f"The body is not valid {request.mimetype}: {error}") from error
+        _check_json(data)
+    return data
+
+
+def output(mediatype):
+    """Returns the flask-restx representation of a binary media type"""
+    encode = CODECS[mediatype][0]
+
+    def render(data, code, headers=None):
+        """Renders a response, timing the encoding"""
+        with phase("render"):
+            response = make_response(encode(data), code)
+        response.headers.extend(headers or {})
+        return response
+
+    return render
+
+
+def add_vary(response):
+    """Tells caches that the API responses depend on the Accept header"""
+    if response.mimetype == JSON or response.mimetype in CODECS:
+        response.vary.add("Accept")
+    return response
+
+
+def init_media_types(app, api):
+    """Negotiates the binary media types that are installed"""
+    if not CODECS:
+        app.logger.info("Binary media types disabled, neither msgpack nor cbor2 is installed")
+        return
+    for mediatype in CODECS:
+        api.representations[mediatype] = output(mediatype)
+    app.after_request(add_vary)
+    app.logger.info("Binary media types established: %s", ", ".join(CODECS))
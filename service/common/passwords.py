@@ -0,0 +1,213 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Password Hashing
+
+Hashes are stored as "<algorithm>$<cost>$<salt>$<hash>" so that the
+algorithm and its cost can be changed without invalidating the passwords
+that are already stored. Plain SHA-256 hex digests stored before this
+format existed are still verified.
+
+Hashing is deliberately slow, so it runs in a small pool of worker
+processes. A burst of sign-ups then waits for a free worker instead of
+holding the GIL in the request threads.
+"""
+import hmac
+import secrets
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
+
+SEPARATOR = "$"
+LEGACY_ALGORITHM = "sha256"
+
+
+######################################################################
+# Hash functions: (password, salt, cost) -> digest bytes
+######################################################################
+def _pbkdf2_sha256(password: bytes, salt: bytes, cost: int) -> bytes:
+    """PBKDF2-HMAC-SHA256 with cost iterations"""
+    return hashlib.pbkdf2_hmac("sha256", password, salt, cost)
+
+
+def _scrypt(password: bytes, salt: bytes, cost: int) -> bytes:
+    """scrypt with a work factor of 2 ** cost"""
+    return hashlib.scrypt(password, salt=salt, n=2**cost, r=8, p=1, maxmem=2**26)
+
+
+HASHERS = {
+    "pbkdf2_sha256": _pbkdf2_sha256,
+    "scrypt": _scrypt,
+}
+
+
+def register_hasher(algorithm: str, function):
+    """
+    Makes a hash function available under the algorithm name
+
+    The worker processes do not share this registry, the function is sent
+    to them with every job so it must be picklable: a module-level
+    function rather than a lambda or a closure.
+    """
+    if SEPARATOR in algorithm or algorithm == LEGACY_ALGORITHM:
+        raise ValueError(f"Invalid algorithm name: {algorithm}")
+    HASHERS[algorithm] = function
+
+
+######################################################################
+# Encoding and verification, run in the worker processes
+######################################################################
+def make_hash(password: str, algorithm: str, cost: int, salt: str, hashers=None) -> str:
+    """Returns the encoded hash of the password, hashers defaults to the registered ones"""
+    digest = (hashers or HASHERS)[algorithm](password.encode("utf-8"), bytes.fromhex(salt), cost)
+    return SEPARATOR.join([algorithm, str(cost), salt, digest.hex()])
+
+
+def check_hash(password: str, encoded: str, hashers=None) -> bool:
+    """Returns True if the password matches the encoded hash, hashers defaults to the registered ones"""
+    parts = parse(encoded, hashers)
+    if parts is None:
+        return False
+    algorithm, cost, salt, _ = parts
+    if algorithm == LEGACY_ALGORITHM:
+        expected = hashlib.sha256(password.encode("utf-8")).hexdigest()
+    else:
+        expected = make_hash(password, algorithm, cost, salt, hashers)
+    return hmac.compare_digest(expected, encoded)
+
+
+def parse(encoded: str, hashers=None):
+    """
+    Splits an encoded hash into its parts
+
+    Args:
+        encoded (str): the stored hash
+        hashers (dict): the known hash functions, the registered ones by default
+
+    Returns:
+        tuple: algorithm, cost, salt and digest, or None if it is not a hash
+    """
+    if not isinstance(encoded, str):
+        return None
+    parts = encoded.split(SEPARATOR)
+    if len(parts) == 1 and len(encoded) == 64:
+        try:
+            bytes.fromhex(encoded)
+        except ValueError:
+            return None
+        return LEGACY_ALGORITHM, 0, "", encoded
+    if len(parts) != 4 or parts[0] not in (hashers or HASHERS) or not parts[1].isdigit():
+        return None
+    return parts[0], int(parts[1]), parts[2], parts[3]
+
+
+def is_hashed(value: str) -> bool:
+    """Returns True if the value looks like a stored hash"""
+    return parse(value) is not None
+
+
+######################################################################
+# Hasher engine
+######################################################################
+class PasswordHasher:
+    """Hashes and verifies passwords, in worker processes when it has any"""
+
+    def __init__(self, algorithm="pbkdf2_sha256", cost=600000, workers=0, max_pending=32):
+        if algorithm not in HASHERS:
+            raise ValueError(f"Unknown password hash algorithm: {algorithm}")
+        self.algorithm = algorithm
+        self.cost = cost
+        self.workers = workers
+        self._pending = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def hash(self, password: str) -> str:
+        """Returns the encoded hash of the password"""
+        salt = secrets.token_hex(16)
+        return self._run(make_hash, password, self.algorithm, self.cost, salt, self._hashers(self.algorithm))
+
+    def verify(self, password: str, encoded: str) -> bool:
+        """Returns True if the password matches the encoded hash"""
+        parts = parse(encoded)
+        return self._run(check_hash, password, encoded, self._hashers(parts[0]) if parts else None)
+
+    def needs_rehash(self, encoded: str) -> bool:
+        """Returns True if the hash was made with another algorithm or cost"""
+        parts = parse(encoded)
+        return parts is None or parts[:2] != (self.algorithm, self.cost)
+
+    @staticmethod
+    def _hashers(algorithm):
+        """Returns the registered function of an algorithm, to send to a worker"""
+        return {algorithm: HASHERS[algorithm]} if algorithm in HASHERS else None
+
+    def shutdown(self):
+        """Stops the worker processes"""
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+    def _run(self, function, *args):
+        """
+        Runs the function in a worker process, waiting for a free slot
+
+        The workers import this module afresh, so the hash function is
+        passed in the arguments rather than looked up in their HASHERS.
+        """
+        if not self.workers:
+            return function(*args)
+        with self._pending:
+            return self._get_pool().submit(function, *args).result()
+
+    def _get_pool(self):
+        """Starts the worker processes on first use"""
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("forkserver"),
+                )
+            return self._pool
+
+
+def init_passwords(app):
+    """Creates the password hasher from the configuration"""
+    app.extensions["passwords"] = PasswordHasher(
+        app.config["PASSWORD_HASH_ALGORITHM"],
+        app.config["PASSWORD_HASH_COST"],
+        app.config["PASSWORD_HASH_WORKERS"],
+        app.config["PASSWORD_HASH_MAX_PENDING"],
+    )
+    app.logger.info(
+        "Password hashing established (%s, %d workers)",
+        app.config["PASSWORD_HASH_ALGORITHM"],
+        app.config["PASSWORD_HASH_WORKERS"],
+    )
+
+
+def hash_password(password: str) -> str:
+    """Hashes a password with the app's password hasher"""
+    return current_app.extensions["passwords"].hash(password)
+
+
+def verify_password(password: str, encoded: str) -> bool:
+    """Verifies a password with the app's password hasher"""
+    return current_app.extensions["passwords"].verify(password, encoded)
@@ -0,0 +1,267 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Query String Parser
+
+Turns the query string of a list request into validated filter
+conditions. A parameter is either a field name, which filters with the
+field's default operator, or field__operator:
+
+    username="alice"        exact match
+    username=al*            prefix, LIKE 'al%' which a text_pattern_ops index serves
+    username=al             substring, which no B-tree index can serve
+    username__in=alice,bob  any of the values
+    id__gte=10&id__lt=20    ranges on numbers and timestamps
+    id=3,1,2                batch of keys, on the fields declared with batch=True
+
+A batch is an IN list that keeps the order of the keys, so the caller
+can return the results in that order and report the keys it did not find.
+
+The field declarations are compiled once into a table of parameter names,
+so parsing a request is a dictionary lookup and a conversion per
+parameter. The parsed conditions are sorted and hashable, so query strings
+that ask for the same thing share one key.
+"""
+import operator
+from datetime import datetime, timezone
+from typing import Any, Callable, NamedTuple
+from sqlalchemy import func
+from service.models import DataValidationError
+
+SEPARATOR = "__"
+ESCAPE = "\\"
+
+
+def _prefix(column, value):
+    """
+    lower(column) LIKE 'value%'
+
+    The pattern is bound as one literal so the planner can turn it into a
+    range scan of an index on lower(column) with text_pattern_ops.
+    """
+    for char in (ESCAPE, "%", "_"):
+        value = value.replace(char, ESCAPE + char)
+    return func.lower(column).like(value.lower() + "%", escape=ESCAPE)
+
+
+OPERATORS = {
+    "eq": operator.eq,
+    "exact": operator.eq,
+    "prefix": _prefix,
+    "contains": lambda column, value: column.icontains(value, autoescape=True),
+    "in": lambda column, values: column.in_(values),
+    "batch": lambda column, values: column.in_(values),
+    "gt": operator.gt,
+    "gte": operator.ge,
+    "lt": operator.lt,
+    "lte": operator.le,
+}
+RANGE_OPERATORS = ("eq", "in", "gt", "gte", "lt", "lte")
+
+
+class Field(NamedTuple):
+    """How a field's values are converted and which operators it takes"""
+
+    convert: Callable[[str], Any]
+    operators: tuple
+    default: Callable[[str], tuple]
+    description: str
+
+
+class Condition(NamedTuple):
+    """A validated filter: field, operator and converted value"""
+
+    field: str
+    operator: str
+    value: Any
+
+
+class ParsedQuery(NamedTuple):
+    """The conditions and options of a query string, in a canonical order"""
+
+    conditions: tuple
+    options: tuple
+
+    @property
+    def batch(self):
+        """Returns the batch condition or None when there is none"""
+        for condition in self.conditions:
+            if condition.operator == "batch":
+                return condition
+        return None
+
+    @property
+    def key(self):
+        """Returns a hashable key that is equal for equivalent query strings"""
+        return self.conditions + self.options
+
+    def option(self, name, default=None):
+        """Returns the value of an option"""
+        return dict(self.options).get(name, default)
+
+
+######################################################################
+# Field kinds
+######################################################################
+def _equals(value):
+    return "eq", value
+
+
+def _batch(value):
+    return "batch", value
+
+
+def _text_operator(value):
+    """Picks exact, prefix or substring matching from the value's quoting"""
+    if len(value) > 1 and value.startswith('"') and value.endswith('"'):
+        return "exact", value[1:-1]
+    if value.endswith("*"):
+        return "prefix", value[:-1]
+    return "contains", value
+
+
+def _text_or_batch(value):
+    """Treats unquoted lists of values as a batch of keys"""
+    if "," in value and not value.startswith('"'):
+        return "batch", value
+    return _text_operator(value)
+
+
+def _boolean(value):
+    value = value.lower()
+    if value in ("true", "1"):
+        return True
+    if value in ("false", "0"):
+        return False
+    raise ValueError(value)
+
+
+def text(description, batch=False):
+    """A string field: "exact", prefix*, substring or __in, batch=True reads a,b as keys"""
+    default = _text_or_batch if batch else _text_operator
+    return Field(str, ("exact", "prefix", "contains", "in"), default, description)
+
+
+def number(description, convert=int, batch=False):
+    """A numeric field that takes ranges, batch=True reads a bare value as keys"""
+    return Field(convert, RANGE_OPERATORS, _batch if batch else _equals, description)
+
+
+def parse_timestamp(value):
+    """Parses an ISO 8601 timestamp into UTC, one without a time zone is UTC"""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def timestamp(description):
+    """An ISO 8601 timestamp field that takes ranges"""
+    return Field(parse_timestamp, RANGE_OPERATORS, _equals, description)
+
+
+def boolean(description):
+    """A true/false or 1/0 field"""
+    return Field(_boolean, ("eq",), _equals, description)
+
+
+def choice(enum, description):
+    """A field holding one of the members of an Enum, case insensitive"""
+    return Field(lambda value: enum[value.upper()], ("eq", "in"), _equals, description)
+
+
+######################################################################
+# Parser
+######################################################################
+class QueryParser:
+    """Parses query strings into filter conditions on a model"""
+
+    def __init__(self, fields, options=None):
+        self.fields = fields
+        self.options = options or {}
+        self._parameters = {}
+        for name, field in fields.items():
+            self._parameters[name] = (name, field, None)
+            for operator_name in field.operators:
+                self._parameters[name + SEPARATOR + operator_name] = (name, field, operator_name)
+
+    def parse(self, args, max_keys=None):
+        """
+        Parses the query string arguments
+
+        Args:
+            args (MultiDict): the request arguments
+            max_keys (int): the most values an in list or batch may hold
+
+        Returns:
+            ParsedQuery: the conditions and options
+
+        Raises:
+            DataValidationError: if a parameter has a bad value or operator
+        """
+        conditions = set()
+        options = {}
+        for name, value in args.items(multi=True):
+            if name in self.options:
+                options[name] = self._convert(name, self.options[name], value)
+                continue
+            parameter = self._parameters.get(name)
+            if parameter is None:
+                if name.split(SEPARATOR)[0] in self.fields:
+                    raise DataValidationError(f"Unknown filter operator: {name}")
+                continue
+            condition = self._condition(name, value, *parameter)
+            if max_keys and isinstance(condition.value, tuple) and len(condition.value) > max_keys:
+                raise DataValidationError(f"{name} takes at most {max_keys} values")
+            conditions.add(condition)
+        parsed = ParsedQuery(tuple(sorted(conditions, key=repr)), tuple(sorted(options.items())))
+        if sum(condition.operator == "batch" for condition in parsed.conditions) > 1:
+            raise DataValidationError("Only one batch of keys can be fetched at a time")
+        return parsed
+
+    def _condition(self, name, value, field_name, field, operator_name):
+        """Converts one parameter into a condition"""
+        if operator_name is None:
+            operator_name, value = field.default(value)
+        if operator_name in ("in", "batch"):
+            # unique values, batches keep their order and in lists are sorted
+            values = dict.fromkeys(self._convert(name, field.convert, item) for item in value.split(","))
+            if operator_name == "in":
+                values = sorted(values, key=repr)
+            return Condition(field_name, operator_name, tuple(values))
+        return Condition(field_name, operator_name, self._convert(name, field.convert, value))
+
+    @staticmethod
+    def _convert(name, convert, value):
+        """Converts a value, reporting bad values as validation errors"""
+        try:
+            return convert(value)
+        except (KeyError, ValueError) as error:
+            raise DataValidationError(f"Invalid {name} value: {value}") from error
+
+    @staticmethod
+    def criterion(model, condition):
+        """Returns the SQL criterion of a condition on the model"""
+        column = getattr(model, condition.field)
+        return OPERATORS[condition.operator](column, condition.value)
+
+    def doc(self):
+        """Returns the Swagger descriptions of the parameters"""
+        params = {name: field.description for name, field in self.fields.items()}
+        for name, convert in self.options.items():
+            params[name] = convert.__doc__.strip()
+        return params
@@ -0,0 +1,126 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Query Plan Capture
+
+Renders the SQL of a query and asks the database how it runs it, so a
+slow filter combination can be diagnosed from the request that was slow
+instead of rebuilding its SQL by hand.
+
+On Postgres the plan is the JSON of EXPLAIN, with ANALYZE and BUFFERS
+when the query may be run again to measure it. SQLite only has EXPLAIN
+QUERY PLAN, whose steps are returned as strings.
+"""
+import re
+import json
+from flask import current_app
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from service.models import db
+
+
+# A single-quoted SQL string, '' escapes a quote
+QUOTED = re.compile(r"'(?:[^']|'')*'")
+
+
+class Explain(Executable, ClauseElement):
+    """EXPLAIN of a statement, compiled for the database in use"""
+
+    inherit_cache = False
+
+    def __init__(self, statement, analyze=False):
+        self.statement = statement
+        self.analyze = analyze
+
+
+@compiles(Explain)
+def _compile_explain(element, compiler, **kwargs):
+    """Postgres explains as JSON, SQLite explains the query plan"""
+    if compiler.dialect.name == "postgresql":
+        options = "ANALYZE, BUFFERS, FORMAT JSON" if element.analyze else "FORMAT JSON"
+        prefix = f"EXPLAIN ({options}) "
+    else:
+        prefix = "EXPLAIN QUERY PLAN "
+    return prefix + compiler.process(element.statement, **kwargs)
+
+
+def display_dialect():
+    """
+    Returns the dialect of the database with named parameters
+
+    psycopg's pyformat parameters make the compiler double every % of the
+    SQL, which is then not the SQL that ran and cannot be pasted in psql.
+    """
+    return type(db.engine.dialect)(paramstyle="named")
+
+
+def render_sql(statement):
+    """Returns the SQL of a statement with its parameters filled in"""
+    dialect = display_dialect()
+    try:
+        return str(statement.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+    except (SQLAlchemyError, NotImplementedError):
+        # a type without a literal form, show the parameters next to the SQL
+        compiled = statement.compile(dialect=dialect)
+        return f"{compiled} -- {compiled.params!r}"
+
+
+def capture_plan(statement, analyze=False):
+    """
+    EXPLAINs a statement
+
+    Args:
+        statement: the SELECT to explain
+        analyze (bool): run the statement to measure it, on Postgres
+
+    Returns:
+        list: the JSON plan on Postgres, the steps of the plan on SQLite
+    """
+    rows = db.session.execute(Explain(statement, analyze)).all()
+    if db.engine.dialect.name == "postgresql":
+        plan = rows[0][0]
+        return json.loads(plan) if isinstance(plan, str) else plan
+    return [row[-1] for row in rows]
+
+
+def redact(text):
+    """Replaces the quoted values in SQL or a plan with ?"""
+    return QUOTED.sub("'?'", text)
+
+
+def log_if_slow(statement, seconds):
+    """
+    Logs the SQL and plan of a query that took longer than SLOW_QUERY_MS
+
+    The SQL keeps its :name placeholders and the quoted values of the plan are
+    redacted, so the customers' usernames, emails and hashes stay out of
+    the logs.
+    """
+    threshold = current_app.config["SLOW_QUERY_MS"]
+    elapsed = seconds * 1000
+    if not threshold or elapsed < threshold:
+        return
+    try:
+        # no ANALYZE, the query is not run a second time
+        plan = redact(json.dumps(capture_plan(statement)))
+    except SQLAlchemyError:
+        db.session.rollback()
+        plan = "unavailable"
+    current_app.logger.warning(
+        "Slow query (%.0f ms): %s plan: %s", elapsed, statement.compile(dialect=display_dialect()), plan
+    )
@@ -0,0 +1,198 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Rate Limiting
+
+This module implements per-client token-bucket rate limiting. Every
+client gets a bucket per route that refills at a steady rate up to a
+burst size, and requests that find the bucket empty are shed with a
+429 Too Many Requests and a Retry-After header.
+
+Buckets live in process memory by default. The shared backend keeps
+them in a memory-mapped file so that every gunicorn worker on a pod
+draws from the same buckets.
+"""
+import os
+import math
+import mmap
+import struct
+import hashlib
+import threading
+import time
+from flask import current_app, request
+from . import status
+
+try:  # fcntl is only available on POSIX systems
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+######################################################################
+# Token bucket math shared by all backends
+######################################################################
+def refill(tokens: float, updated: float, rate: float, burst: int, now: float):
+    """Returns the tokens in a bucket after refilling it up to now"""
+    return min(float(burst), tokens + max(0.0, now - updated) * rate)
+
+
+def take(tokens: float, rate: float):
+    """
+    Takes one token from a bucket
+
+    Returns:
+        tuple: the tokens left and the seconds to wait, 0 if a token was taken
+    """
+    if tokens >= 1.0:
+        return tokens - 1.0, 0.0
+    return tokens, (1.0 - tokens) / rate
+
+
+######################################################################
+# In-process backend
+######################################################################
+class MemoryBackend:
+    """Keeps the token buckets in a dictionary guarded by a lock"""
+
+    def __init__(self, max_keys: int = 10000):
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def consume(self, key: str, rate: float, burst: int, now: float) -> float:
+        """Takes a token from the bucket for key and returns the seconds to wait"""
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (float(burst), now))
+            tokens, wait = take(refill(tokens, updated, rate, burst, now), rate)
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._evict()
+        return wait
+
+    def _evict(self):
+        """Forgets the least recently used half of the buckets"""
+        by_age = sorted(self._buckets.items(), key=lambda item: item[1][1])
+        for key, _ in by_age[: len(by_age) // 2]:
+            del self._buckets[key]
+
+
+######################################################################
+# Shared memory backend
+######################################################################
+class SharedMemoryBackend:
+    """
+    Keeps the token buckets in fixed-size slots of a memory-mapped file
+
+    Keys are hashed into slots and each slot is guarded by its own byte
+    range lock, so processes only contend when they touch the same slot.
+    A key that collides with another one simply starts a fresh bucket.
+    """
+
+    SLOT = struct.Struct("<8sdd")  # key digest, tokens, updated
+
+    def __init__(self, path: str, slots: int = 4096):
+        if fcntl is None:  # pragma: no cover
+            raise RuntimeError("The shared rate limit backend requires fcntl")
+        self.slots = slots
+        size = slots * self.SLOT.size
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size != size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+
+    def consume(self, key: str, rate: float, burst: int, now: float) -> float:
+        """Takes a token from the bucket for key and returns the seconds to wait"""
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+        offset = int.from_bytes(digest, "little") % self.slots * self.SLOT.size
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self.SLOT.size, offset)
+        try:
+            owner, tokens, updated = self.SLOT.unpack_from(self._map, offset)
+            if owner != digest:
+                tokens, updated = float(burst), now
+            tokens, wait = take(refill(tokens, updated, rate, burst, now), rate)
+            self.SLOT.pack_into(self._map, offset, digest, tokens, now)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self.SLOT.size, offset)
+        return wait
+
+    def close(self):
+        """Releases the memory map"""
+        self._map.close()
+        os.close(self._fd)
+
+
+######################################################################
+# Request hook
+######################################################################
+def client_identity() -> str:
+    """
+    Identifies the client by its API key, or by its address
+
+    Behind RATE_LIMIT_PROXY_HOPS proxies the address is the entry of
+    X-Forwarded-For that the outermost proxy appended. The entries left
+    of it were sent by the client, who could rotate them for new buckets.
+    """
+    config = current_app.config
+    api_key = request.headers.get(config["RATE_LIMIT_KEY_HEADER"])
+    if api_key:
+        return "key:" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+    hops = config["RATE_LIMIT_PROXY_HOPS"]
+    if hops and "X-Forwarded-For" in request.headers and len(request.access_route) >= hops:
+        return "ip:" + request.access_route[-hops]
+    return f"ip:{request.remote_addr}"
+
+
+def limit_request():
+    """Sheds the request when the client has used up its budget for the route"""
+    config = current_app.config
+    if not config["RATE_LIMIT_ENABLED"] or request.endpoint is None:
+        return None
+    budget = config["RATE_LIMITS"].get(request.endpoint, config["RATE_LIMIT_DEFAULT"])
+    if budget is None:
+        return None
+
+    rate, burst = budget
+    key = f"{request.endpoint}|{client_identity()}"
+    backend = current_app.extensions["rate_limit"]
+    wait = backend.consume(key, rate, burst, time.time())
+    if not wait:
+        return None
+
+    current_app.logger.warning("Rate limit exceeded for %s", key)
+    message = f"Rate limit exceeded, retry in {math.ceil(wait)} seconds"
+    return (
+        {
+            "status_code": status.HTTP_429_TOO_MANY_REQUESTS,
+            "error": "Too Many Requests",
+            "message": message,
+        },
+        status.HTTP_429_TOO_MANY_REQUESTS,
+        {"Retry-After": str(math.ceil(wait))},
+    )
+
+
+def init_rate_limiting(app):
+    """Creates the rate limit backend and registers the request hook"""
+    if app.config["RATE_LIMIT_BACKEND"] == "shared":
+        backend = SharedMemoryBackend(
+            app.config["RATE_LIMIT_SHARED_PATH"], app.config["RATE_LIMIT_SHARED_SLOTS"]
+        )
+    else:
+        backend = MemoryBackend(app.config["RATE_LIMIT_MAX_KEYS"])
+    app.extensions["rate_limit"] = backend
+    app.before_request(limit_request)
+    app.logger.info("Rate limiting established (%s)", type(backend).__name__)
@@ -0,0 +1,191 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Request Timing
+
+Gives every request an id, taken from its X-Request-ID header when the
+caller sent a usable one, and returns it in the response so a slow call
+can be found in the logs of every service it went through.
+
+A sample of the requests, REQUEST_TIMING_SAMPLE_RATE of them (none by
+default, the header tells every caller how the service spends its time),
+also has its phases timed and reported in a Server-Timing header:
+
+    parse      decoding the JSON body and the query string
+    db         executing SQL, summed from the cursor events
+    serialize  turning Customers into dictionaries
+    marshal    applying the response models of TimedApi.marshal_with
+    render     encoding the response body as JSON
+    total      from the first before_request hook to the response
+
+Requests that are not sampled skip the phase timers, so only the id and
+the database time (which the request log line always holds) are kept.
+"""
+import re
+import time
+import uuid
+import random
+from functools import wraps
+from contextlib import contextmanager
+from flask import current_app, g, has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+from flask_restx import Api
+from flask_restx.representations import output_json
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+HEADER = "X-Request-ID"
+SERVER_TIMING_HEADER = "Server-Timing"
+REQUEST_ID = re.compile(r"[A-Za-z0-9._:-]{1,128}")
+
+
+@contextmanager
+def phase(name):
+    """Adds the time spent in the block to a phase of a sampled request"""
+    timings = g.get("timings") if has_request_context() else None
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - started
+
+
+def summary():
+    """
+    Returns the phases of the request in milliseconds
+
+    Returns:
+        dict: the timed phases and the total, or None when the request
+        was not sampled
+    """
+    timings = g.get("timings")
+    if timings is None:
+        return None
+    result = {name: round(seconds * 1000, 2) for name, seconds in timings.items()}
+    result["db"] = round(g.get("db_time", 0.0) * 1000, 2)
+    result["total"] = round((time.perf_counter() - g.request_started) * 1000, 2)
+    return result
+
+
+######################################################################
+# Hooks
+######################################################################
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query(_conn, _cursor, _statement, _parameters, context, _executemany):
+    context.query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _end_query(_conn, _cursor, _statement, _parameters, context, _executemany):
+    if has_request_context():
+        g.db_time = g.get("db_time", 0.0) + time.perf_counter() - context.query_started
+
+
+def start_request():
+    """Gives the request an id, starts its clock and decides if it is sampled"""
+    request_id = request.headers.get(HEADER, "")
+    g.request_id = request_id if REQUEST_ID.fullmatch(request_id) else uuid.uuid4().hex
+    g.request_started = time.perf_counter()
+    g.db_time = 0.0
+    rate = current_app.config["REQUEST_TIMING_SAMPLE_RATE"]
+    g.timings = {} if rate and random.random() < rate else None
+
+
+def finish_request(response):
+    """Returns the request id and the Server-Timing of sampled requests"""
+    if "request_id" not in g:
+        return response
+    response.headers[HEADER] = g.request_id
+    timings = summary()
+    if timings is not None:
+        response.headers[SERVER_TIMING_HEADER] = ", ".join(
+            f"{name};dur={duration}" for name, duration in timings.items()
+        )
+    return response
+
+
+######################################################################
+# Timed JSON parsing, marshalling and rendering
+######################################################################
+class TimedJSONProvider(DefaultJSONProvider):
+    """Times the decoding of JSON request bodies"""
+
+    def loads(self, s, **kwargs):
+        with phase("parse"):
+            return super().loads(s, **kwargs)
+
+
+def timed_marshalling(decorator):
+    """
+    Times the marshalling of a marshal_with decorator of flask-restx
+
+    The marshalling is the time from the return of the resource method
+    to the return of the decorated one.
+    """
+
+    def wrapper(func):
+        @wraps(func)
+        def handled(*args, **kwargs):
+            result = func(*args, **kwargs)
+            g.handled = time.perf_counter()
+            return result
+
+        marshalled = decorator(handled)
+
+        @wraps(marshalled)
+        def timed(*args, **kwargs):
+            result = marshalled(*args, **kwargs)
+            timings = g.get("timings")
+            if timings is not None:
+                timings["marshal"] = timings.get("marshal", 0.0) + time.perf_counter() - g.pop("handled")
+            return result
+
+        return timed
+
+    return wrapper
+
+
+class TimedApi(Api):
+    """An Api whose marshal_with and marshal_list_with time the marshalling"""
+
+    def marshal_with(self, fields, *args, **kwargs):
+        """Documents and marshals the response like Namespace.marshal_with, timed"""
+        return timed_marshalling(self.default_namespace.marshal_with(fields, *args, **kwargs))
+
+    def marshal_list_with(self, fields, **kwargs):
+        """A marshal_with of a list of fields"""
+        return self.marshal_with(fields, True, **kwargs)
+
+
+def timed_output_json(data, code, headers=None):
+    """Renders a JSON response, timing the encoding"""
+    with phase("render"):
+        return output_json(data, code, headers)
+
+
+def init_request_timing(app, api):
+    """Registers the request id and timing hooks"""
+    app.json = TimedJSONProvider(app)
+    api.representations["application/json"] = timed_output_json
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.logger.info(
+        "Request timing established (%s%% sampled)", app.config["REQUEST_TIMING_SAMPLE_RATE"] * 100
+    )
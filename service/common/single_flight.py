@@ -0,0 +1,98 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Single Flight
+
+This module coalesces identical concurrent calls. The first caller for a
+key runs the function while the callers that arrive before it finishes
+wait for it and share its result (or a copy of its exception).
+
+A write starts a new generation of calls: a read that arrives after a
+write finished never joins a call that started before it, so a client
+reads its own writes.
+
+Results are handed to several threads, so functions should return plain
+data such as serialized dictionaries rather than ORM instances that are
+bound to the leader's database session.
+"""
+import copy
+import threading
+
+
+class _Call:  # pylint: disable=too-few-public-methods
+    """A call in flight"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.shared = 0
+        self.generation = 0
+
+    def invalidate(self, *args):
+        """Starts a new generation of calls, a write listener"""
+        # pylint: disable=unused-argument
+        with self._lock:
+            self.generation += 1
+
+    def do(self, key, function):
+        """
+        Runs the function, or waits for the identical call already in flight
+
+        Args:
+            key (hashable): identifies identical calls
+            function (callable): computes the result when no call is in flight
+
+        Returns:
+            the result of the function
+        """
+        with self._lock:
+            self.calls += 1
+            key = (self.generation, key)
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                # the leader's exception and its traceback stay with the leader
+                raise copy.copy(call.error) from call.error
+            return call.result
+
+        try:
+            call.result = function()
+        except Exception as error:  # pylint: disable=broad-except
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
@@ -0,0 +1,115 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Statement Cache
+
+Every statement SQLAlchemy runs is first turned into SQL. It keeps the
+SQL it compiled in a cache of SQL_COMPILED_CACHE_SIZE statements keyed
+by their structure, so a statement only compiles the first time its
+shape is seen, but the statement still has to be built and its cache
+key computed on every call. The hot queries of the models (find,
+find_many, create, update and patch) are built once with bind parameters
+by models.cached_statement, which leaves only binding the values.
+
+On Postgres psycopg also prepares a statement on the server once it ran
+SQL_PREPARE_THRESHOLD times on a connection, keeping the last
+SQL_PREPARED_MAX of them, so the server stops parsing and planning it.
+
+This module counts how often the executed statements were found in the
+compiled cache, for /customers:statements and the benchmark of
+flask db-statement-benchmark.
+"""
+import time
+import threading
+from sqlalchemy import event
+from sqlalchemy.engine.default import CACHE_HIT, CACHE_MISS
+from service.models import db, statements
+
+
+class StatementStats:
+    """Counts the executions that hit and missed the compiled cache"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.uncached = 0
+        self._lock = threading.Lock()
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        """Counts an execution, an after_cursor_execute listener"""
+        # pylint: disable=unused-argument, too-many-arguments
+        cache_hit = getattr(context, "cache_hit", None)
+        with self._lock:
+            if cache_hit is CACHE_HIT:
+                self.hits += 1
+            elif cache_hit is CACHE_MISS:
+                self.misses += 1
+            else:  # driver SQL and statements that cannot be cached
+                self.uncached += 1
+
+    def stats(self, engine, config):
+        """Returns the counts with the state of the compiled cache"""
+        compiled = engine._compiled_cache  # pylint: disable=protected-access
+        with self._lock:
+            executions = self.hits + self.misses + self.uncached
+            counts = {"executions": executions, "hits": self.hits, "misses": self.misses, "uncached": self.uncached}
+        cached = counts["hits"] + counts["misses"]
+        counts.update(
+            {
+                "hit_rate": round(counts["hits"] / cached, 4) if cached else 0.0,
+                "compiled": len(compiled) if compiled is not None else 0,
+                "compiled_capacity": compiled.capacity if compiled is not None else 0,
+                "prebuilt": len(statements),
+                "prepared": engine.dialect.name == "postgresql" and config["SQL_PREPARE_THRESHOLD"] is not None,
+            }
+        )
+        return counts
+
+
+def measure(call, repeat):
+    """
+    Runs call repeat times
+
+    Returns:
+        tuple: the wall and CPU time of a call in microseconds
+    """
+    wall, cpu = time.perf_counter(), time.process_time()
+    for _ in range(repeat):
+        call()
+    return (time.perf_counter() - wall) * 1e6 / repeat, (time.process_time() - cpu) * 1e6 / repeat
+
+
+def _limit_prepared(prepared_max, dbapi_connection, connection_record):
+    """Sets how many prepared statements a psycopg connection keeps, a connect listener"""
+    # pylint: disable=unused-argument
+    if hasattr(dbapi_connection, "prepared_max"):
+        dbapi_connection.prepared_max = prepared_max
+
+
+def init_statement_cache(app):
+    """Counts the compiled cache hits and limits the prepared statements"""
+    prepared_max = app.config["SQL_PREPARED_MAX"]
+    event.listen(db.engine, "connect", lambda *args: _limit_prepared(prepared_max, *args))
+    statement_stats = StatementStats()
+    event.listen(db.engine, "after_cursor_execute", statement_stats.record)
+    app.extensions["statement_cache"] = statement_stats
+    app.logger.info("Statement cache statistics established")
+
+
+def stats(app):
+    """Returns the statistics of the statement cache"""
+    return app.extensions["statement_cache"].stats(db.engine, app.config)
@@ -0,0 +1,182 @@
+######################################################################
+# Copyright 2016, 2024 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+######################################################################
+
+"""
+Typo-tolerant Index
+
+A SymSpell style deletion dictionary over usernames and last names. Every
+distinct lowercased value is stored under each string that can be made
+from it by deleting up to max_distance characters. Two values within that
+edit distance of each other always share one of those strings, so a
+lookup only generates the deletions of the search term, collects the
+values stored under them and checks their real distance. The work depends
+on the length of the term, not on the number of customers.
+
+Values repeat a lot (think of how many Smiths there are), so the
+deletions are stored once per distinct value and the values map to the
+customers that have them.
+"""
+import sys
+from flask import current_app
+from service.common.inverted_index import StreamedIndex, maintain_index
+
+DEFAULT_FIELDS = ("username", "last_name")
+
+
+def deletions(value, max_distance):
+    """Returns the strings made by deleting up to max_distance characters"""
+    found = {value}
+    edge = {value}
+    for _ in range(max_distance):
+        edge = {
+            term[:i] + term[i + 1:]
+            for term in edge
+            for i in range(len(term))
+        } - found
+        found |= edge
+    return found
+
+
+def distance(source, target, limit):
+    """
+    Returns the optimal string alignment distance between two strings
+
+    This is the Levenshtein distance that also counts swapping two
+    adjacent characters as one edit. It stops early and returns limit + 1
+    as soon as the distance is known to be over the limit.
+    """
+    if abs(len(source) - len(target)) > limit:
+        return limit + 1
+    previous = None
+    current = list(range(len(target) + 1))
+    for i, char in enumerate(source, 1):
+        before, previous, current = previous, current, [i] + [0] * len(target)
+        for j, other in enumerate(target, 1):
+            cost = 0 if char == other else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if j > 1 and i > 1 and char == target[j - 2] and source[i - 2] == other:
+                current[j] = min(current[j], before[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+    return current[-1]
+
+
+class TypoIndex(StreamedIndex):
+    """A deletion dictionary from misspelled values to customer ids"""
+
+    def __init__(self, fields=DEFAULT_FIELDS, max_distance=2):
+        super().__init__(fields)
+        self.max_distance = max_distance
+        self._values = {}
+        self._deletions = {}
+
+    def _empty(self):
+        return TypoIndex(self.fields, self.max_distance)
+
+    def _swap(self, fresh):
+        super()._swap(fresh)
+        self._values = fresh._values
+        self._deletions = fresh._deletions
+
+    def _index(self, customer_id, document):
+        for field, value in document.items():
+            if not value:
+                continue
+            value = value.lower()
+            customers = self._values.get((field, value))
+            if customers is None:
+                customers = self._values[(field, value)] = set()
+                for deletion in deletions(value, self.max_distance):
+                    self._deletions.setdefault((field, deletion), set()).add(value)
+            customers.add(customer_id)
+
+    def _unindex(self, customer_id, document):
+        for field, value in document.items():
+            if not value:
+                continue
+            value = value.lower()
+            customers = self._values[(field, value)]
+            customers.discard(customer_id)
+            if customers:
+                continue
+            del self._values[(field, value)]
+            for deletion in deletions(value, self.max_distance):
+                values = self._deletions[(field, deletion)]
+                values.discard(value)
+                if not values:
+                    del self._deletions[(field, deletion)]
+
+    def lookup(self, field, value, max_distance):
+        """
+        Returns the customers whose field is within max_distance edits of value
+
+        Returns:
+            dict: the distance of each matching customer id
+        """
+        if max_distance > self.max_distance:
+            raise ValueError(f"The index only holds distances up to {self.max_distance}")
+        value = (value or "").lower()
+        matches = {}
+        with self._lock:
+            seen = set()
+            for deletion in deletions(value, max_distance):
+                for term in self._deletions.get((field, deletion), ()):
+                    if term in seen:
+                        continue
+                    seen.add(term)
+                    edits = distance(value, term, max_distance)
+                    if edits <= max_distance:
+                        for customer_id in self._values[(field, term)]:
+                            matches[customer_id] = edits
+        return matches
+
+    def stats(self):
+        """Returns the size of the index and an estimate of its memory use"""
+        with self._lock:
+            size = sys.getsizeof(self._values) + sys.getsizeof(self._deletions)
+            size += sys.getsizeof(self._documents)
+            for (_, value), customers in self._values.items():
+                size += sys.getsizeof(value) + sys.getsizeof(customers)
+            for (_, deletion), values in self._deletions.items():
+                size += sys.getsizeof(deletion) + sys.getsizeof(values)
+            for document in self._documents.values():
+                size += sys.getsizeof(document)
+            return {
+                "customers": len(self._documents),
+                "values": len(self._values),
+                "deletions": len(self._deletions),
+                "bytes": size,
+            }
+
+
+######################################################################
+# Flask integration
+######################################################################
+def init_typo_index(app):
+    """Builds the typo index and keeps it up to date"""
+    if not app.config["TYPO_INDEX_ENABLED"]:
+        return
+    index = TypoIndex(max_distance=app.config["TYPO_INDEX_MAX_DISTANCE"])
+    maintain_index(app, "typo_index", index, app.config["TYPO_INDEX_REFRESH"])
+
+
+def find_typos(field, value, max_distance):
+    """
+    Returns the distance of each customer whose field is close to the value
+
+    The fuzzy_distance filter is only accepted when the app has a typo index.
+    """
+    return current_app.extensions["typo_index"].lookup(field, value, max_distance)
@@ -5,18 +5,18 @@ All of the models are stored in this module
 """
 
 import logging
+from datetime import datetime, timezone
 from enum import Enum
-import hashlib
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from service.common.passwords import hash_password, is_hashed
 
 logger = logging.getLogger("flask.app")
 
 
-def encrypt_password(password):
-    """Hashing Passwords"""
-    return hashlib.sha256(password.encode("UTF-8")).hexdigest()
-
-
 # Create the SQLAlchemy object to be initialized later in init_db()
 db = SQLAlchemy()
 
@@ -33,7 +33,103 @@ class DataValidationError(Exception):
     """Used for an data validation errors when deserializing"""
 
 
-# pylint: disable=too-many-instance-attributes
+def utcnow():
+    """Returns the current time in UTC"""
+    return datetime.now(timezone.utc)
+
+
+def as_utc(value):
+    """Returns a timestamp in UTC, SQLite returns them without a time zone"""
+    if value is None or value.tzinfo is not None:
+        return value
+    return value.replace(tzinfo=timezone.utc)
+
+
+######################################################################
+# Write listeners
+######################################################################
+write_listeners = []
+
+
+def add_write_listener(listener):
+    """
+    Calls listener(action, data) after every committed write of a Customer
+
+    The action is one of create, update, activate, deactivate or delete and
+    data is the serialized Customer, or just its id for a delete.
+    """
+    write_listeners.append(listener)
+
+
+def remove_write_listener(listener):
+    """Stops calling a write listener"""
+    write_listeners.remove(listener)
+
+
+def notify_write(action, data):
+    """Calls the write listeners, a failing listener does not fail the write"""
+    for listener in list(write_listeners):
+        try:
+            listener(action, data)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Write listener %r failed for %s", listener, action)
+
+
+# The Postgres NOTIFY channel and origin that the Customer writes
+# announce themselves with, see announce_writes
+write_announcement = []
+
+
+def announce_writes(channel, origin):
+    """
+    Makes every Customer write on Postgres NOTIFY channel of itself with
+
+        {"origin": origin, "action": "update", "id": 7}
+
+    The write statements return the pg_notify(), so it takes no extra round
+    trip and is sent when, and only when, the write's transaction commits.
+    """
+    write_announcement[:] = [channel, origin] if channel else []
+
+
+def announcement(customer_id, action=None):
+    """Returns the pg_notify() column of a write, or None, the action is bound as write_action"""
+    if not write_announcement or db.session.get_bind().dialect.name != "postgresql":
+        return None
+    channel, origin = (db.literal(value, db.String) for value in write_announcement)
+    payload = db.func.json_build_object(
+        "origin", origin,
+        "action", db.bindparam("write_action", action, type_=db.String),
+        "id", customer_id,
+    )
+    return db.func.pg_notify(channel, db.cast(payload, db.Text)).label("announced")
+
+
+# Statements that are built once per shape and database, with bind
+# parameters in place of the values, see cached_statement
+statements = {}
+
+
+def cached_statement(key, build):
+    """
+    Returns a statement that is built once per key and database
+
+    The statement holds bind parameters instead of values, so executing
+    it again skips building it and computing its cache key, and finds
+    its compiled form in the engine's cache.
+
+    Args:
+        key (tuple): the name and shape of the statement
+        build (callable): builds the statement
+    """
+    key = (db.session.get_bind().dialect.name,) + key
+    statement = statements.get(key)
+    if statement is None:
+        statement = statements.setdefault(key, build())
+    return statement
+
+
+# pylint: disable=too-many-instance-attributes, too-many-public-methods
 
 
 class Customer(db.Model):
@@ -55,6 +151,40 @@ class Customer(db.Model):
     active = db.Column(db.Boolean(), nullable=False, default=False)
     address = db.Column(db.String(255), nullable=False)
     email = db.Column(db.String(255), nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False, default=utcnow)
+    updated_at = db.Column(db.DateTime(timezone=True), nullable=False, default=utcnow, onupdate=utcnow)
+
+    # lower(column) text_pattern_ops indexes serve the prefix (abc*) filters,
+    # the others the gender and active filters that the lists combine them with
+    __table_args__ = tuple(
+        db.Index(
+            f"ix_customer_{name}_prefix",
+            db.func.lower(column).label(f"{name}_lower"),
+            postgresql_ops={f"{name}_lower": "text_pattern_ops"},
+        )
+        for name, column in (("username", username), ("email", email), ("last_name", last_name))
+    ) + (
+        # the exact lookups and the uniqueness checks of every write
+        db.Index("ix_customer_username", username),
+        db.Index("ix_customer_email", email),
+        db.Index("ix_customer_gender_active", gender, active),
+        # most lists ask for active customers, so only they are indexed by name
+        db.Index(
+            "ix_customer_active_gender_last_name",
+            gender,
+            db.func.lower(last_name).label("last_name_lower"),
+            postgresql_ops={"last_name_lower": "text_pattern_ops"},
+            postgresql_where=active,
+            sqlite_where=active,
+        ),
+        # the change feed reads in (updated_at, id) order
+        db.Index("ix_customer_updated_at_id", updated_at, id),
+        # SQLite would reuse the id of the last row, which may have a tombstone
+        {"sqlite_autoincrement": True},
+    )
+
+    # Columns that hold free text
+    TEXT_FIELDS = ("username", "password", "first_name", "last_name", "address", "email")
 
     def __repr__(self):
         return f"<Customer {self.first_name, self.last_name} id=[{self.id}]>"
@@ -62,65 +192,223 @@ class Customer(db.Model):
     def create(self):
         """
         Creates a Customer to the database
-        """
-
-        # id is checked by database itself
-        if Customer.query.filter_by(username=self.username).first():
-            raise DataValidationError(f"Username {self.username} is already in use.")
-        if Customer.query.filter_by(email=self.email).first():
-            raise DataValidationError(f"Email {self.email} is already in use.")
 
+        The row is inserted with a single INSERT ... SELECT ... RETURNING
+        statement that only inserts it when no other account has the same
+        username or email. The returned values are kept loaded so that
+        serializing the Customer afterwards does not reload it.
+        """
         logger.info("Creating %s", self.first_name)
         self.id = None  # pylint: disable=invalid-name
-        self.password = encrypt_password(self.password)
+        self.password = hash_password(self.password)
+        self.created_at = self.updated_at = utcnow()
+        values = self._values()
+        statement = cached_statement(("create", *write_announcement), Customer._insert_statement)
         try:
-            db.session.add(self)
+            with db.session.no_autoflush:
+                row = db.session.execute(statement, dict(values, write_action="create")).one_or_none()
+            if row is not None:
+                self.id = row.id
+                make_transient_to_detached(self)
+                db.session.add(self)
             db.session.commit()
         except Exception as e:
             db.session.rollback()
             logger.error("Error creating record: %s", self)
             raise DataValidationError(e) from e
 
-    def update(self, original_password=None):
+        if row is None:
+            Customer._check_unique(
+                None,
+                values,
+                f"Username {self.username} is already in use.",
+                f"Email {self.email} is already in use.",
+            )
+            raise DataValidationError(f"Customer {self.username} was not created.")
+        self._load(row)
+        notify_write("create", self.serialize())
+
+    def update(self, original_password=None, keep_hashed_password=False):
         """
         Updates a Customer to the database
-        """
-        existing_user = Customer.query.filter(
-            (Customer.username == self.username) | (Customer.email == self.email),
-            Customer.id != self.id,
-        ).first()
 
-        if existing_user:
-            if existing_user.username == self.username:
-                raise DataValidationError(
-                    "Username already exists with another account"
-                )
-            if existing_user.email == self.email:
-                raise DataValidationError("Email already exists with another account")
+        The row is updated with a single UPDATE ... RETURNING statement that
+        only matches when no other account has the same username or email.
+        The returned values are kept loaded so that serializing the Customer
+        afterwards does not reload it.
 
+        Args:
+            original_password (str): the stored hash, the password is hashed
+                again when it has changed
+            keep_hashed_password (bool): hash the password unless it is the
+                stored hash, without having to read the stored hash first
+
+        Returns:
+            Customer: this Customer, or None if it does not exist
+        """
         logger.info("Saving %s", self.first_name)
         if self.id is None:
             raise DataValidationError("There is no valid ID Specified")
         # if PWD changed, hash again
         if original_password is not None and not original_password == self.password:
-            self.password = encrypt_password(self.password)
+            self.password = hash_password(self.password)
+        values = self._values()
+        # the creation time is never written again, the update time is
+        # stamped by _update_row
+        del values["created_at"]
         try:
+            with db.session.no_autoflush:
+                if keep_hashed_password:
+                    row = self._update_keeping_hash(values)
+                else:
+                    row = self._execute_update(values)
+            # the UPDATE wrote the changes, so the commit must neither flush
+            # them again nor expire the values it returned
+            if self in db.session:
+                db.session.expunge(self)
             db.session.commit()
         except Exception as e:
             db.session.rollback()
             logger.error("Error updating record: %s", self)
             raise DataValidationError(e) from e
 
+        if row is None:
+            Customer._check_unique(
+                self.id,
+                values,
+                "Username already exists with another account",
+                "Email already exists with another account",
+            )
+            return None
+        self._load(row)
+        notify_write("update", self.serialize())
+        return self
+
+    @staticmethod
+    def _typed_parameter(column):
+        """
+        Returns a bind parameter with the type of a column
+
+        SQLite has no timestamp type and CASTs them to numbers, so they are
+        not CAST there.
+        """
+        parameter = db.bindparam(column.name, type_=column.type)
+        if isinstance(column.type, db.DateTime) and db.session.get_bind().dialect.name == "sqlite":
+            return parameter
+        return db.cast(parameter, column.type)
+
+    @staticmethod
+    def _insert_statement():
+        """
+        INSERT ... SELECT ... RETURNING of a Customer that only inserts it
+        when no other account has the same username or email
+        """
+        table = Customer.__table__
+        columns = [column for column in table.c if column.name != "id"]
+        values = {column.name: db.bindparam(column.name) for column in columns}
+        return (
+            db.insert(table)
+            .from_select(
+                columns,
+                db.select(*[Customer._typed_parameter(column) for column in columns]).where(
+                    Customer._unique_clause(None, values)
+                ),
+            )
+            .returning(*Customer._returned(table))
+        )
+
+    @staticmethod
+    def _returned(table):
+        """Returns the columns a write returns, with its announcement if any"""
+        notify = announcement(table.c.id)
+        return list(table.c) if notify is None else [*table.c, notify]
+
+    @staticmethod
+    def _update_statement(names, check_password):
+        """
+        UPDATE ... RETURNING of a Customer's columns that only matches when
+        no other account has the new username or email
+
+        The new values are bound as set_<column>, the id as customer_id and,
+        with check_password, the stored password hash as stored_password.
+
+        Args:
+            names (tuple): the columns to set
+            check_password (bool): only update the row if it holds stored_password
+        """
+        table = Customer.__table__
+        customer_id = db.bindparam("customer_id")
+        values = {name: db.bindparam(f"set_{name}", type_=table.c[name].type) for name in names}
+        criteria = [table.c.id == customer_id, Customer._unique_clause(customer_id, values)]
+        if check_password:
+            criteria.append(table.c.password == db.bindparam("stored_password"))
+        return db.update(table).where(*criteria).values(values).returning(*Customer._returned(table))
+
+    def _update_keeping_hash(self, values):
+        """Updates this Customer's row, hashing the password unless it is the stored hash"""
+        if is_hashed(self.password):
+            # most likely the stored hash sent back, which needs no hashing
+            row = self._execute_update(values, stored_password=self.password)
+            if row is not None:
+                return row
+        values["password"] = hash_password(self.password)
+        return self._execute_update(values)
+
+    def _execute_update(self, values, stored_password=None):
+        """Runs an UPDATE ... RETURNING of this Customer's row"""
+        return Customer._update_row(self.id, values, stored_password)
+
+    @staticmethod
+    def _update_row(customer_id, values, stored_password=None, action="update"):
+        """
+        Runs an UPDATE ... RETURNING of a Customer's row with a cached statement
+
+        The update time is stamped here, after the password was hashed, so
+        that a slow hash cannot commit a time that the change feed has
+        already moved past.
+        """
+        values["updated_at"] = utcnow()
+        names = tuple(sorted(values))
+        check_password = stored_password is not None
+        statement = cached_statement(
+            ("update", names, check_password, *write_announcement),
+            lambda: Customer._update_statement(names, check_password),
+        )
+        parameters = {f"set_{name}": value for name, value in values.items()}
+        parameters["customer_id"] = customer_id
+        parameters["write_action"] = action
+        if check_password:
+            parameters["stored_password"] = stored_password
+        return db.session.execute(statement, parameters).one_or_none()
+
+    def _values(self):
+        """Returns the column values of this Customer, except the id"""
+        return {
+            column.name: getattr(self, column.name)
+            for column in Customer.__table__.c
+            if column.name != "id"
+        }
+
+    def _load(self, row):
+        """Loads the values of a returned row as the committed state"""
+        for column in Customer.__table__.c:
+            set_committed_value(self, column.name, row._mapping[column.name])
+
     def delete(self):
         """Removes a Customer from the data store"""
         logger.info("Deleting %s", self.first_name)
         try:
             db.session.delete(self)
+            db.session.add(CustomerTombstone(id=self.id, deleted_at=utcnow()))
+            notify = announcement(self.id, "delete")
+            if notify is not None:
+                db.session.execute(db.select(notify))
             db.session.commit()
         except Exception as e:
             db.session.rollback()
             logger.error("Error deleting record: %s", self)
             raise DataValidationError(e) from e
+        notify_write("delete", {"id": self.id})
 
     def serialize(self):
         """Serializes a Customer into a dictionary"""
@@ -134,6 +422,8 @@ class Customer(db.Model):
             "active": self.active,
             "address": self.address,
             "email": self.email,
+            "created_at": _isoformat(self.created_at),
+            "updated_at": _isoformat(self.updated_at),
         }
 
     def deserialize(self, data):
@@ -171,6 +461,168 @@ class Customer(db.Model):
             ) from error
         return self
 
+    @classmethod
+    def deserialize_changes(cls, data):
+        """
+        Validates a partial Customer document
+
+        Args:
+            data (dict): A dictionary containing some of the resource data
+
+        Returns:
+            dict: the column values to change
+        """
+        if not isinstance(data, dict):
+            raise DataValidationError(
+                "Invalid Customer: body of request contained bad or no data"
+            )
+        changes = {}
+        for name, value in data.items():
+            if name == "id":
+                continue
+            if name == "gender":
+                if not isinstance(value, str) or value not in Gender.__members__:
+                    raise DataValidationError(f"Invalid attribute: {value}")
+                changes[name] = Gender[value]
+            elif name == "active":
+                if not isinstance(value, bool):
+                    raise DataValidationError("Invalid type for active Boolean")
+                changes[name] = value
+            elif name in cls.TEXT_FIELDS:
+                if not isinstance(value, str):
+                    raise DataValidationError(f"Invalid type for {name} String")
+                changes[name] = value
+            else:
+                raise DataValidationError(f"Invalid Customer: unknown field {name}")
+        return changes
+
+    @classmethod
+    def patch(cls, customer_id, changes, action="update"):
+        """
+        Applies a partial update with a single UPDATE ... RETURNING statement
+
+        The uniqueness of the username and email is checked in the same
+        statement, the conflicting row is only looked up when it fails.
+
+        Args:
+            customer_id (int): the id of the Customer to update
+            changes (dict): the validated column values to change
+            action (str): the action reported to the write listeners
+
+        Returns:
+            Customer: the updated Customer, or None if it does not exist
+        """
+        logger.info("Patching id %s with %s", customer_id, sorted(changes))
+        if not changes:
+            return cls.find(customer_id)
+        values = dict(changes)
+        if "password" in values:
+            values["password"] = hash_password(values["password"])
+
+        customer = None
+        try:
+            row = cls._update_row(customer_id, values, action=action)
+            if row is not None:
+                # a Customer outside the session keeps the returned values
+                customer = cls()
+                customer._load(row)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error patching record: %s", customer_id)
+            raise DataValidationError(e) from e
+
+        if customer is None:
+            cls._check_unique(
+                customer_id,
+                values,
+                "Username already exists with another account",
+                "Email already exists with another account",
+            )
+        else:
+            notify_write(action, customer.serialize())
+        return customer
+
+    @classmethod
+    def set_active(cls, customer_id, active):
+        """
+        Activates or deactivates a Customer with a single UPDATE ... RETURNING
+
+        Returns:
+            Customer: the updated Customer, or None if it does not exist
+        """
+        action = "activate" if active else "deactivate"
+        return cls.patch(customer_id, {"active": active}, action)
+
+    @classmethod
+    def delete_by_id(cls, customer_id):
+        """
+        Removes a Customer and leaves a tombstone for the change feed
+
+        Postgres does both in a single statement, a DELETE ... RETURNING in
+        a WITH clause that the tombstone is inserted from. Other databases
+        insert the tombstone with a second statement in the same transaction.
+
+        Returns:
+            bool: True if the Customer existed
+        """
+        logger.info("Deleting id %s", customer_id)
+        now = utcnow()
+        statement = db.delete(cls).where(cls.id == customer_id).returning(cls.id)
+        try:
+            if db.session.get_bind().dialect.name == "postgresql":
+                notify = announcement(CustomerTombstone.id, "delete")
+                deleted = db.session.execute(CustomerTombstone.insert_from(statement, now, notify)).scalar_one_or_none()
+                # the WITH statement is not an ORM delete, so the session does
+                # not know the Customer it may hold is gone
+                loaded = db.session.identity_map.get(db.session.identity_key(cls, customer_id))
+                if loaded is not None:
+                    db.session.expunge(loaded)
+            else:
+                deleted = db.session.execute(statement).scalar_one_or_none()
+                if deleted is not None:
+                    db.session.add(CustomerTombstone(id=deleted, deleted_at=now))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error("Error deleting record: %s", customer_id)
+            raise DataValidationError(e) from e
+        if deleted is None:
+            return False
+        notify_write("delete", {"id": customer_id})
+        return True
+
+    @classmethod
+    def _unique_clause(cls, customer_id, values):
+        """Matches when no other account has the username or email in values"""
+        other = db.aliased(cls)
+        matches = [
+            getattr(other, name) == values[name]
+            for name in ("username", "email")
+            if name in values
+        ]
+        if not matches:
+            return db.true()
+        others = db.exists().where(db.or_(*matches))
+        if customer_id is not None:
+            others = others.where(other.id != customer_id)
+        return ~others
+
+    @classmethod
+    def _check_unique(cls, customer_id, values, username_message, email_message):
+        """Raises a DataValidationError if another account has the username or email"""
+        if "username" not in values and "email" not in values:
+            return
+        with db.session.no_autoflush:
+            existing_user = cls.query.filter(
+                (cls.username == values.get("username")) | (cls.email == values.get("email")),
+                cls.id != customer_id,
+            ).first()
+        if existing_user:
+            if existing_user.username == values.get("username"):
+                raise DataValidationError(username_message)
+            raise DataValidationError(email_message)
+
     def activate(self):
         """Activates the customer account"""
         self.active = True
@@ -191,11 +643,92 @@ class Customer(db.Model):
         logger.info("Processing all Customer")
         return cls.query.all()
 
+    @classmethod
+    def search(cls, text, limit, offset=0):
+        """
+        Returns the Customers that match a free text query, best match first
+
+        Postgres matches the query against the indexed search_vector column.
+        Other databases, such as SQLite in tests, match it in Python.
+
+        Args:
+            text (string): the words to search for
+            limit (int): the maximum number of Customers to return
+            offset (int): the number of matching Customers to skip
+        """
+        logger.info("Processing search for %s ...", text)
+        if db.session.get_bind().dialect.name == "postgresql":
+            return db.session.scalars(cls.search_statement(text, limit, offset)).all()
+        terms = text.lower().split()
+        ranked = [(cls._rank(customer, terms), customer) for customer in cls.query]
+        ranked = sorted(
+            (item for item in ranked if item[0] > 0), key=lambda item: (-item[0], item[1].id)
+        )
+        return [customer for _, customer in ranked[offset:offset + limit]]
+
+    @classmethod
+    def search_statement(cls, text, limit, offset=0):
+        """Returns the Postgres full text search query, ranked by ts_rank_cd"""
+        query = db.func.websearch_to_tsquery(SEARCH_CONFIG, text)
+        vector = db.literal_column("customer.search_vector")
+        return (
+            db.select(cls)
+            .where(vector.bool_op("@@")(query))
+            .order_by(db.func.ts_rank_cd(vector, query).desc(), cls.id)
+            .limit(limit)
+            .offset(offset)
+        )
+
+    @staticmethod
+    def _rank(customer, terms):
+        """Ranks a Customer for the search terms with the search_vector weights"""
+        rank = 0.0
+        for term in terms:
+            weights = [
+                weight
+                for fields, weight in SEARCH_WEIGHTS
+                if any(term in getattr(customer, name).lower() for name in fields)
+            ]
+            if not weights:
+                return 0.0
+            rank += max(weights)
+        return rank
+
     @classmethod
     def find(cls, by_id):
         """Finds a Customer by it's ID"""
         logger.info("Processing lookup for id %s ...", by_id)
-        return cls.query.get(by_id)
+        statement = cached_statement(("find",), lambda: db.select(Customer).where(Customer.id == db.bindparam("id")))
+        return db.session.execute(statement, {"id": by_id}).scalar_one_or_none()
+
+    @classmethod
+    def find_many(cls, field, keys):
+        """Returns the Customers whose field holds any of the keys in one query
+
+        Args:
+            field (string): id, username or email
+            keys (list): the values to look for
+        """
+        logger.info("Processing batch lookup of %d %s values ...", len(keys), field)
+        statement = cached_statement(
+            ("find_many", field),
+            lambda: db.select(Customer).where(getattr(Customer, field).in_(db.bindparam("keys", expanding=True))),
+        )
+        return db.session.execute(statement, {"keys": list(keys)}).scalars().all()
+
+    @classmethod
+    def changed_since(cls, updated_at, customer_id, until, limit):
+        """
+        Returns the Customers changed after a cursor, oldest change first
+
+        Args:
+            updated_at (datetime): the update time of the cursor
+            customer_id (int): the id of the cursor, to order equal times
+            until (datetime): the latest update time to return
+            limit (int): the maximum number of Customers to return
+        """
+        logger.info("Processing changes since %s ...", updated_at)
+        return _read_after(cls, cls.updated_at, (updated_at, customer_id), until, limit)
 
     @classmethod
     def find_by_name(cls, first_name):
@@ -242,3 +775,221 @@ class Customer(db.Model):
         """It should return a list of all customers with a certain email"""
         logger.info("Processing lookup for %s ...", email)
         return cls.query.filter(cls.email == email)
+
+
+def _isoformat(value):
+    """Formats a timestamp as ISO 8601 in UTC"""
+    value = as_utc(value)
+    return value.isoformat() if value is not None else None
+
+
+def _read_after(model, time_column, cursor, until, limit):
+    """Returns the rows after a (time, id) cursor up to until, in that order"""
+    statement = (
+        db.select(model)
+        .where(db.tuple_(time_column, model.id) > db.tuple_(*cursor), time_column <= until)
+        .order_by(time_column, model.id)
+        .limit(limit)
+    )
+    return db.session.scalars(statement).all()
+
+
+######################################################################
+# Tombstones
+######################################################################
+class CustomerTombstone(db.Model):
+    """
+    The id and deletion time of a deleted Customer
+
+    Mirrors read them by cursor to remove the Customers they hold, and
+    they are purged once they are older than the retention period.
+    """
+
+    __tablename__ = "customer_tombstone"
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    deleted_at = db.Column(db.DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (db.Index("ix_customer_tombstone_deleted_at_id", deleted_at, id),)
+
+    def __repr__(self):
+        return f"<CustomerTombstone id=[{self.id}] deleted_at={self.deleted_at}>"
+
+    def serialize(self):
+        """Serializes a tombstone into a dictionary"""
+        return {"id": self.id, "deleted_at": _isoformat(self.deleted_at)}
+
+    @classmethod
+    def insert_from(cls, deleted, deleted_at, notify=None):
+        """
+        Returns an INSERT of the tombstones of the ids a DELETE ... RETURNING removes
+
+        Postgres only runs data-modifying statements in a top level WITH.
+        The INSERT returns the ids, and notify after them if it is given.
+        """
+        deleted = deleted.cte("deleted")
+        when = db.literal(deleted_at, cls.deleted_at.type)
+        return (
+            db.insert(cls)
+            .from_select(["id", "deleted_at"], db.select(deleted.c.id, db.cast(when, cls.deleted_at.type)))
+            .add_cte(deleted)
+            .returning(cls.id, *([] if notify is None else [notify]))
+        )
+
+    @classmethod
+    def deleted_since(cls, deleted_at, customer_id, until, limit):
+        """
+        Returns the tombstones after a cursor, oldest first
+
+        Args:
+            deleted_at (datetime): the deletion time of the cursor
+            customer_id (int): the id of the cursor, to order equal times
+            until (datetime): the latest deletion time to return
+            limit (int): the maximum number of tombstones to return
+        """
+        logger.info("Processing deletions since %s ...", deleted_at)
+        return _read_after(cls, cls.deleted_at, (deleted_at, customer_id), until, limit)
+
+    @classmethod
+    def purge(cls, before):
+        """Deletes the tombstones older than a time and returns how many there were"""
+        result = db.session.execute(db.delete(cls.__table__).where(cls.__table__.c.deleted_at < before))
+        db.session.commit()
+        return result.rowcount
+
+
+######################################################################
+# Idempotency keys
+######################################################################
+class IdempotencyRecord(db.Model):
+    """
+    The stored response to a request that carried an Idempotency-Key
+
+    A PENDING record is held by a request that is still being processed.
+    It expires after a short lock timeout so a key whose request crashed
+    can be used again, and the stored response expires after the TTL.
+    """
+
+    __tablename__ = "idempotency_record"
+
+    PENDING = 0
+
+    ##################################################
+    # Table Schema
+    ##################################################
+    id = db.Column(db.String(64), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.Integer, nullable=False, default=PENDING)
+    body = db.Column(db.LargeBinary)
+    content_type = db.Column(db.String(255))
+    location = db.Column(db.String(2048))
+    expires_at = db.Column(db.Float, nullable=False, index=True)
+
+    def __repr__(self):
+        return f"<IdempotencyRecord id=[{self.id}] status={self.status}>"
+
+    @classmethod
+    def find_live(cls, record_id, now):
+        """Returns the record if it has not expired"""
+        statement = db.select(cls).where(cls.id == record_id, cls.expires_at > now)
+        return db.session.execute(statement).scalar_one_or_none()
+
+    @classmethod
+    def claim(cls, record_id, fingerprint, expires_at, now):
+        """
+        Claims a key for the request about to be processed
+
+        Returns:
+            bool: False when another request holds the key
+        """
+        table = cls.__table__
+        try:
+            with db.session.no_autoflush:
+                db.session.execute(
+                    db.delete(table).where(table.c.id == record_id, table.c.expires_at <= now)
+                )
+                db.session.execute(
+                    db.insert(table).values(
+                        id=record_id, fingerprint=fingerprint, status=cls.PENDING, expires_at=expires_at
+                    )
+                )
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            return False
+        return True
+
+    @classmethod
+    def save(cls, record_id, response, expires_at):
+        """Stores the response of the request that claimed the key"""
+        table = cls.__table__
+        db.session.execute(
+            db.update(table)
+            .where(table.c.id == record_id)
+            .values(
+                status=response.status_code,
+                body=response.get_data(),
+                content_type=response.content_type,
+                location=response.headers.get("Location"),
+                expires_at=expires_at,
+            )
+        )
+        db.session.commit()
+
+    @classmethod
+    def release(cls, record_id):
+        """Frees a key so the request can be retried"""
+        db.session.execute(db.delete(cls.__table__).where(cls.__table__.c.id == record_id))
+        db.session.commit()
+
+    @classmethod
+    def purge(cls, now):
+        """Deletes the expired records and returns how many there were"""
+        result = db.session.execute(db.delete(cls.__table__).where(cls.__table__.c.expires_at <= now))
+        db.session.commit()
+        return result.rowcount
+
+
+######################################################################
+# Full text search
+######################################################################
+SEARCH_CONFIG = "simple"
+
+# Fields of the search_vector and their weight, the same as ts_rank_cd uses
+SEARCH_WEIGHTS = [
+    (("first_name", "last_name", "username"), 1.0),
+    (("email",), 0.4),
+    (("address",), 0.2),
+]
+
+SEARCH_VECTOR = (
+    f"setweight(to_tsvector('{SEARCH_CONFIG}', first_name || ' ' || last_name || ' ' || username), 'A')"
+    f" || setweight(to_tsvector('{SEARCH_CONFIG}', email), 'B')"
+    f" || setweight(to_tsvector('{SEARCH_CONFIG}', address), 'C')"
+)
+
+SEARCH_DDL = [
+    "ALTER TABLE customer ADD COLUMN IF NOT EXISTS search_vector tsvector"
+    f" GENERATED ALWAYS AS ({SEARCH_VECTOR}) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_customer_search_vector ON customer USING GIN (search_vector)",
+]
+
+
+def create_search_index(connection=None):
+    """Adds the search_vector column and its GIN index on Postgres"""
+    connection = connection or db.session.connection()
+    if connection.dialect.name != "postgresql":
+        return False
+    for statement in SEARCH_DDL:
+        connection.execute(db.text(statement))
+    return True
+
+
+event.listen(
+    Customer.__table__,
+    "after_create",
+    lambda _table, connection, **_kwargs: create_search_index(connection),
+)
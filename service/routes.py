@@ -20,18 +20,30 @@ Customer Store Service
 This service implements a REST API that allows you to Create, Read, Update
 and Delete Customers from the inventory of customers in the CustomerShop
 """
-import hashlib
+import hmac
+import json
+import time
+import base64
+from datetime import datetime, timedelta, timezone
 from flask import request
 from flask import current_app as app  # Import Flask application
 from flask_restx import Resource, fields, reqparse, inputs
-from service.models import Customer, Gender
+from sqlalchemy import any_
+from sqlalchemy.dialects import postgresql
+from service.models import db, Customer, CustomerTombstone, Gender, DataValidationError, utcnow, add_write_listener
 from service.common import status  # HTTP Status Codes
+from service.common import assets
+from service.common.single_flight import SingleFlight
+from service.common.typo_index import find_typos
+from service.common import query_parser, query_plans, request_timing, cache, statement_cache
+from service.common.media_types import REQUEST_MEDIA_TYPES, read_body
 from . import api
 
 
-def encrypt_password(password):
-    """Hashing Passwords"""
-    return hashlib.sha256(password.encode("UTF-8")).hexdigest()
+# Identical concurrent reads in this worker share one database query, and
+# the reads that follow a write do not share the query of an earlier read
+reads = SingleFlight()
+add_write_listener(reads.invalidate)
 
 
 ############################################################
@@ -50,7 +62,11 @@ def health():
 def index():
     """Root URL response"""
     app.logger.info("Request for root URL")
-    return app.send_static_file("index.html")
+    manifest = app.config.get("ASSET_MANIFEST")
+    if not manifest:
+        return app.send_static_file("index.html")
+    with app.open_resource("static/index.html", "r") as page:
+        return assets.rewrite_asset_urls(page.read(), manifest)
 
 
 ######################################################################
@@ -95,34 +111,70 @@ customer_model = api.inherit(
             readOnly=True,
             description="The Id of the customer assigned internally by the service",
         ),
+        "created_at": fields.String(readOnly=True, description="When the Customer was created, in UTC"),
+        "updated_at": fields.String(readOnly=True, description="When the Customer last changed, in UTC"),
     },
 )
 
-# query string arguments for customers
-customer_args = reqparse.RequestParser()
-customer_args.add_argument(
-    "username",
-    type=str,
-    location="args",
-    required=False,
-    help="List Customers by username",
-)
-customer_args.add_argument(
-    "active",
-    type=inputs.boolean,
-    location="args",
-    required=False,
-    help="List Customers by active status",
+# Define the model so that the docs reflect what can be patched
+patch_customer_model = api.model(
+    "CustomerPatch",
+    {
+        "username": fields.String(description="The username of the Customer"),
+        "password": fields.String(description="The password of the Customer"),
+        "first_name": fields.String(description="The first name of the Customer"),
+        "last_name": fields.String(description="The last name of the Customer"),
+        "email": fields.String(description="The email of the Customer"),
+        "address": fields.String(description="The address of the Customer"),
+        "active": fields.Boolean(description="Is the Customer active?"),
+        # pylint: disable=protected-access
+        "gender": fields.String(
+            enum=Gender._member_names_, description="The gender of the Customer"
+        ),
+    },
 )
-customer_args.add_argument(
-    "gender", type=str, location="args", required=False, help="List Customers by gender"
+
+
+def typo_distance(value):
+    """Match usernames and last names within this many typos, closest first"""
+    if "typo_index" not in app.extensions:
+        # without the index every lookup would read the whole column
+        raise ValueError("fuzzy_distance is not available, the typo index is not enabled")
+    limit = app.config["TYPO_INDEX_MAX_DISTANCE"]
+    if not value.isdigit() or int(value) > limit:
+        raise ValueError(f"fuzzy_distance must be a whole number from 0 to {limit}")
+    return int(value)
+
+
+# query string filters for customers
+TEXT_HELP = '"exact", prefix* or substring, or __in=a,b for any of the values'
+customer_filters = query_parser.QueryParser(
+    {
+        "id": query_parser.number(
+            "Get Customers by a list of ids, or __in, __gt, __gte, __lt, __lte", batch=True
+        ),
+        "username": query_parser.text(
+            f"List Customers by username: {TEXT_HELP}, a,b gets a list of usernames", batch=True
+        ),
+        "email": query_parser.text(
+            f"List Customers by email: {TEXT_HELP}, a,b gets a list of emails", batch=True
+        ),
+        "first_name": query_parser.text(f"List Customers by first name: {TEXT_HELP}"),
+        "last_name": query_parser.text(f"List Customers by last name: {TEXT_HELP}"),
+        "address": query_parser.text(f"List Customers by address: {TEXT_HELP}"),
+        "gender": query_parser.choice(Gender, "List Customers by gender, or __in=male,female"),
+        "active": query_parser.boolean("List Customers by active status"),
+        "created_at": query_parser.timestamp("List Customers created at an ISO 8601 time, or __gt, __gte, __lt, __lte"),
+        "updated_at": query_parser.timestamp("List Customers updated at an ISO 8601 time, or __gt, __gte, __lt, __lte"),
+    },
+    options={"fuzzy_distance": typo_distance},
 )
 
 
 ######################################################################
 #  PATH: /customers/{id}
 ######################################################################
-@api.route("/customers/<customer_id>")
+@api.route("/customers/<int:customer_id>")
 @api.param("customer_id", "The Customer identifier")
 class CustomerResource(Resource):
     """
@@ -131,6 +183,7 @@ class CustomerResource(Resource):
     Allows the manipulation of a single Customer
     GET /customers/{id} - Returns a Customer with the id
     PUT /customers/{id} - Update a Customer with the id
+    PATCH /customers/{id} - Partially update a Customer with the id
     DELETE /customers/{id} -  Deletes a Customer with the id
     """
 
@@ -148,13 +201,17 @@ class CustomerResource(Resource):
         """
         app.logger.info("Request for customer with id: %s", customer_id)
 
-        customer = Customer.find(customer_id)
+        def find():
+            customer = Customer.find(customer_id)
+            return customer.serialize() if customer else None
+
+        customer = cache.cached(cache.customer_key(customer_id), lambda: coalesce(("find", str(customer_id)), find))
         if not customer:
             error(
                 status.HTTP_404_NOT_FOUND,
                 f"Customer with id '{customer_id}' was not found.",
             )
-        return customer.serialize(), status.HTTP_200_OK
+        return customer, status.HTTP_200_OK
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING CUSTOMER
@@ -171,27 +228,58 @@ class CustomerResource(Resource):
 
         This endpoint will update a Customer based the body that is posted
         """
-        app.logger.info("Request to update customer with id: %d", customer_id)
-        check_content_type("application/json")
-        # original_password = None
-        customer = Customer.find(int(customer_id))
-        if not customer:
+        app.logger.info("Request to update customer with id: %s", customer_id)
+        check_content_type(*REQUEST_MEDIA_TYPES)
+
+        customer = Customer()
+        try:
+            customer.deserialize(read_body())
+        except DataValidationError:
+            # a missing Customer is reported before a bad document
+            if not Customer.find(customer_id):
+                error(
+                    status.HTTP_404_NOT_FOUND,
+                    f"Customer with id: '{customer_id}' was not found.",
+                )
+            raise
+        customer.id = customer_id
+
+        # The password is hashed unless it is the stored hash sent back
+        if not customer.update(keep_hashed_password=True):
             error(
                 status.HTTP_404_NOT_FOUND,
                 f"Customer with id: '{customer_id}' was not found.",
             )
-        # else:
-        original_hashed_password = customer.password
 
-        customer.deserialize(request.get_json())
-        customer.id = int(customer_id)
+        app.logger.info("Customer with ID: %d updated.", customer.id)
+        return customer.serialize(), status.HTTP_200_OK
 
-        # Hash the new password if it's different from the original
-        if customer.password != original_hashed_password:
-            customer.password = encrypt_password(customer.password)
-        customer.update(original_hashed_password)
+    # ------------------------------------------------------------------
+    # PARTIALLY UPDATE AN EXISTING CUSTOMER
+    # ------------------------------------------------------------------
+    @api.doc("patch_customers")
+    @api.response(404, "Customer not found")
+    @api.response(400, "The patched Customer data was not valid")
+    @api.expect(patch_customer_model)
+    @api.marshal_with(customer_model)
+    def patch(self, customer_id):
+        """
+        Partially update a Customer
 
-        app.logger.info("Customer with ID: %d updated.", customer.id)
+        This endpoint will update only the fields of a Customer that are posted
+        """
+        app.logger.info("Request to patch customer with id: %s", customer_id)
+        check_content_type(*REQUEST_MEDIA_TYPES)
+
+        changes = Customer.deserialize_changes(read_body())
+        customer = Customer.patch(customer_id, changes)
+        if not customer:
+            error(
+                status.HTTP_404_NOT_FOUND,
+                f"Customer with id: '{customer_id}' was not found.",
+            )
+
+        app.logger.info("Customer with ID: %d patched.", customer.id)
         return customer.serialize(), status.HTTP_200_OK
 
     # ------------------------------------------------------------------
@@ -206,12 +294,11 @@ class CustomerResource(Resource):
 
         This endpoint will delete a Customer based the id specified in the path
         """
-        app.logger.info("Request to delete customer with id: %d", customer_id)
-        customer = Customer.find(customer_id)
-        if customer:
-            customer.delete()
+        app.logger.info("Request to delete customer with id: %s", customer_id)
+        if not Customer.delete_by_id(customer_id):
+            app.logger.info("Customer with ID: %s was already gone.", customer_id)
 
-        app.logger.info("Customer with ID: %d delete complete.", customer_id)
+        app.logger.info("Customer with ID: %s delete complete.", customer_id)
 
         return "", status.HTTP_204_NO_CONTENT
 
@@ -226,60 +313,44 @@ class CustomerCollection(Resource):
     # ------------------------------------------------------------------
     # LIST ALL CUSTOMERS
     # ------------------------------------------------------------------
-    @api.doc("list_customers")
-    @api.expect(customer_args, validate=True)
+    @api.doc("list_customers", params=customer_filters.doc())
+    @api.response(400, "The query string was not valid")
     @api.marshal_list_with(customer_model)
     def get(self):
         """Returns all of the Customers by some Attributes"""
         app.logger.info("Request for customer list")
 
-        query = Customer.query
-
-        # if 'username' in request.args:
-        #     query = Customer.query_by_username(request.args.get('username'))
-        # if 'email' in request.args:
-        #     query = Customer.query_by_email(request.args.get('email'))
-        # if 'first_name' in request.args:
-        #     query = Customer.find_by_name(request.args.get('first_name'))
-        # if 'last_name' in request.args:
-        #     query = Customer.query_by_last_name(request.args.get('last_name'))
-        # if 'address' in request.args:
-        #     query = Customer.query_by_address(request.args.get('address'))
-
-        # dynamic querying
-        for param in ["username", "email", "address", "first_name", "last_name"]:
-            if param in request.args:
-                value = request.args.get(param)
-                if value.startswith('"') and value.endswith('"'):
-                    # Exact search
-                    exact_value = value[1:-1]
-                    query = query.filter(getattr(Customer, param) == exact_value)
-                else:
-                    # Fuzzy search
-                    query = query.filter(getattr(Customer, param).ilike(f"%{value}%"))
-
-        if "gender" in request.args:
-            gender_value = request.args.get("gender").upper()
-            if gender_value in Gender.__members__:
-                query = query.filter(
-                    getattr(Customer, "gender") == Gender[gender_value]
-                )
-            else:
-                error(status.HTTP_400_BAD_REQUEST, "Invalid gender value")
-
-        if "active" in request.args:
-            active_value = request.args.get("active").lower()
-            if active_value in ["true", "1"]:
-                query = query.filter(Customer.active)
-            elif active_value in ["false", "0"]:
-                query = query.filter(~Customer.active)
-            else:
-                error(status.HTTP_400_BAD_REQUEST, "Invalid active value")
-
-        customers = query.all()
-        results = [customer.serialize() for customer in customers]
+        with request_timing.phase("parse"):
+            filters = customer_filters.parse(request.args, app.config["BATCH_GET_MAX_KEYS"])
+        query, ranks = filter_customers(filters)
+
+        def list_customers():
+            started = time.perf_counter()
+            rows = query.all()
+            query_plans.log_if_slow(query.statement, time.perf_counter() - started)
+            with request_timing.phase("serialize"):
+                customers = [customer.serialize() for customer in rows]
+            if ranks is not None:
+                # closest typo matches first
+                customers.sort(key=lambda customer: (ranks[customer["id"]], customer["id"]))
+            return customers
+
+        def find_many(ids):
+            rows = Customer.find_many("id", ids)
+            with request_timing.phase("serialize"):
+                return [customer.serialize() for customer in rows]
+
+        results = cache.cached_list(
+            filters.key, lambda: coalesce(("list",) + filters.key, list_customers), find_many
+        )
+        headers = {}
+        batch = filters.batch
+        if batch is not None:
+            results, missing = order_by_keys(results, batch.field, batch.value)
+            if missing:
+                headers[MISSING_KEYS_HEADER] = ",".join(str(key) for key in missing)
         app.logger.info("Returning %d customers", len(results))
-        return results, status.HTTP_200_OK
+        return results, status.HTTP_200_OK, headers
 
     # ------------------------------------------------------------------
     # ADD A NEW CUSTOMER
@@ -295,10 +366,10 @@ class CustomerCollection(Resource):
         This endpoint will create a Customer based the data in the body that is posted
         """
         app.logger.info("Request to Create a Customer")
-        check_content_type("application/json")
+        check_content_type(*REQUEST_MEDIA_TYPES)
 
         customer = Customer()
-        customer.deserialize(request.get_json())
+        customer.deserialize(read_body())
         customer.create()
 
         location_url = api.url_for(
@@ -309,10 +380,327 @@ class CustomerCollection(Resource):
         return customer.serialize(), status.HTTP_201_CREATED, {"Location": location_url}
 
 
+######################################################################
+#  PATH: /customers:batchGet
+######################################################################
+batch_get_model = api.model(
+    "CustomerBatchGet",
+    {
+        "ids": fields.List(fields.Integer, description="The ids to get"),
+        "usernames": fields.List(fields.String, description="The usernames to get"),
+        "emails": fields.List(fields.String, description="The emails to get"),
+    },
+)
+
+batch_model = api.model(
+    "CustomerBatch",
+    {
+        "customers": fields.List(
+            fields.Nested(customer_model), description="The Customers found, in the order asked for"
+        ),
+        "missing": fields.List(fields.Raw, description="The keys that were not found"),
+    },
+)
+
+# request field -> column and the type of its keys
+BATCH_FIELDS = {"ids": ("id", int), "usernames": ("username", str), "emails": ("email", str)}
+
+
+@api.route("/customers:batchGet")
+class CustomerBatchGet(Resource):
+    """Gets many Customers in one request"""
+
+    # ------------------------------------------------------------------
+    # GET CUSTOMERS BY A LIST OF KEYS
+    # ------------------------------------------------------------------
+    @api.doc("batch_get_customers")
+    @api.response(400, "The posted keys were not valid")
+    @api.expect(batch_get_model)
+    @api.marshal_with(batch_model)
+    def post(self):
+        """
+        Gets Customers by ids, usernames or emails
+
+        Looks all of the keys up in one query and returns the Customers in
+        the order of the keys along with the keys that were not found.
+        """
+        app.logger.info("Request to batch get Customers")
+        check_content_type(*REQUEST_MEDIA_TYPES)
+        field, keys = batch_keys(read_body())
+
+        def find_many():
+            rows = Customer.find_many(field, keys)
+            with request_timing.phase("serialize"):
+                return [customer.serialize() for customer in rows]
+
+        results = coalesce(("batch", field) + keys, find_many)
+        customers, missing = order_by_keys(results, field, keys)
+        app.logger.info("Returning %d customers, %d missing", len(customers), len(missing))
+        return {"customers": customers, "missing": missing}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /customers:explain
+######################################################################
+plan_model = api.model(
+    "CustomerQueryPlan",
+    {
+        "sql": fields.String(description="The SQL of the list query"),
+        "plan": fields.Raw(description="The plan of the query as the database reports it"),
+        "analyzed": fields.Boolean(description="True if the query was run to measure the plan"),
+    },
+)
+
+
+@api.route("/customers:explain")
+class CustomerQueryPlan(Resource):
+    """The plan of a Customer list query, for administrators"""
+
+    # ------------------------------------------------------------------
+    # EXPLAIN A LIST QUERY
+    # ------------------------------------------------------------------
+    @api.doc("explain_list_customers", params=customer_filters.doc())
+    @api.response(400, "The query string was not valid")
+    @api.response(403, "The admin token is missing or wrong")
+    @api.marshal_with(plan_model)
+    def get(self):
+        """
+        Explains a Customer list query
+
+        Takes the query string of GET /customers and returns the SQL it
+        runs and its EXPLAIN (ANALYZE, BUFFERS) plan, without the results.
+        """
+        check_admin()
+        filters = customer_filters.parse(request.args, app.config["BATCH_GET_MAX_KEYS"])
+        statement = filter_customers(filters)[0].statement
+        analyze = db.engine.dialect.name == "postgresql"
+        plan = query_plans.capture_plan(statement, analyze=analyze)
+        app.logger.info("Explained a customer list query for an administrator")
+        return {
+            "sql": query_plans.render_sql(statement),
+            "plan": plan,
+            "analyzed": analyze,
+        }, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /customers:statements
+######################################################################
+statements_model = api.model(
+    "StatementCacheStats",
+    {
+        "executions": fields.Integer(description="Statements executed by this process"),
+        "hits": fields.Integer(description="Executions whose SQL was found in the compiled cache"),
+        "misses": fields.Integer(description="Executions that compiled their SQL"),
+        "uncached": fields.Integer(description="Executions of SQL that is not cached"),
+        "hit_rate": fields.Float(description="Hits out of the hits and misses"),
+        "compiled": fields.Integer(description="Statements in the compiled cache"),
+        "compiled_capacity": fields.Integer(description="Size of the compiled cache"),
+        "prebuilt": fields.Integer(description="Hot statements built once with bind parameters"),
+        "prepared": fields.Boolean(description="True if the database prepares the statements"),
+    },
+)
+
+
+@api.route("/customers:statements")
+class CustomerStatements(Resource):
+    """The statement cache statistics of this process, for administrators"""
+
+    @api.doc("statement_cache_stats")
+    @api.response(403, "The admin token is missing or wrong")
+    @api.marshal_with(statements_model)
+    def get(self):
+        """Returns how often the statements reused their compiled SQL"""
+        check_admin()
+        return statement_cache.stats(app), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /customers/changes
+######################################################################
+changes_args = reqparse.RequestParser()
+changes_args.add_argument(
+    "since",
+    type=str,
+    location="args",
+    help="The cursor of the last page, or an ISO 8601 time to start from, omitted for all",
+)
+changes_args.add_argument(
+    "limit",
+    type=inputs.int_range(1, 1000),
+    location="args",
+    default=100,
+    help="The number of Customers per page",
+)
+
+changes_model = api.model(
+    "CustomerChanges",
+    {
+        "customers": fields.List(
+            fields.Nested(customer_model), description="The changed Customers, oldest change first"
+        ),
+        "cursor": fields.String(description="The since of the next page"),
+        "more": fields.Boolean(description="True if there are more changes to read right away"),
+    },
+)
+
+
+@api.route("/customers/changes")
+class CustomerChanges(Resource):
+    """The feed of created and updated Customers"""
+
+    @api.doc("list_customer_changes")
+    @api.expect(changes_args, validate=True)
+    @api.response(400, "The cursor was not valid")
+    @api.marshal_with(changes_model)
+    def get(self):
+        """
+        Lists the Customers changed since a cursor
+
+        Mirrors keep the returned cursor and pass it as since to get the
+        next page, then keep polling with it to get the later changes.
+        Deleted Customers are in /customers/deletions.
+        """
+        app.logger.info("Request for customer changes")
+        customers, cursor, more = read_feed("changes", Customer.changed_since, "updated_at")
+        app.logger.info("Returning %d changed customers", len(customers))
+        return {"customers": customers, "cursor": cursor, "more": more}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /customers/deletions
+######################################################################
+tombstone_model = api.model(
+    "CustomerTombstone",
+    {
+        "id": fields.Integer(description="The id of the deleted Customer"),
+        "deleted_at": fields.String(description="When the Customer was deleted, in UTC"),
+    },
+)
+
+deletions_model = api.model(
+    "CustomerDeletions",
+    {
+        "deletions": fields.List(
+            fields.Nested(tombstone_model), description="The deleted Customers, oldest deletion first"
+        ),
+        "cursor": fields.String(description="The since of the next page"),
+        "more": fields.Boolean(description="True if there are more deletions to read right away"),
+    },
+)
+
+
+@api.route("/customers/deletions")
+class CustomerDeletions(Resource):
+    """The feed of deleted Customers"""
+
+    @api.doc("list_customer_deletions")
+    @api.expect(changes_args, validate=True)
+    @api.response(400, "The cursor was not valid")
+    @api.marshal_with(deletions_model)
+    def get(self):
+        """
+        Lists the Customers deleted since a cursor
+
+        Works like the change feed. Tombstones are kept for
+        TOMBSTONE_RETENTION_DAYS, a mirror that has not read them for
+        longer than that has to read the whole list again.
+        """
+        app.logger.info("Request for customer deletions")
+        deletions, cursor, more = read_feed("deletions", CustomerTombstone.deleted_since, "deleted_at")
+        app.logger.info("Returning %d deleted customers", len(deletions))
+        return {"deletions": deletions, "cursor": cursor, "more": more}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /customers/events
+######################################################################
+@api.route("/customers/events")
+class CustomerEvents(Resource):
+    """The stream of Customer writes"""
+
+    @api.doc("stream_customer_events")
+    @api.produces(["text/event-stream"])
+    @api.response(200, "Server-Sent Events named create, update, activate, deactivate, delete and reset")
+    @api.response(503, "Too many clients are connected")
+    def get(self):
+        """
+        Streams the writes of Customers as Server-Sent Events
+
+        The data of an event is the Customer without its password, or its
+        id for a delete. Send the id of the last event received in the
+        Last-Event-ID header to be sent the events missed since then.
+        """
+        broker = app.extensions["event_stream"]
+        subscriber, backlog = broker.subscribe(request.headers.get("Last-Event-ID"))
+        if subscriber is None:
+            error(status.HTTP_503_SERVICE_UNAVAILABLE, "Too many clients are streaming events")
+        app.logger.info("Streaming events, %d clients connected", broker.clients)
+        events = broker.stream(
+            subscriber, backlog, app.config["EVENTS_HEARTBEAT"], app.config["EVENTS_MAX_DURATION"]
+        )
+        response = app.response_class(events, mimetype="text/event-stream")
+        response.headers["Cache-Control"] = "no-cache"
+        response.headers["X-Accel-Buffering"] = "no"
+        # the stream is not started when the client is gone before the first event
+        response.call_on_close(lambda: broker.unsubscribe(subscriber))
+        return response
+
+
+######################################################################
+#  PATH: /customers/search
+######################################################################
+search_args = reqparse.RequestParser()
+search_args.add_argument(
+    "q", type=str, location="args", required=True, help="The words to search for"
+)
+search_args.add_argument(
+    "page", type=inputs.positive, location="args", default=1, help="The page to return"
+)
+search_args.add_argument(
+    "per_page",
+    type=inputs.int_range(1, 100),
+    location="args",
+    default=20,
+    help="The number of Customers per page",
+)
+
+
+@api.route("/customers/search")
+class CustomerSearch(Resource):
+    """Free text search of Customers"""
+
+    @api.doc("search_customers")
+    @api.expect(search_args, validate=True)
+    @api.response(400, "The search query was not valid")
+    @api.marshal_list_with(customer_model)
+    def get(self):
+        """
+        Search Customers
+
+        This endpoint will return the Customers whose names, username, email
+        or address match the words in q, best match first
+        """
+        args = search_args.parse_args()
+        text = args["q"].strip()
+        if not text:
+            error(status.HTTP_400_BAD_REQUEST, "The search query q must not be empty")
+        app.logger.info("Request to search customers for: %s", text)
+
+        limit = args["per_page"]
+        offset = (args["page"] - 1) * limit
+        results = coalesce(
+            ("search", text, limit, offset),
+            lambda: [c.serialize() for c in Customer.search(text, limit, offset)],
+        )
+        app.logger.info("Returning %d customers", len(results))
+        return results, status.HTTP_200_OK
+
+
 ######################################################################
 #  PATH: /customers/{id}/activate
 ######################################################################
-@api.route("/customers/<customer_id>/activate")
+@api.route("/customers/<int:customer_id>/activate")
 @api.param("customer_id", "The Customer identifier")
 class ActivateCustomerResource(Resource):
     """Activation actions on a Customer"""
@@ -325,20 +713,19 @@ class ActivateCustomerResource(Resource):
 
         This endpoint will activate a customer based on the id specified in the path
         """
-        customer = Customer.find(customer_id)
+        customer = Customer.set_active(customer_id, True)
         if not customer:
             error(
                 status.HTTP_404_NOT_FOUND,
                 f"Customer with id '{customer_id}' was not found.",
             )
-        customer.activate()
         return customer.serialize(), status.HTTP_204_NO_CONTENT
 
 
 ######################################################################
 #  PATH: /customers/{id}/deactivate
 ######################################################################
-@api.route("/customers/<customer_id>/deactivate")
+@api.route("/customers/<int:customer_id>/deactivate")
 @api.param("customer_id", "The Customer identifier")
 class DeactivateCustomerResource(Resource):
     """Deactivation actions on a Customer"""
@@ -351,13 +738,12 @@ class DeactivateCustomerResource(Resource):
 
         This endpoint will deactivate a customer based on the id specified in the path
         """
-        customer = Customer.find(customer_id)
+        customer = Customer.set_active(customer_id, False)
         if not customer:
             error(
                 status.HTTP_404_NOT_FOUND,
                 f"Customer with id '{customer_id}' was not found.",
             )
-        customer.deactivate()
         return customer.serialize(), status.HTTP_204_NO_CONTENT
 
 
@@ -369,24 +755,222 @@ class DeactivateCustomerResource(Resource):
 ######################################################################
 # Checks the ContentType of a request
 ######################################################################
-def check_content_type(content_type):
-    """Checks that the media type is correct"""
+def check_content_type(*content_types):
+    """Checks that the media type is one of the content types"""
+    expected = " or ".join(content_types)
     if "Content-Type" not in request.headers:
         app.logger.error("No Content-Type specified.")
         error(
             status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
-            f"Content-Type must be {content_type}",
+            f"Content-Type must be {expected}",
         )
 
-    if request.headers["Content-Type"] == content_type:
+    if request.headers["Content-Type"] in content_types:
         return
 
     app.logger.error("Invalid Content-Type: %s", request.headers["Content-Type"])
     error(
-        status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, f"Content-Type must be {content_type}"
+        status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, f"Content-Type must be {expected}"
     )
 
 
+######################################################################
+# Checks that the request comes from an administrator
+######################################################################
+def check_admin():
+    """Checks the admin token of the request"""
+    token = app.config["ADMIN_TOKEN"]
+    given = request.headers.get(app.config["ADMIN_TOKEN_HEADER"], "")
+    if not token or not hmac.compare_digest(given.encode("utf-8"), token.encode("utf-8")):
+        error(status.HTTP_403_FORBIDDEN, "This endpoint is for administrators only")
+
+
+######################################################################
+# Change feed cursors
+######################################################################
+FEED_START = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def encode_cursor(updated_at, customer_id):
+    """Returns the opaque cursor of a position in the change feed"""
+    position = f"{updated_at.isoformat()}|{customer_id}"
+    return base64.urlsafe_b64encode(position.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(since):
+    """
+    Reads the since of the change feed
+
+    Returns:
+        tuple: the update time and id to read the changes after
+    """
+    if not since:
+        return FEED_START, 0
+    try:
+        # a time starts the feed there
+        return query_parser.parse_timestamp(since), 0
+    except ValueError:
+        pass
+    try:
+        updated_at, customer_id = base64.urlsafe_b64decode(since.encode("ascii")).decode("utf-8").split("|")
+        return query_parser.parse_timestamp(updated_at), int(customer_id)
+    except ValueError as reason:
+        raise DataValidationError(f"Invalid since: {since}") from reason
+
+
+def read_feed(name, read, time_field):
+    """
+    Reads a page of a feed in (time, id) order
+
+    Changes younger than CHANGE_FEED_DELAY seconds are held back so a
+    write that commits late is not skipped, as long as it commits within
+    the delay, which the SQL timeouts bound.
+
+    Args:
+        name (str): the name of the feed
+        read (callable): returns the rows after a (time, id) cursor up to
+            a time, read(time, id, until, limit)
+        time_field (str): the serialized time the rows are ordered by
+
+    Returns:
+        tuple: the serialized rows, the cursor of the next page and
+        whether there are more rows to read right away
+    """
+    args = changes_args.parse_args()
+    since, row_id = decode_cursor(args["since"])
+    limit = args["limit"]
+    until = utcnow() - timedelta(seconds=app.config["CHANGE_FEED_DELAY"])
+
+    def read_page():
+        rows = read(since, row_id, until, limit + 1)
+        with request_timing.phase("serialize"):
+            return [row.serialize() for row in rows]
+
+    results = coalesce((name, since, row_id, limit), read_page)
+    page = results[:limit]
+    cursor = args["since"] or encode_cursor(since, row_id)
+    if page:
+        last = page[-1]
+        cursor = encode_cursor(query_parser.parse_timestamp(last[time_field]), last["id"])
+    return page, cursor, len(results) > limit
+
+
+######################################################################
+# Batch gets
+######################################################################
+MISSING_KEYS_HEADER = "X-Missing-Keys"
+
+
+def batch_keys(data):
+    """
+    Validates the body of a batch get
+
+    Returns:
+        tuple: the column and the unique keys in the order they were given
+    """
+    if not isinstance(data, dict):
+        raise DataValidationError("Invalid batch get: body of request contained bad data")
+    given = [name for name in BATCH_FIELDS if name in data]
+    if len(given) != 1:
+        raise DataValidationError(f"Invalid batch get: give one of {', '.join(BATCH_FIELDS)}")
+    name = given[0]
+    field, key_type = BATCH_FIELDS[name]
+    keys = data[name]
+    if not isinstance(keys, list) or not all(
+        isinstance(key, key_type) and not isinstance(key, bool) for key in keys
+    ):
+        raise DataValidationError(f"Invalid batch get: {name} must be a list of {key_type.__name__}")
+    if len(keys) > app.config["BATCH_GET_MAX_KEYS"]:
+        raise DataValidationError(
+            f"Invalid batch get: at most {app.config['BATCH_GET_MAX_KEYS']} {name}"
+        )
+    return field, tuple(dict.fromkeys(keys))
+
+
+def order_by_keys(customers, field, keys):
+    """
+    Orders serialized Customers by the keys that were asked for
+
+    Returns:
+        tuple: the Customers in the order of the keys and the missing keys
+    """
+    by_key = {}
+    for customer in customers:
+        by_key.setdefault(customer[field], customer)
+    found = [by_key[key] for key in keys if key in by_key]
+    missing = [key for key in keys if key not in by_key]
+    return found, missing
+
+
+######################################################################
+# Builds the list queries from the parsed filters
+######################################################################
+TYPO_FIELDS = ("username", "last_name")
+
+
+def filter_customers(filters):
+    """
+    Builds the query for the parsed filters
+
+    Returns:
+        tuple: the query and the typo distance of each customer, or None
+        when no typo-tolerant filter was asked for
+    """
+    query = Customer.query
+    max_distance = filters.option("fuzzy_distance")
+    ranks = None
+    for condition in filters.conditions:
+        if condition.operator != "contains":
+            query = query.filter(customer_filters.criterion(Customer, condition))
+        elif max_distance is not None and condition.field in TYPO_FIELDS:
+            # Typo-tolerant search, the distances add up over the fields
+            matches = find_typos(condition.field, condition.value, max_distance)
+            if ranks is not None:
+                matches = {key: ranks[key] + edits for key, edits in matches.items() if key in ranks}
+            ranks = matches
+            query = query.filter(ids_criterion(ranks))
+        else:
+            query = query.filter(*fuzzy_match(condition.field, condition.value))
+    return query, ranks
+
+
+def ids_criterion(ids):
+    """
+    Returns the criterion of the Customers with the ids, bound as one value
+
+    However many ids there are, Postgres gets one array and SQLite one JSON
+    array, instead of a bind parameter per id.
+    """
+    ids = sorted(ids)
+    if db.engine.dialect.name == "postgresql":
+        return Customer.id == any_(db.literal(ids, postgresql.ARRAY(db.Integer)))
+    values = db.select(db.column("value")).select_from(db.func.json_each(json.dumps(ids)))
+    return Customer.id.in_(values)
+
+
+def fuzzy_match(field, value):
+    """Returns the criteria for a field that contains the value"""
+    criteria = [getattr(Customer, field).icontains(value, autoescape=True)]
+    search_index = app.extensions.get("search_index")
+    if search_index is not None:
+        candidates = search_index.candidates(field, value)
+        # a common n-gram matches most of the table, the LIKE alone is cheaper
+        # than binding that many ids
+        if candidates is not None and len(candidates) <= app.config["SEARCH_INDEX_MAX_CANDIDATES"]:
+            criteria.append(Customer.id.in_(candidates))
+    return criteria
+
+
+######################################################################
+# Shares the result of identical concurrent reads
+######################################################################
+def coalesce(key, function):
+    """Runs a read, or waits for the identical read already in flight"""
+    if not app.config["SINGLE_FLIGHT_ENABLED"]:
+        return function()
+    return reads.do(key, function)
+
+
 ######################################################################
 # Logs error messages before aborting
 ######################################################################
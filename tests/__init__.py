@@ -0,0 +1,9 @@
+"""
+Test Package
+
+Cheap password hashing in the request thread keeps the suites fast
+"""
+import os
+
+os.environ.setdefault("PASSWORD_HASH_COST", "1000")
+os.environ.setdefault("PASSWORD_HASH_WORKERS", "0")
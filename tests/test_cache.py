@@ -0,0 +1,205 @@
+"""
+Test cases for the Customer Cache
+"""
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from wsgi import app
+from service import models
+from service.common import cache, status
+from service.common.cache import MemoryCache, SharedMemoryCache
+from service.common.invalidation import InvalidationBus
+from .customer_factory import CustomerFactory
+from .service_test_case import ServiceTestCase
+
+BASE_URL = "/api/customers"
+
+
+######################################################################
+#  B A C K E N D   T E S T   C A S E S
+######################################################################
+class TestBackends(TestCase):
+    """Cache Backend Tests"""
+
+    def setUp(self):
+        """Creates a scratch file for the shared backend, removed after the test"""
+        with tempfile.NamedTemporaryFile(delete=False) as scratch:
+            self.path = scratch.name
+        self.addCleanup(os.remove, self.path)
+
+    def _shared(self, **kwargs):
+        """Returns a shared cache with one stripe of two slots in the scratch file"""
+        options = {"size": 1, "ways": 2, "slot_size": 64}
+        options.update(kwargs)
+        backend = SharedMemoryCache(self.path, **options)
+        self.addCleanup(backend.close)
+        return backend
+
+    def _check_backend(self, backend):
+        """Checks the behavior that both backends share"""
+        self.assertIsNone(backend.get("a", now=100.0))
+        self.assertTrue(backend.set("a", b"alice", 10, now=100.0))
+        self.assertEqual(backend.get("a", now=105.0), b"alice")
+        self.assertIsNone(backend.get("a", now=110.0))
+        self.assertFalse(backend.set("big", b"x" * 1000, 10, now=100.0))
+
+        generation = backend.generation()
+        backend.bump()
+        self.assertFalse(backend.set("b", b"bob", 10, generation, now=100.0))
+        self.assertTrue(backend.set("b", b"bob", 10, backend.generation(), now=100.0))
+        backend.delete("b")
+        self.assertIsNone(backend.get("b", now=100.0))
+        backend.set("c", b"carol", 10, now=100.0)
+        backend.clear()
+        self.assertIsNone(backend.get("c", now=100.0))
+
+    def test_memory(self):
+        """It should cache values in the process until they expire"""
+        backend = MemoryCache(max_entries=2, max_value_size=64)
+        self._check_backend(backend)
+        for key in ["a", "b", "c"]:
+            backend.set(key, key.encode(), 10)
+            backend.get("a")
+        self.assertIsNotNone(backend.get("a"))
+        self.assertIsNone(backend.get("b"))
+        stats = backend.stats()
+        self.assertEqual((stats["evictions"], stats["oversized"], stats["entries"]), (1, 1, 2))
+
+    def test_shared(self):
+        """It should cache values in slots of a memory-mapped file"""
+        backend = self._shared()
+        self.assertEqual((backend.stripes, backend.max_value_size), (1, 64 - backend.SLOT.size))
+        self._check_backend(backend)
+
+    def test_shared_between_processes(self):
+        """It should share the values and the generation with every worker"""
+        first, second = self._shared(), self._shared()
+        first.set("a", b"alice", 10)
+        first.bump()
+        self.assertEqual(second.get("a"), b"alice")
+        self.assertEqual(second.generation(), 1)
+        # another layout starts over
+        third = self._shared(slot_size=128)
+        self.assertIsNone(third.get("a"))
+
+    def test_shared_eviction(self):
+        """It should replace the slot of a stripe used least recently"""
+        backend = self._shared()
+        backend.set("a", b"alice", 10, now=100.0)
+        backend.set("b", b"bob", 10, now=101.0)
+        backend.get("a", now=102.0)
+        backend.set("c", b"carol", 10, now=103.0)
+        self.assertEqual(backend.get("a", now=104.0), b"alice")
+        self.assertIsNone(backend.get("b", now=104.0))
+        backend.set("c", b"carl", 10, now=105.0)
+        stats = backend.stats(now=105.0)
+        self.assertEqual((stats["stores"], stats["evictions"]), (4, 1))
+        self.assertEqual((stats["entries"], stats["bytes"]), (2, 9))
+
+
+######################################################################
+#  R O U T E   T E S T   C A S E S
+######################################################################
+class TestCustomerCache(ServiceTestCase):
+    """Customer Cache Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Caches the customers in memory"""
+        super().setUpClass()
+        app.config["CACHE_BACKEND"] = "memory"
+        cls.listeners = list(models.write_listeners)
+        app.extensions["invalidation"] = InvalidationBus("customer_writes", 1, 1)
+        cache.init_cache(app)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Turns the cache off again"""
+        app.config["CACHE_BACKEND"] = "none"
+        app.extensions.pop("cache")
+        app.extensions.pop("invalidation")
+        del models.write_listeners[len(cls.listeners):]
+        super().tearDownClass()
+
+    def setUp(self):
+        """Runs before each test"""
+        super().setUp()
+        self.cache = app.extensions["cache"]
+        self.cache.clear()
+
+    def test_get_customer(self):
+        """It should read a Customer from the cache until it is written"""
+        response = self.client.post(BASE_URL, json=CustomerFactory().serialize())
+        customer = response.get_json()
+        url = f"{BASE_URL}/{customer['id']}"
+        with patch("service.models.Customer.find", wraps=models.Customer.find) as find:
+            self.assertEqual(self.client.get(url).get_json(), customer)
+            self.assertEqual(self.client.get(url).get_json(), customer)
+            self.assertEqual(find.call_count, 1)
+
+            self.client.patch(url, json={"first_name": "Cached"})
+            self.assertEqual(self.client.get(url).get_json()["first_name"], "Cached")
+            self.assertEqual(find.call_count, 2)
+
+            # a write on another pod
+            app.extensions["invalidation"].receive(
+                f'{{"origin": "other", "action": "update", "id": {customer["id"]}}}'
+            )
+            self.client.get(url)
+            self.assertEqual(find.call_count, 3)
+            app.extensions["invalidation"].receive('{"origin": "other", "action": "reset", "id": null}')
+            self.client.get(url)
+            self.assertEqual(find.call_count, 4)
+
+        self.client.delete(url)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+    def test_list_customers(self):
+        """It should serve repeated list queries from the cached ids until a write"""
+        customers = [
+            self.client.post(BASE_URL, json=customer.serialize()).get_json()
+            for customer in CustomerFactory.build_batch(3, active=True)
+        ]
+        ids = ",".join(str(customer["id"]) for customer in customers)
+        with patch("service.routes.query_plans.log_if_slow") as queries:
+            first = self.client.get(BASE_URL, query_string={"id__in": ids, "active": "true"}).get_json()
+            second = self.client.get(BASE_URL, query_string={"active": "1", "id__in": ids}).get_json()
+            self.assertEqual(second, first)
+            self.assertEqual(queries.call_count, 1)
+
+            # customers that left the cache are read by id
+            self.cache.delete(cache.customer_key(customers[0]["id"]))
+            with patch("service.models.Customer.find_many", wraps=models.Customer.find_many) as find_many:
+                self.assertEqual(self.client.get(BASE_URL, query_string={"id__in": ids, "active": "true"}).get_json(), first)
+                find_many.assert_called_once_with("id", [customers[0]["id"]])
+
+            self.client.patch(f"{BASE_URL}/{customers[0]['id']}", json={"first_name": "Listed"})
+            third = self.client.get(BASE_URL, query_string={"id__in": ids, "active": "true"}).get_json()
+            self.assertEqual(queries.call_count, 2)
+            self.assertIn("Listed", [customer["first_name"] for customer in third])
+
+            with patch.dict(app.config, {"CACHE_LIST_MAX_RESULTS": 2}):
+                for _ in range(2):
+                    self.client.get(BASE_URL, query_string={"id__in": ids})
+            self.assertEqual(queries.call_count, 4)
+
+            # a customer deleted behind the cache's back runs the query again
+            self.client.get(BASE_URL, query_string={"id__in": ids})
+            self.cache.delete(cache.customer_key(customers[1]["id"]))
+            models.db.session.execute(models.db.delete(models.Customer).where(models.Customer.id == customers[1]["id"]))
+            models.db.session.commit()
+            self.assertEqual(len(self.client.get(BASE_URL, query_string={"id__in": ids}).get_json()), 2)
+            self.assertEqual(queries.call_count, 6)
+
+    def test_create_cache(self):
+        """It should create the backend the config asks for"""
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        config = dict(app.config, CACHE_BACKEND="shared", CACHE_SHARED_PATH=path)
+        backend = cache.create_cache(config)
+        self.assertIsInstance(backend, SharedMemoryCache)
+        backend.close()
+        self.assertIsNone(cache.create_cache(dict(config, CACHE_BACKEND="none")))
@@ -7,7 +7,12 @@ from unittest.mock import patch, MagicMock
 from click.testing import CliRunner
 # pylint: disable=unused-import
 from wsgi import app  # noqa: F401
-from service.common.cli_commands import db_create  # noqa: E402
+from service.common.cli_commands import db_create, db_search_index, db_indexes, assets_build  # noqa: E402
+from service.common.cli_commands import db_purge_tombstones, cache_stats, db_statement_benchmark  # noqa: E402
+from service.common.cli_commands import media_type_benchmark  # noqa: E402
+from service.common.cache import MemoryCache  # noqa: E402
+from service.models import db, Customer  # noqa: E402
+from .customer_factory import CustomerFactory  # noqa: E402
 
 
 class TestFlaskCLI(TestCase):
@@ -23,3 +28,99 @@ class TestFlaskCLI(TestCase):
         with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+
+    @patch('service.common.cli_commands.assets')
+    def test_assets_build(self, assets_mock):
+        """It should call the assets-build command"""
+        assets_mock.build_assets.return_value = {"js/app.js": "dist/app.123.js"}
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(assets_build)
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("dist/app.123.js", result.output)
+
+    @patch('service.common.cli_commands.db')
+    @patch('service.common.cli_commands.create_search_index')
+    def test_db_search_index(self, create_mock, db_mock):
+        """It should call the db-search-index command"""
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            create_mock.return_value = True
+            result = self.runner.invoke(db_search_index)
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("index created", result.output)
+            db_mock.session.commit.assert_called_once()
+
+            create_mock.return_value = False
+            result = self.runner.invoke(db_search_index)
+            self.assertIn("needs Postgres", result.output)
+
+    @patch('service.common.cli_commands.db')
+    @patch('service.common.index_advice.missing_indexes')
+    def test_db_indexes(self, missing_mock, db_mock):
+        """It should call the db-indexes command"""
+        missing_mock.return_value = ["ix_customer_gender_active"]
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(db_indexes)
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("ix_customer_gender_active created", result.output)
+            self.assertIn("ix_customer_username_prefix is in place", result.output)
+            self.assertEqual(db_mock.engine._run_ddl_visitor.call_count, 1)
+
+    @patch('service.common.cli_commands.CustomerTombstone')
+    def test_db_purge_tombstones(self, tombstone_mock):
+        """It should call the db-purge-tombstones command"""
+        tombstone_mock.purge.return_value = 3
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(db_purge_tombstones)
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("Purged 3 tombstones", result.output)
+            tombstone_mock.purge.assert_called_once()
+
+    @patch('service.common.cli_commands.cache.create_cache')
+    def test_cache_stats(self, create_mock):
+        """It should call the cache-stats command"""
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            create_mock.return_value = None
+            result = self.runner.invoke(cache_stats)
+            self.assertIn("disabled", result.output)
+
+            create_mock.return_value = MemoryCache()
+            create_mock.return_value.get("missing")
+            result = self.runner.invoke(cache_stats)
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("misses: 1", result.output)
+            self.assertIn("hit rate: 0.0%", result.output)
+
+    def test_db_statement_benchmark(self):
+        """It should call the db-statement-benchmark command"""
+        self.addCleanup(CustomerFactory.reset_sequence)
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True), app.app_context():
+            db.session.query(Customer).delete()
+            db.session.commit()
+            result = self.runner.invoke(db_statement_benchmark, ["--repeat", "2"])
+            self.assertIn("no customers", result.output)
+
+            customer = CustomerFactory()
+            customer.create()
+            result = self.runner.invoke(db_statement_benchmark, ["--repeat", "2"])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("update", result.output)
+            self.assertIn("compiled cache:", result.output)
+            self.assertEqual(Customer.find(customer.id).first_name, customer.first_name)
+            customer.delete()
+
+    def test_media_type_benchmark(self):
+        """It should call the media-type-benchmark command"""
+        self.addCleanup(CustomerFactory.reset_sequence)
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True), app.app_context():
+            db.session.query(Customer).delete()
+            db.session.commit()
+            result = self.runner.invoke(media_type_benchmark, ["--repeat", "2"])
+            self.assertIn("no customers", result.output)
+
+            customer = CustomerFactory()
+            customer.create()
+            result = self.runner.invoke(media_type_benchmark, ["--repeat", "2"])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("1 customers", result.output)
+            self.assertIn("application/json", result.output)
+            customer.delete()
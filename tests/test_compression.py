@@ -0,0 +1,143 @@
+"""
+Test cases for Response Compression and Static Assets
+"""
+import os
+import gzip
+import shutil
+import logging
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+from wsgi import app
+from service.common import status, assets, compression
+
+
+######################################################################
+#  C O M P R E S S I O N   T E S T   C A S E S
+######################################################################
+class TestCompression(TestCase):
+    """Response Compression Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.logger.setLevel(logging.CRITICAL)
+
+    def setUp(self):
+        """Runs before each test"""
+        self.client = app.test_client()
+        self.min_size = app.config["COMPRESS_MIN_SIZE"]
+        app.config["COMPRESS_MIN_SIZE"] = 0
+
+    def tearDown(self):
+        """Runs after each test"""
+        app.config["COMPRESS_MIN_SIZE"] = self.min_size
+        app.config["COMPRESS_ENABLED"] = True
+
+    def test_gzip_response(self):
+        """It should gzip a JSON response when the client accepts it"""
+        resp = self.client.get("/health", headers={"Accept-Encoding": "gzip, deflate"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        self.assertIn(b'"status"', gzip.decompress(resp.data))
+
+    def test_no_accept_encoding(self):
+        """It should not compress when the client does not accept it"""
+        resp = self.client.get("/health")
+        self.assertNotIn("Content-Encoding", resp.headers)
+        resp = self.client.get("/health", headers={"Accept-Encoding": "gzip;q=0"})
+        self.assertNotIn("Content-Encoding", resp.headers)
+
+    def test_below_threshold(self):
+        """It should not compress responses smaller than the threshold"""
+        app.config["COMPRESS_MIN_SIZE"] = 1024
+        resp = self.client.get("/health", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", resp.headers)
+
+    def test_compression_disabled(self):
+        """It should not compress when compression is disabled"""
+        app.config["COMPRESS_ENABLED"] = False
+        resp = self.client.get("/health", headers={"Accept-Encoding": "gzip"})
+        self.assertNotIn("Content-Encoding", resp.headers)
+
+    def test_brotli_preferred(self):
+        """It should prefer brotli when it is installed"""
+        mock_brotli = MagicMock()
+        mock_brotli.compress.return_value = b"brotli"
+        with patch.object(compression, "brotli", mock_brotli):
+            resp = self.client.get("/health", headers={"Accept-Encoding": "gzip, br"})
+        self.assertEqual(resp.headers["Content-Encoding"], "br")
+        self.assertEqual(resp.data, b"brotli")
+        mock_brotli.compress.assert_called_once()
+
+    def test_quality_order(self):
+        """It should choose the encoding with the highest q-value"""
+        with patch.object(compression, "brotli", MagicMock()):
+            resp = self.client.get("/health", headers={"Accept-Encoding": "br;q=0.1, gzip"})
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+            resp = self.client.get("/health", headers={"Accept-Encoding": "gzip;q=0.5, br;q=0"})
+            self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+
+
+######################################################################
+#  S T A T I C   A S S E T   T E S T   C A S E S
+######################################################################
+class TestAssets(TestCase):
+    """Static Asset Tests"""
+
+    def setUp(self):
+        """Builds the assets into a scratch static folder"""
+        self.client = app.test_client()
+        self.static_folder = app.static_folder
+        self.folder = tempfile.mkdtemp()
+        shutil.copytree(
+            os.path.join(self.static_folder, "js"), os.path.join(self.folder, "js")
+        )
+        self.manifest = assets.build_assets(self.folder)
+        app.static_folder = self.folder
+
+    def tearDown(self):
+        """Removes the scratch static folder"""
+        app.static_folder = self.static_folder
+        app.config["ASSET_MANIFEST"] = {}
+        shutil.rmtree(self.folder)
+
+    def test_build_assets(self):
+        """It should fingerprint and precompress the assets"""
+        fingerprinted = self.manifest["js/jquery-3.6.0.min.js"]
+        self.assertRegex(fingerprinted, r"^dist/jquery-3\.6\.0\.min\.[0-9a-f]{12}\.js$")
+        self.assertTrue(os.path.exists(os.path.join(self.folder, fingerprinted)))
+        self.assertTrue(os.path.exists(os.path.join(self.folder, fingerprinted + ".gz")))
+        self.assertEqual(assets.load_manifest(self.folder), self.manifest)
+        self.assertEqual(assets.load_manifest(tempfile.gettempdir() + "/missing"), {})
+
+    def test_serve_precompressed(self):
+        """It should serve the precompressed asset with a long-lived cache"""
+        url = "/static/" + self.manifest["js/bootstrap.min.js"]
+        resp = self.client.get(url, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(resp.mimetype, "text/javascript")
+        self.assertIn("immutable", resp.headers["Cache-Control"])
+        self.assertIn("max-age=31536000", resp.headers["Cache-Control"])
+        resp.close()
+
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertIn("immutable", resp.headers["Cache-Control"])
+        resp.close()
+
+        resp = self.client.get("/static/js/bootstrap.min.js")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotIn("immutable", resp.headers.get("Cache-Control", ""))
+        resp.close()
+
+    def test_index_uses_fingerprints(self):
+        """It should point the home page at the fingerprinted assets"""
+        app.config["ASSET_MANIFEST"] = self.manifest
+        resp = self.client.get("/")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn(self.manifest["js/rest_api.js"], resp.get_data(as_text=True))
@@ -0,0 +1,151 @@
+"""
+Test cases for the Customer Event Stream
+"""
+import json
+from unittest import TestCase
+from unittest.mock import MagicMock, patch
+from wsgi import app
+from service.common import event_stream
+from service.common.event_stream import EventBroker, KEEP_ALIVE, format_event, relay
+from .customer_factory import CustomerFactory
+from .service_test_case import ServiceTestCase
+
+
+def parse(event):
+    """Returns the fields of an encoded event"""
+    fields = dict(line.split(": ", 1) for line in event.strip().split("\n"))
+    fields["data"] = json.loads(fields["data"])
+    return fields
+
+
+class TestEventBroker(TestCase):
+    """Event Broker Tests"""
+
+    def setUp(self):
+        """Creates a broker with a small buffer and small client queues"""
+        self.broker = EventBroker(buffer_size=3, queue_size=2, max_clients=2)
+
+    def test_format_event(self):
+        """It should encode an event on one data line"""
+        self.assertEqual(
+            format_event("a-1", "update", {"id": 1, "address": "1\n2"}),
+            'id: a-1\nevent: update\ndata: {"id":1,"address":"1\\n2"}\n\n',
+        )
+        self.assertTrue(format_event(None, "dropped", {}).startswith("event: dropped"))
+
+    def test_publish(self):
+        """It should queue every event for every client without the password"""
+        first, _ = self.broker.subscribe()
+        second, _ = self.broker.subscribe()
+        self.broker.publish("create", {"id": 1, "password": "hash"})
+        for subscriber in (first, second):
+            event = parse(subscriber.queue.get_nowait())
+            self.assertEqual(event["id"], f"{self.broker.epoch}-1")
+            self.assertEqual(event["event"], "create")
+            self.assertEqual(event["data"], {"id": 1})
+
+    def test_max_clients(self):
+        """It should refuse clients over the limit until one disconnects"""
+        first, _ = self.broker.subscribe()
+        self.broker.subscribe()
+        self.assertEqual(self.broker.subscribe(), (None, None))
+        self.broker.unsubscribe(first)
+        self.assertEqual(self.broker.clients, 1)
+        self.assertIsNotNone(self.broker.subscribe()[0])
+
+    def test_drop_slow_client(self):
+        """It should drop a client whose queue is full instead of waiting"""
+        subscriber, _ = self.broker.subscribe()
+        for customer_id in range(3):
+            self.broker.publish("update", {"id": customer_id})
+        self.assertTrue(subscriber.dropped)
+        self.assertEqual((self.broker.dropped, self.broker.clients), (1, 0))
+        events = list(self.broker.stream(subscriber, [], heartbeat=1, max_duration=1))
+        self.assertEqual(parse(events[-1])["event"], "dropped")
+
+    def test_resume(self):
+        """It should send the buffered events after the Last-Event-ID"""
+        for customer_id in range(1, 5):
+            self.broker.publish("update", {"id": customer_id})
+        epoch = self.broker.epoch
+        _, backlog = self.broker.subscribe(f"{epoch}-2")
+        self.assertEqual([parse(event)["data"]["id"] for event in backlog], [3, 4])
+        _, backlog = self.broker.subscribe(f"{epoch}-4")
+        self.assertEqual(backlog, [])
+
+    def test_reset(self):
+        """It should send a reset event when the missed events are not buffered"""
+        for customer_id in range(1, 6):
+            self.broker.publish("delete", {"id": customer_id})
+        epoch = self.broker.epoch
+        for last_event_id in [f"{epoch}-1", f"{epoch}-9", "other-3", "garbage"]:
+            subscriber, backlog = self.broker.subscribe(last_event_id)
+            self.broker.unsubscribe(subscriber)
+            event = parse(backlog[0])
+            self.assertEqual((event["event"], event["id"]), ("reset", f"{epoch}-5"))
+
+    def test_stream(self):
+        """It should send the backlog, the events and keep-alives until the stream expires"""
+        subscriber, _ = self.broker.subscribe()
+        self.broker.publish("activate", {"id": 1})
+        events = list(self.broker.stream(subscriber, ["backlog"], heartbeat=0.01, max_duration=0.05))
+        self.assertEqual(events[0], "retry: 3000\n\n")
+        self.assertEqual(events[1], "backlog")
+        self.assertEqual(parse(events[2])["event"], "activate")
+        self.assertIn(KEEP_ALIVE, events[3:])
+        self.assertEqual(self.broker.clients, 0)
+
+    def test_first_client(self):
+        """It should call on_first_client when the first client connects, once"""
+        on_first_client = MagicMock()
+        broker = EventBroker(buffer_size=3, queue_size=2, max_clients=2, on_first_client=on_first_client)
+        first, _ = broker.subscribe()
+        broker.unsubscribe(first)
+        broker.subscribe()
+        on_first_client.assert_called_once_with()
+
+
+class TestEventRelay(ServiceTestCase):
+    """Event Relay Tests"""
+
+    def setUp(self):
+        """Creates a broker with a client"""
+        super().setUp()
+        CustomerFactory.reset_sequence()
+        self.broker = EventBroker(buffer_size=10, queue_size=10, max_clients=1)
+        self.subscriber, _ = self.broker.subscribe()
+
+    def _events(self):
+        """Returns the events queued for the client"""
+        events = []
+        while not self.subscriber.queue.empty():
+            events.append(parse(self.subscriber.queue.get_nowait()))
+        return [(event["event"], event["data"]) for event in events]
+
+    def test_relay(self):
+        """It should publish the writes of other processes with the customer read back"""
+        customer = CustomerFactory()
+        customer.create()
+        relay(app, self.broker, "update", customer.id)
+        relay(app, self.broker, "update", 0)
+        relay(app, self.broker, "delete", 0)
+        relay(app, self.broker, "reset", None)
+        data = customer.serialize()
+        del data["password"]
+        events = self._events()
+        self.assertEqual(events[:2], [("update", data), ("delete", {"id": 0})])
+        self.assertEqual(events[2][0], "reset")
+
+    @patch("service.common.event_stream.add_write_listener")
+    @patch("service.common.event_stream.invalidation.subscribe")
+    def test_relay_other_processes(self, subscribe_mock, _):
+        """It should start relaying the writes of other processes with the first client"""
+        broker = app.extensions["event_stream"]
+        try:
+            event_stream.init_event_stream(app)
+            subscriber, _ = app.extensions["event_stream"].subscribe()
+        finally:
+            app.extensions["event_stream"] = broker
+        subscribe_mock.assert_called_once()
+        subscribe_mock.call_args[0][1]("delete", 7)
+        self.assertEqual(parse(subscriber.queue.get_nowait())["data"], {"id": 7})
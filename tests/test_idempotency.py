@@ -0,0 +1,136 @@
+"""
+Test cases for Idempotency Keys
+"""
+import time
+from unittest import skipUnless
+from unittest.mock import patch
+from werkzeug.exceptions import InternalServerError
+from wsgi import app
+from service.common import status, media_types
+from service.models import db, Customer, IdempotencyRecord
+from .customer_factory import CustomerFactory
+from .service_test_case import ServiceTestCase
+from .test_routes import count_statements
+
+BASE_URL = "/api/customers"
+
+
+class TestIdempotencyKeys(ServiceTestCase):
+    """Idempotency Key Tests"""
+
+    models = [Customer, IdempotencyRecord]
+
+    def _post(self, data, key="key-1"):
+        """Posts a customer with an Idempotency-Key"""
+        return self.client.post(BASE_URL, json=data, headers={"Idempotency-Key": key})
+
+    def test_retried_create(self):
+        """It should answer a retried create with the stored response"""
+        data = CustomerFactory().serialize()
+        first = self._post(data)
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        with patch("service.routes.Customer.create") as create, count_statements() as statements:
+            retry = self._post(data)
+        create.assert_not_called()
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry.get_json(), first.get_json())
+        self.assertEqual(retry.headers["Location"], first.headers["Location"])
+        self.assertEqual(retry.headers["Idempotent-Replayed"], "true")
+        self.assertNotIn("Idempotent-Replayed", first.headers)
+        self.assertEqual(len(Customer.all()), 1)
+        # another key is another request
+        self.assertEqual(self._post(data, "key-2").status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_retried_update(self):
+        """It should answer retried updates and activations"""
+        customer = CustomerFactory()
+        customer.create()
+        data = customer.serialize()
+        data["first_name"] = "Changed"
+        headers = {"Idempotency-Key": "update-1"}
+        first = self.client.put(f"{BASE_URL}/{customer.id}", json=data, headers=headers)
+        retry = self.client.put(f"{BASE_URL}/{customer.id}", json=data, headers=headers)
+        self.assertEqual(retry.get_json(), first.get_json())
+        self.assertEqual(retry.headers["Idempotent-Replayed"], "true")
+        first = self.client.put(f"{BASE_URL}/{customer.id}/deactivate", headers=headers)
+        self.assertNotIn("Idempotent-Replayed", first.headers)
+        retry = self.client.put(f"{BASE_URL}/{customer.id}/deactivate", headers=headers)
+        self.assertEqual(retry.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(retry.headers["Idempotent-Replayed"], "true")
+
+    def test_key_reused_for_another_request(self):
+        """It should reject a key sent again with a different body"""
+        self._post(CustomerFactory().serialize())
+        response = self._post(CustomerFactory().serialize())
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    @skipUnless(media_types.CODECS, "no binary media type is installed")
+    def test_key_reused_for_another_media_type(self):
+        """It should reject a key sent again asking for another media type"""
+        data = CustomerFactory().serialize()
+        self._post(data)
+        mediatype = next(iter(media_types.CODECS))
+        response = self.client.post(BASE_URL, json=data, headers={"Idempotency-Key": "key-1", "Accept": mediatype})
+        self.assertEqual(response.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+        response = self.client.post(BASE_URL, json=data, headers={"Idempotency-Key": "key-1", "Accept": "*/*"})
+        self.assertEqual(response.headers["Idempotent-Replayed"], "true")
+
+    def test_request_in_progress(self):
+        """It should tell retries that the first request is still running"""
+        data = CustomerFactory().serialize()
+        with patch.object(IdempotencyRecord, "save", side_effect=RuntimeError("database is down")):
+            self.assertEqual(self._post(data).status_code, status.HTTP_201_CREATED)
+        response = self._post(data)
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        # the key is freed when its lock times out
+        later = time.time() + app.config["IDEMPOTENCY_LOCK_TIMEOUT"] + 1
+        with patch("service.common.idempotency.time.time", return_value=later):
+            response = self._post(data)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertNotIn("Idempotent-Replayed", response.headers)
+
+    def test_server_error(self):
+        """It should free the key of a request that failed on the server"""
+        data = CustomerFactory().serialize()
+        with patch("service.routes.Customer.create", side_effect=InternalServerError()):
+            response = self._post(data)
+        self.assertEqual(response.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        self.assertEqual(self._post(data).status_code, status.HTTP_201_CREATED)
+
+    def test_expired_responses(self):
+        """It should forget responses after the TTL"""
+        data = CustomerFactory().serialize()
+        self._post(data)
+        later = time.time() + app.config["IDEMPOTENCY_TTL"] + 1
+        self.assertEqual(IdempotencyRecord.purge(time.time()), 0)
+        self.assertEqual(IdempotencyRecord.purge(later), 1)
+        self.assertEqual(self._post(data).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_purge_periodically(self):
+        """It should purge expired responses every so many saves"""
+        app.config["IDEMPOTENCY_PURGE_EVERY"] = 1
+        try:
+            with patch.object(IdempotencyRecord, "purge") as purge:
+                self._post(CustomerFactory().serialize())
+            purge.assert_called_once()
+        finally:
+            app.config["IDEMPOTENCY_PURGE_EVERY"] = 100
+
+    def test_ignored_keys(self):
+        """It should only use keys on idempotent endpoints when enabled"""
+        headers = {"Idempotency-Key": "key-1"}
+        response = self.client.post(f"{BASE_URL}:batchGet", json={"ids": [1]}, headers=headers)
+        self.assertNotIn("Idempotent-Replayed", response.headers)
+        app.config["IDEMPOTENCY_ENABLED"] = False
+        try:
+            self._post(CustomerFactory().serialize())
+        finally:
+            app.config["IDEMPOTENCY_ENABLED"] = True
+        self.assertEqual(db.session.query(IdempotencyRecord).count(), 0)
+
+    def test_bad_key(self):
+        """It should reject keys that are empty or too long"""
+        for key in ["", "k" * 256]:
+            response = self._post(CustomerFactory().serialize(), key)
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,115 @@
+"""
+Test cases for Index Advice
+"""
+import os
+from unittest.mock import patch
+from click.testing import CliRunner
+from wsgi import app  # noqa: F401 pylint: disable=unused-import
+from service.models import db, Customer
+from service.common import index_advice
+from service.common.cli_commands import db_index_advice
+from .customer_factory import CustomerFactory
+from .service_test_case import ServiceTestCase
+
+POSTGRES_PLAN = {
+    "Node Type": "Limit",
+    "Plans": [
+        {
+            "Node Type": "Bitmap Heap Scan",
+            "Relation Name": "customer",
+            "Plans": [{"Node Type": "Bitmap Index Scan", "Index Name": "ix_customer_gender_active"}],
+        },
+        {"Node Type": "Seq Scan", "Relation Name": "customer"},
+    ],
+}
+
+
+class TestIndexAdvice(ServiceTestCase):
+    """Index Advice Tests"""
+
+    def setUp(self):
+        """Runs before each test"""
+        super().setUp()
+        self.runner = CliRunner()
+
+    @staticmethod
+    def _create_customers(count):
+        """Saves customers to the database"""
+        for customer in CustomerFactory.build_batch(count):
+            customer.create()
+
+    def test_declared_indexes_exist(self):
+        """It should find every declared index, expression indexes included"""
+        self.assertEqual(index_advice.missing_indexes(), [])
+        existing = index_advice.existing_indexes()
+        self.assertIn("ix_customer_username_prefix", existing)
+        self.assertIn("ix_customer_active_gender_last_name", existing)
+
+    def test_explain(self):
+        """It should report whether a plan scans the customer table"""
+        steps, scan = index_advice.explain(db.select(Customer).where(Customer.address == "x"))
+        self.assertTrue(scan)
+        self.assertTrue(steps)
+        # whether an index is used depends on the data, so the plan is given
+        if db.engine.dialect.name == "postgresql":
+            plan = [{"Plan": {"Node Type": "Index Scan", "Index Name": "customer_pkey", "Relation Name": "customer"}}]
+        else:
+            plan = ["SEARCH customer USING INTEGER PRIMARY KEY (rowid=?)"]
+        with patch("service.common.index_advice.capture_plan", return_value=plan):
+            _, scan = index_advice.explain(db.select(Customer).where(Customer.id == 1))
+        self.assertFalse(scan)
+
+    def test_postgres_steps(self):
+        """It should flatten a Postgres JSON plan"""
+        self.assertEqual(
+            index_advice._postgres_steps(POSTGRES_PLAN),  # pylint: disable=protected-access
+            [
+                "Limit",
+                "Bitmap Heap Scan on customer",
+                "Bitmap Index Scan using ix_customer_gender_active",
+                "Seq Scan on customer",
+            ],
+        )
+
+    def test_advise(self):
+        """It should explain every query shape"""
+        self.assertIsNone(index_advice.sample_values())
+        self._create_customers(3)
+        values = index_advice.sample_values()
+        self.assertEqual(len(values["ids"].split(",")), 3)
+        # the advice follows the verdict of the plan, which depends on the data
+        with patch("service.common.index_advice.missing_indexes", return_value=["ix_customer_email"]), \
+                patch("service.common.index_advice.explain", return_value=(["Seq Scan on customer"], True)):
+            results = index_advice.advise(lambda args: Customer.query.filter_by(active=True), values)
+        self.assertEqual(len(results), len(index_advice.QUERY_SHAPES))
+        substring = results[-1]
+        self.assertTrue(substring.sequential_scan)
+        self.assertEqual(substring.advice, index_advice.SUBSTRING_ADVICE)
+        self.assertIn("db-indexes", results[0].advice)
+        with patch("service.common.index_advice.explain", return_value=(["Seq Scan on customer"], True)):
+            results = index_advice.advise(lambda args: Customer.query.filter_by(active=True), values)
+        self.assertEqual(results[0].advice, "no index suits this filter on the current data")
+        with patch("service.common.index_advice.explain", return_value=(["Index Scan on customer"], False)):
+            results = index_advice.advise(lambda args: Customer.query.filter_by(active=True), values)
+        self.assertEqual({result.advice for result in results}, {""})
+
+    def test_db_index_advice(self):
+        """It should print the plan of every query shape"""
+        with patch.dict(os.environ, {"FLASK_APP": "wsgi:app"}, clear=True):
+            result = self.runner.invoke(db_index_advice)
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("no customers", result.output)
+
+            self._create_customers(3)
+            result = self.runner.invoke(db_index_advice)
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("customer has 3 rows", result.output)
+            # the planner's choices depend on the data, every shape gets a verdict
+            verdicts = [line.split(None, 1) for line in result.output.splitlines() if line[:1].isupper()]
+            shapes = [shape for shape, _ in index_advice.QUERY_SHAPES]
+            self.assertEqual([rest.split(":")[0] for verdict, rest in verdicts if verdict in ("OK", "SCAN")], shapes)
+            self.assertRegex(result.output, rf"\n\d+ of {len(shapes)} queries scan the customer table")
+
+            with patch("service.common.index_advice.missing_indexes", return_value=["ix_customer_email"]):
+                result = self.runner.invoke(db_index_advice)
+            self.assertIn("Missing indexes: ix_customer_email", result.output)
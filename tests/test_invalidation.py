@@ -0,0 +1,192 @@
+"""
+Test cases for Cache Invalidation
+"""
+import os
+import json
+import time
+import logging
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+from wsgi import app
+from service.models import db, Customer, announce_writes, announcement
+from service.common import invalidation
+from service.common.invalidation import InvalidationBus, psycopg
+from .customer_factory import CustomerFactory
+from .service_test_case import ServiceTestCase
+
+
+class FakeConnection:
+    """A psycopg connection that delivers one notification and then drops"""
+
+    def __init__(self, bus, payloads):
+        self.bus = bus
+        self.payloads = payloads
+        self.handlers = []
+        self.queries = []
+        self.read, self.write = os.pipe()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        os.close(self.read)
+        os.close(self.write)
+
+    def fileno(self):
+        """Returns a descriptor that never becomes readable"""
+        return self.read
+
+    def add_notify_handler(self, handler):
+        """Keeps the notification handler"""
+        self.handlers.append(handler)
+
+    def execute(self, query):
+        """Delivers the next notification, or drops when there are none left"""
+        self.queries.append(query)
+        if query != "SELECT 1":
+            return
+        if not self.payloads:
+            raise ConnectionError("server closed the connection")
+        for handler in self.handlers:
+            handler(MagicMock(payload=self.payloads.pop(0)))
+
+
+class TestInvalidationBus(TestCase):
+    """Invalidation Bus Tests"""
+
+    def setUp(self):
+        """Creates a bus that records what its handler is called with"""
+        logging.getLogger("flask.app").setLevel(logging.CRITICAL)
+        self.bus = InvalidationBus("customer_writes", heartbeat=0.001, retry=0)
+        self.calls = []
+        self.bus.subscribe(lambda action, customer_id: self.calls.append((action, customer_id)))
+
+    def _payload(self, action, customer_id, origin="other"):
+        return json.dumps({"origin": origin, "action": action, "id": customer_id})
+
+    def test_receive(self):
+        """It should hand the writes of other processes to the handlers"""
+        self.bus.subscribe(MagicMock(side_effect=RuntimeError("handler failed")))
+        self.bus.receive(self._payload("update", 7))
+        self.bus.receive(self._payload("delete", 8, origin=self.bus.origin))
+        self.assertEqual(self.calls, [("update", 7)])
+        self.assertEqual(self.bus.received, 1)
+
+    def test_listen(self):
+        """It should reconnect when the connection drops and reset the handlers"""
+        connections = []
+
+        def connect():
+            if len(connections) == 2:
+                self.bus.stop()
+                raise ConnectionError("could not connect")
+            connections.append(FakeConnection(self.bus, [self._payload("update", len(connections))]))
+            return connections[-1]
+
+        self.bus.listen(connect)
+        self.assertEqual(self.calls, [("update", 0), ("reset", None), ("update", 1)])
+        self.assertFalse(self.bus.connected)
+        self.assertIn("LISTEN", repr(connections[0].queries[0]))
+
+    def test_start(self):
+        """It should listen in a background thread until stopped"""
+        connect = MagicMock(side_effect=ConnectionError("could not connect"))
+        self.bus.retry = 60
+        thread = self.bus.start(connect)
+        self.bus.stop()
+        thread.join()
+        connect.assert_called_once()
+
+
+class TestInvalidationSetup(TestCase):
+    """Invalidation Setup Tests"""
+
+    def tearDown(self):
+        """Removes the bus from the app"""
+        app.extensions.pop("invalidation", None)
+
+    def test_disabled(self):
+        """It should not listen when disabled and keep the caches' TTLs"""
+        with patch.dict(app.config, {"INVALIDATION_ENABLED": False}):
+            invalidation.init_invalidation(app)
+        self.assertNotIn("invalidation", app.extensions)
+        invalidation.subscribe(app, print)
+        self.assertEqual(invalidation.ttl(app, 600), 600)
+
+    def test_idle_without_subscribers(self):
+        """It should only prepare the bus, on Postgres, until a cache subscribes"""
+        invalidation.init_invalidation(app)
+        bus = app.extensions.get("invalidation")
+        postgres = db.engine.dialect.name == "postgresql" and psycopg is not None
+        self.assertEqual(bus is not None, postgres)
+        if bus is not None:
+            self.assertIsNone(bus.thread)
+
+    @patch("service.common.invalidation.announce_writes")
+    def test_first_subscriber(self, announce_mock):
+        """It should announce the writes and listen once a cache subscribes"""
+        connect = MagicMock(side_effect=ConnectionError("could not connect"))
+        bus = app.extensions["invalidation"] = InvalidationBus("customer_writes", 1, 60, connect)
+        invalidation.subscribe(app, print)
+        invalidation.subscribe(app, repr)
+        bus.stop()
+        bus.thread.join()
+        announce_mock.assert_called_once_with("customer_writes", bus.origin)
+        connect.assert_called_once()
+
+    def test_ttl(self):
+        """It should shorten the TTLs while invalidations are not received"""
+        bus = app.extensions["invalidation"] = InvalidationBus("customer_writes", 1, 1)
+        self.assertEqual(invalidation.ttl(app, 600), app.config["INVALIDATION_FALLBACK_TTL"])
+        bus.connected = True
+        self.assertEqual(invalidation.ttl(app, 600), 600)
+
+
+class TestWriteAnnouncement(ServiceTestCase):
+    """Write Announcement Tests"""
+
+    def setUp(self):
+        """Announces the writes on a test channel"""
+        super().setUp()
+        CustomerFactory.reset_sequence()
+        announce_writes("customer_writes_test", "test")
+
+    def tearDown(self):
+        """Stops announcing the writes"""
+        announce_writes(None, None)
+        super().tearDown()
+
+    def _write(self):
+        """Creates, updates, deactivates and deletes a customer"""
+        customer = CustomerFactory()
+        customer.create()
+        customer.first_name = "Announced"
+        customer.update()
+        Customer.set_active(customer.id, False)
+        Customer.delete_by_id(customer.id)
+        return customer.id
+
+    def test_announce_writes(self):
+        """It should NOTIFY each write from the write's own statement on Postgres"""
+        if db.engine.dialect.name != "postgresql":
+            self.assertIsNone(announcement(Customer.id))
+            self.assertIsNone(Customer.find(self._write()))
+            return
+        url = db.engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+        payloads = []
+        with psycopg.connect(url, autocommit=True) as connection:
+            connection.add_notify_handler(lambda notify: payloads.append(json.loads(notify.payload)))
+            connection.execute("LISTEN customer_writes_test")
+            customer_id = self._write()
+            for _ in range(50):
+                connection.execute("SELECT 1")
+                if len(payloads) == 4:
+                    break
+                time.sleep(0.02)
+        self.assertEqual(
+            payloads,
+            [
+                {"origin": "test", "action": action, "id": customer_id}
+                for action in ("create", "update", "deactivate", "delete")
+            ],
+        )
@@ -0,0 +1,177 @@
+"""
+Test cases for the In-process Inverted Index
+"""
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+from wsgi import app
+from service import models, routes
+from service.common.inverted_index import InvertedIndex, StreamedIndex, init_search_index, refresh_interval
+from service.common.invalidation import InvalidationBus
+
+
+class TestInvertedIndex(TestCase):
+    """Inverted Index Tests"""
+
+    def setUp(self):
+        """Creates an index over two fields"""
+        self.index = InvertedIndex(("username", "email"))
+
+    def test_grams(self):
+        """It should split lowercased values into n-grams"""
+        self.assertEqual(self.index.grams("Abcd"), {"abc", "bcd"})
+        self.assertEqual(self.index.grams("ab"), set())
+        self.assertEqual(self.index.grams(None), set())
+
+    def test_candidates(self):
+        """It should intersect the posting lists of the n-grams"""
+        self.index.add(3, {"username": "johnsmith", "email": "js@example.com"})
+        self.index.add(1, {"username": "smithers", "email": "sm@example.com"})
+        self.index.add(2, {"username": "janedoe", "email": "jd@example.com"})
+        self.assertEqual(self.index.candidates("username", "SMITH"), [1, 3])
+        self.assertEqual(self.index.candidates("username", "doe"), [2])
+        self.assertEqual(self.index.candidates("email", "example"), [1, 2, 3])
+        self.assertEqual(self.index.candidates("username", "xyz"), [])
+        self.assertIsNone(self.index.candidates("username", "sm"))
+
+    def test_update_and_remove(self):
+        """It should replace and remove the postings of a customer"""
+        self.index.add(1, {"username": "johnsmith", "email": None})
+        self.index.add(1, {"username": "janedoe", "email": None})
+        self.assertEqual(self.index.candidates("username", "smith"), [])
+        self.assertEqual(self.index.candidates("username", "doe"), [1])
+        self.index.remove(1)
+        self.index.remove(1)
+        self.assertEqual(self.index.candidates("username", "doe"), [])
+        self.assertEqual(self.index.stats()["grams"], 0)
+
+    def test_load(self):
+        """It should rebuild from streamed rows and replay concurrent writes"""
+        self.index.add(9, {"username": "stale", "email": None})
+
+        def rows():
+            yield (1, "johnsmith", "js@example.com")
+            # writes made while the table is streamed
+            self.index.add(5, {"username": "newsmith", "email": None})
+            self.index.remove(1)
+            yield (2, "janedoe", "jd@example.com")
+
+        self.index.load(rows())
+        self.assertEqual(self.index.candidates("username", "smith"), [5])
+        self.assertEqual(self.index.candidates("username", "stale"), [])
+        self.assertEqual(self.index.candidates("email", "jd@"), [2])
+
+    def test_stats(self):
+        """It should report its size and memory use"""
+        self.index.add(1, {"username": "abcd", "email": None})
+        stats = self.index.stats()
+        self.assertEqual(stats["customers"], 1)
+        self.assertEqual(stats["grams"], 2)
+        self.assertEqual(stats["postings"], 2)
+        self.assertGreater(stats["bytes"], 0)
+
+    def test_abstract_base(self):
+        """It should refuse to create an index that does not keep structures"""
+
+        class Unfinished(StreamedIndex):  # pylint: disable=abstract-method
+            """An index that forgot _unindex"""
+
+            def _empty(self):
+                return Unfinished(self.fields)
+
+            def _index(self, customer_id, document):
+                pass
+
+        self.assertRaises(TypeError, Unfinished, ("username",))
+
+
+class TestSearchIndexSetup(TestCase):
+    """Search Index Setup Tests"""
+
+    def setUp(self):
+        """Enables the index on the app"""
+        app.config["SEARCH_INDEX_ENABLED"] = True
+        app.config["SEARCH_INDEX_REFRESH"] = 0
+        app.logger.setLevel(logging.CRITICAL)
+        self.listeners = list(models.write_listeners)
+
+    def tearDown(self):
+        """Removes the index from the app"""
+        app.config["SEARCH_INDEX_ENABLED"] = False
+        app.extensions.pop("search_index", None)
+        app.extensions.pop("invalidation", None)
+        del models.write_listeners[len(self.listeners):]
+
+    def test_init_search_index(self):
+        """It should build the index and follow the model's writes"""
+        init_search_index(app)
+        index = app.extensions["search_index"]
+        models.notify_write("update", {"id": 7, "username": "johnsmith"})
+        self.assertEqual(index.candidates("username", "smith"), [7])
+        models.notify_write("delete", {"id": 7})
+        self.assertEqual(index.candidates("username", "smith"), [])
+
+    def test_max_candidates(self):
+        """It should leave out the id filter when too many customers match"""
+        index = app.extensions["search_index"] = InvertedIndex(("username",))
+        for customer_id in range(1, 4):
+            index.add(customer_id, {"username": f"smith{customer_id}"})
+        with app.app_context():
+            self.assertEqual(len(routes.fuzzy_match("username", "smith")), 2)
+            with patch.dict(app.config, {"SEARCH_INDEX_MAX_CANDIDATES": 2}):
+                self.assertEqual(len(routes.fuzzy_match("username", "smith")), 1)
+
+    def test_disabled(self):
+        """It should not build the index unless it is enabled"""
+        app.config["SEARCH_INDEX_ENABLED"] = False
+        init_search_index(app)
+        self.assertNotIn("search_index", app.extensions)
+
+    @patch("service.common.inverted_index.threading.Timer")
+    @patch("service.common.inverted_index.build_index")
+    def test_refresh(self, build_index, timer):
+        """It should rebuild the index periodically and survive failures"""
+        app.config["SEARCH_INDEX_REFRESH"] = 60
+        init_search_index(app)
+        # without invalidations the other processes' writes wait for a rebuild
+        self.assertEqual(timer.call_args[0][0], app.config["INVALIDATION_FALLBACK_TTL"])
+        bus = app.extensions["invalidation"] = InvalidationBus("customer_writes", 1, 1)
+        bus.connected = True
+        self.assertEqual(refresh_interval(app, 60), 60)
+        build_index.side_effect = RuntimeError("database is down")
+        refresh = timer.call_args[0][1]
+        refresh()
+        self.assertEqual(build_index.call_count, 2)
+        self.assertEqual(timer.call_count, 2)
+
+    @patch("service.common.inverted_index.threading.Timer")
+    @patch("service.common.inverted_index.build_index")
+    def test_invalidations(self, build_index, timer):
+        """It should reload the customers other processes write and refresh sooner without invalidations"""
+        bus = app.extensions["invalidation"] = InvalidationBus("customer_writes", 1, 1)
+        app.config["SEARCH_INDEX_REFRESH"] = 600
+        init_search_index(app)
+        self.assertEqual(timer.call_args[0][0], app.config["INVALIDATION_FALLBACK_TTL"])
+        index = app.extensions["search_index"]
+
+        values = {
+            "username": "remotesmith", "password": "x", "first_name": "Remote", "last_name": "Smith",
+            "email": "remote@example.com", "address": "1 Main St", "active": True, "gender": models.Gender.UNKNOWN,
+        }
+        with app.app_context():
+            customer_id = models.db.session.execute(
+                models.db.insert(models.Customer).values(**values).returning(models.Customer.id)
+            ).scalar_one()
+            models.db.session.commit()
+        bus.receive(f'{{"origin": "other", "action": "create", "id": {customer_id}}}')
+        self.assertEqual(index.candidates("username", "remotesmith"), [customer_id])
+        with app.app_context():
+            models.Customer.delete_by_id(customer_id)
+        self.assertEqual(index.candidates("username", "remotesmith"), [])
+        bus.receive(f'{{"origin": "other", "action": "delete", "id": {customer_id}}}')
+        self.assertEqual(index.candidates("username", "remotesmith"), [])
+        self.assertEqual(bus.received, 2)
+
+        bus.subscribe(lambda _action, _id: None)
+        bus._dispatch("reset", None)  # pylint: disable=protected-access
+        self.assertEqual(build_index.call_count, 2)
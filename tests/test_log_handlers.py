@@ -0,0 +1,119 @@
+"""
+Test cases for the Log Handlers
+"""
+import json
+import queue
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+from flask import Flask
+from service import config
+from service.common import log_handlers, request_timing
+
+
+class ListHandler(logging.Handler):
+    """Keeps the formatted records"""
+
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+
+def make_record(msg, *args, level=logging.INFO, **attributes):
+    """Makes a log record"""
+    record = logging.LogRecord("service", level, __file__, 1, msg, args, None)
+    record.__dict__.update(attributes)
+    return record
+
+
+class TestLogHandlers(TestCase):
+    """Log Handler Tests"""
+
+    def setUp(self):
+        self.model_logger = logging.getLogger(log_handlers.MODEL_LOGGER)
+        self.saved = (self.model_logger.handlers, self.model_logger.propagate, self.model_logger.level)
+        self.gunicorn_logger = logging.getLogger("test.gunicorn")
+        self.gunicorn_logger.setLevel(logging.INFO)
+        self.output = ListHandler()
+        self.gunicorn_logger.handlers = [self.output]
+
+    def tearDown(self):
+        (self.model_logger.handlers, self.model_logger.propagate, self.model_logger.level) = self.saved
+
+    def _app(self, **settings):
+        """Makes an app with a route that logs"""
+        app = Flask("test")
+        app.config.from_object(config)
+        app.config.update(settings)
+
+        @app.route("/lookup")
+        def lookup():
+            logging.getLogger(log_handlers.MODEL_LOGGER).info("Processing lookup for %s ...", 1)
+            app.logger.warning("Looked up")
+            return "", 204
+
+        app.before_request(request_timing.start_request)
+        log_handlers.init_logging(app, "test.gunicorn")
+        return app
+
+    def test_json_formatter(self):
+        """It should format records as JSON with their request context"""
+        formatter = log_handlers.JsonFormatter()
+        entry = json.loads(formatter.format(make_record("Hello %s", "you", request_id="abc", status=200)))
+        self.assertEqual(entry["message"], "Hello you")
+        self.assertEqual(entry["level"], "INFO")
+        self.assertEqual(entry["request_id"], "abc")
+        self.assertEqual(entry["status"], 200)
+        self.assertNotIn("db_ms", entry)
+        try:
+            raise ValueError("boom")
+        except ValueError as error:
+            record = make_record("Failed", level=logging.ERROR, exc_info=(ValueError, error, error.__traceback__))
+            self.assertIn("ValueError: boom", json.loads(formatter.format(record))["exception"])
+
+    def test_sampling_filter(self):
+        """It should keep a fraction of the sampled INFO records only"""
+        sampling = log_handlers.SamplingFilter({"Processing lookup": 0.1})
+        with patch("service.common.log_handlers.random.random", return_value=0.5):
+            self.assertFalse(sampling.filter(make_record("Processing lookup for %s", 1)))
+            self.assertTrue(sampling.filter(make_record("Processing lookup", level=logging.ERROR)))
+            self.assertTrue(sampling.filter(make_record("Something else")))
+        with patch("service.common.log_handlers.random.random", return_value=0.05):
+            self.assertTrue(sampling.filter(make_record("Processing lookup for %s", 1)))
+
+    def test_queue_handler(self):
+        """It should render records for the queue and drop them when it is full"""
+        handler = log_handlers.NonBlockingQueueHandler(queue.Queue(1))
+        handler.handle(make_record("Hello %s", "you"))
+        handler.handle(make_record("Dropped"))
+        self.assertEqual(handler.dropped, 1)
+        record = handler.queue.get_nowait()
+        self.assertEqual((record.msg, record.args), ("Hello you", None))
+
+    def test_async_json_logging(self):
+        """It should log requests as JSON through the background listener"""
+        app = self._app(LOG_SAMPLE_RATES={"Processing lookup": 0.0}, REQUEST_TIMING_SAMPLE_RATE=1.0)
+        response = app.test_client().get("/lookup")
+        self.assertEqual(response.status_code, 204)
+        app.logger.handlers[0].queue.join()
+        entries = [json.loads(line) for line in self.output.lines]
+        messages = [entry["message"] for entry in entries]
+        self.assertEqual(messages, ["Logging handler established", "Looked up", "Request finished"])
+        looked_up, finished = entries[1:]
+        self.assertEqual(looked_up["route"], "lookup")
+        self.assertEqual(looked_up["request_id"], finished["request_id"])
+        self.assertEqual(finished["status"], 204)
+        self.assertIn("latency_ms", finished)
+        self.assertEqual(finished["db_ms"], 0.0)
+        self.assertIn("total", finished["timings"])
+
+    def test_text_logging(self):
+        """It should log text synchronously when asked to"""
+        app = self._app(LOG_FORMAT="text", LOG_ASYNC=False, LOG_SAMPLE_RATES={})
+        app.test_client().get("/lookup")
+        self.assertEqual(app.logger.handlers, [self.output])
+        self.assertIn("[INFO] [log_handlers] Logging handler established", self.output.lines[0])
+        self.assertTrue(any("Processing lookup for 1" in line for line in self.output.lines))
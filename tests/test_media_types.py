@@ -0,0 +1,103 @@
+"""
+Test cases for the Binary Media Types
+"""
+from datetime import datetime, timezone
+from unittest import skipUnless
+from unittest.mock import patch, MagicMock
+from wsgi import app
+from service.common import status, media_types
+from service.common.media_types import CBOR, MSGPACK
+from .customer_factory import CustomerFactory
+from .service_test_case import ServiceTestCase
+
+BASE_URL = "/api/customers"
+
+
+@skipUnless(media_types.msgpack and media_types.cbor2, "msgpack and cbor2 are not installed")
+class TestMediaTypes(ServiceTestCase):
+    """Binary Media Type Tests"""
+
+    def _post(self, mediatype, data):
+        """Posts a customer encoded in a media type and returns the response"""
+        return self.client.post(
+            BASE_URL,
+            data=media_types.CODECS[mediatype][0](data),
+            content_type=mediatype,
+            headers={"Accept": mediatype},
+        )
+
+    def test_read(self):
+        """It should answer in the media type of the Accept header"""
+        customer = CustomerFactory()
+        customer.create()
+        for mediatype in [MSGPACK, CBOR]:
+            response = self.client.get(f"{BASE_URL}/{customer.id}", headers={"Accept": mediatype})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.mimetype, mediatype)
+            self.assertIn("Accept", response.vary)
+            data = media_types.CODECS[mediatype][1](response.get_data())
+            self.assertEqual(data, self.client.get(f"{BASE_URL}/{customer.id}").get_json())
+
+        response = self.client.get(BASE_URL, headers={"Accept": f"application/json;q=0.5, {CBOR}"})
+        self.assertEqual(media_types.cbor2.loads(response.get_data())[0]["id"], customer.id)
+        response = self.client.get(f"{BASE_URL}/0", headers={"Accept": MSGPACK})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertIn("was not found", media_types.msgpack.unpackb(response.get_data())["message"])
+
+    def test_write(self):
+        """It should read the bodies of POST, PUT and PATCH in a binary media type"""
+        data = CustomerFactory().serialize()
+        response = self._post(MSGPACK, data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        created = media_types.msgpack.unpackb(response.get_data())
+        self.assertEqual(created["username"], data["username"])
+
+        url = f"{BASE_URL}/{created['id']}"
+        changed = dict(created, first_name="Binary")
+        response = self.client.put(url, data=media_types.cbor2.dumps(changed), content_type=CBOR)
+        self.assertEqual(response.get_json()["first_name"], "Binary")
+        response = self.client.patch(url, data=media_types.msgpack.packb({"last_name": "Packed"}), content_type=MSGPACK)
+        self.assertEqual(response.get_json()["last_name"], "Packed")
+        response = self.client.post(
+            f"{BASE_URL}:batchGet", data=media_types.cbor2.dumps({"ids": [created["id"]]}), content_type=CBOR
+        )
+        self.assertEqual(len(response.get_json()["customers"]), 1)
+
+    def test_bad_body(self):
+        """It should refuse bodies that do not decode and unknown Content-Types"""
+        response = self.client.post(BASE_URL, data=b"\xc1", content_type=MSGPACK)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(BASE_URL, data=b"\xff\xff", content_type=CBOR)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(BASE_URL, data=b"x", content_type="application/xml")
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        self.assertIn(f"application/json or {MSGPACK} or {CBOR}", response.get_json()["message"])
+
+    def test_non_json_values(self):
+        """It should refuse bodies with values JSON cannot hold"""
+        data = CustomerFactory().serialize()
+        response = self._post(MSGPACK, dict(data, username=b"raw"))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("type bytes", media_types.msgpack.unpackb(response.get_data())["message"])
+        response = self._post(CBOR, dict(data, first_name=datetime(2024, 1, 1, tzinfo=timezone.utc)))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("type datetime", media_types.cbor2.loads(response.get_data())["message"])
+        response = self._post(MSGPACK, {1: "one"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.patch(
+            f"{BASE_URL}/0", data=media_types.cbor2.dumps({"gender": [b"MALE"]}), content_type=CBOR
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_swagger(self):
+        """It should list the binary media types in the Swagger document"""
+        produces = self.client.get("/api/swagger.json").get_json()["produces"]
+        self.assertIn(MSGPACK, produces)
+        self.assertIn(CBOR, produces)
+
+    def test_init_without_codecs(self):
+        """It should only offer JSON when no binary library is installed"""
+        fake_api = MagicMock(representations={})
+        with patch.object(media_types, "CODECS", {}):
+            media_types.init_media_types(app, fake_api)
+        self.assertEqual(fake_api.representations, {})
@@ -0,0 +1,94 @@
+"""
+Test cases for Password Hashing
+"""
+import hashlib
+from unittest import TestCase
+from service.common import passwords
+from service.common.passwords import PasswordHasher, check_hash, make_hash, parse
+
+
+def reversed_hasher(password, salt, cost):
+    """A hash function that the worker processes can only get from their jobs"""
+    # pylint: disable=unused-argument
+    return password[::-1]
+
+
+class TestPasswordHashing(TestCase):
+    """Password Hashing Tests"""
+
+    def test_pbkdf2_hash(self):
+        """It should hash and verify a password with pbkdf2_sha256"""
+        hasher = PasswordHasher("pbkdf2_sha256", 1000)
+        encoded = hasher.hash("secret")
+        algorithm, cost, salt, digest = parse(encoded)
+        self.assertEqual((algorithm, cost), ("pbkdf2_sha256", 1000))
+        self.assertEqual(len(salt), 32)
+        self.assertEqual(len(digest), 64)
+        self.assertTrue(hasher.verify("secret", encoded))
+        self.assertFalse(hasher.verify("Secret", encoded))
+        # every hash gets its own salt
+        self.assertNotEqual(hasher.hash("secret"), encoded)
+
+    def test_scrypt_hash(self):
+        """It should hash and verify a password with scrypt"""
+        encoded = make_hash("secret", "scrypt", 4, "00" * 16)
+        self.assertTrue(encoded.startswith("scrypt$4$"))
+        self.assertTrue(check_hash("secret", encoded))
+        self.assertFalse(check_hash("other", encoded))
+
+    def test_legacy_hash(self):
+        """It should verify the plain SHA-256 hashes stored before"""
+        legacy = hashlib.sha256(b"secret").hexdigest()
+        self.assertTrue(passwords.is_hashed(legacy))
+        self.assertTrue(check_hash("secret", legacy))
+        self.assertFalse(check_hash("other", legacy))
+
+    def test_not_a_hash(self):
+        """It should not treat other values as hashes"""
+        for value in ["secret", "z" * 64, "pbkdf2_sha256$x$00$00", "md5$1$00$00", None]:
+            self.assertFalse(passwords.is_hashed(value))
+            self.assertFalse(check_hash("secret", value))
+
+    def test_needs_rehash(self):
+        """It should tell when a hash was made with other settings"""
+        hasher = PasswordHasher("pbkdf2_sha256", 1000)
+        self.assertFalse(hasher.needs_rehash(hasher.hash("secret")))
+        self.assertTrue(hasher.needs_rehash(make_hash("secret", "pbkdf2_sha256", 999, "00")))
+        self.assertTrue(hasher.needs_rehash(hashlib.sha256(b"secret").hexdigest()))
+
+    def test_register_hasher(self):
+        """It should use hash functions that are registered"""
+        passwords.register_hasher("test_plain", lambda password, salt, cost: password)
+        try:
+            hasher = PasswordHasher("test_plain", 1)
+            self.assertTrue(hasher.verify("secret", hasher.hash("secret")))
+        finally:
+            del passwords.HASHERS["test_plain"]
+        self.assertRaises(ValueError, passwords.register_hasher, "sha256", None)
+        self.assertRaises(ValueError, passwords.register_hasher, "a$b", None)
+        self.assertRaises(ValueError, PasswordHasher, "test_plain")
+
+    def test_worker_processes(self):
+        """It should hash passwords in worker processes"""
+        hasher = PasswordHasher("pbkdf2_sha256", 1000, workers=1, max_pending=2)
+        try:
+            encoded = hasher.hash("secret")
+            self.assertTrue(hasher.verify("secret", encoded))
+            self.assertIsNotNone(hasher._pool)
+        finally:
+            hasher.shutdown()
+        self.assertIsNone(hasher._pool)
+        hasher.shutdown()
+
+    def test_registered_hasher_in_workers(self):
+        """It should hash with a registered function in the worker processes"""
+        passwords.register_hasher("test_reversed", reversed_hasher)
+        hasher = PasswordHasher("test_reversed", 1, workers=1)
+        try:
+            encoded = hasher.hash("secret")
+            self.assertTrue(encoded.endswith(b"terces".hex()))
+            self.assertTrue(hasher.verify("secret", encoded))
+            self.assertFalse(hasher.verify("other", encoded))
+        finally:
+            hasher.shutdown()
+            del passwords.HASHERS["test_reversed"]
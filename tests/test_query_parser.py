@@ -0,0 +1,130 @@
+"""
+Test cases for the Query String Parser
+"""
+from datetime import datetime, timezone
+from unittest import TestCase
+from werkzeug.datastructures import MultiDict
+from sqlalchemy.dialects import postgresql
+from wsgi import app  # noqa: F401 pylint: disable=unused-import
+from service.models import Customer, Gender, DataValidationError
+from service.common import query_parser
+from service.common.query_parser import Condition, QueryParser
+
+
+def distance(value):
+    """The number of typos to accept"""
+    return int(value)
+
+
+PARSER = QueryParser(
+    {
+        "id": query_parser.number("id", batch=True),
+        "username": query_parser.text("username", batch=True),
+        "gender": query_parser.choice(Gender, "gender"),
+        "active": query_parser.boolean("active"),
+        "created": query_parser.timestamp("created"),
+    },
+    options={"distance": distance},
+)
+
+
+class TestQueryParser(TestCase):
+    """Query String Parser Tests"""
+
+    def parse(self, **args):
+        """Parses keyword arguments as a query string"""
+        return PARSER.parse(MultiDict(args))
+
+    def test_text_operators(self):
+        """It should pick exact, prefix and substring matching from the value"""
+        self.assertEqual(
+            self.parse(username='"al"').conditions, (Condition("username", "exact", "al"),)
+        )
+        self.assertEqual(
+            self.parse(username="al*").conditions, (Condition("username", "prefix", "al"),)
+        )
+        self.assertEqual(
+            self.parse(username="al").conditions, (Condition("username", "contains", "al"),)
+        )
+        self.assertEqual(
+            self.parse(username__in="bob,al").conditions,
+            (Condition("username", "in", ("al", "bob")),),
+        )
+
+    def test_ranges(self):
+        """It should convert range values"""
+        parsed = self.parse(
+            id__gte="10", id__lt="20", created__gt="2024-01-02T03:04:05", created__lt="2024-01-02T05:04:05+02:00"
+        )
+        self.assertEqual(
+            parsed.conditions,
+            (
+                Condition("created", "gt", datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc)),
+                Condition("created", "lt", datetime(2024, 1, 2, 3, 4, 5, tzinfo=timezone.utc)),
+                Condition("id", "gte", 10),
+                Condition("id", "lt", 20),
+            ),
+        )
+
+    def test_other_kinds(self):
+        """It should convert enum, boolean and option values"""
+        parsed = self.parse(gender__in="male,Female", active="0", distance="2")
+        self.assertEqual(
+            parsed.conditions,
+            (
+                Condition("active", "eq", False),
+                Condition("gender", "in", (Gender.FEMALE, Gender.MALE)),
+            ),
+        )
+        self.assertEqual(parsed.option("distance"), 2)
+        self.assertIsNone(self.parse().option("distance"))
+
+    def test_canonical_key(self):
+        """It should give equivalent query strings the same key"""
+        first = PARSER.parse(MultiDict([("id__gt", "1"), ("username__in", "b,a")]))
+        second = PARSER.parse(MultiDict([("username__in", "a,b"), ("id__gt", "01"), ("page", "2")]))
+        self.assertEqual(first.key, second.key)
+        self.assertEqual(hash(first.key), hash(second.key))
+
+    def test_bad_values(self):
+        """It should reject bad values and unknown operators"""
+        for args in [
+            {"id": "x"},
+            {"id__in": "1,x"},
+            {"gender": "other"},
+            {"active": "maybe"},
+            {"created__gt": "yesterday"},
+            {"id__contains": "1"},
+            {"username__gt": "a"},
+            {"distance": "x"},
+        ]:
+            self.assertRaises(DataValidationError, self.parse, **args)
+
+    def test_batch(self):
+        """It should keep the order of a batch of keys"""
+        parsed = self.parse(id="3,1,3,2")
+        self.assertEqual(parsed.conditions, (Condition("id", "batch", (3, 1, 2)),))
+        self.assertEqual(parsed.batch, parsed.conditions[0])
+        self.assertEqual(self.parse(id="3").batch, Condition("id", "batch", (3,)))
+        parsed = self.parse(username="bob,al")
+        self.assertEqual(parsed.batch, Condition("username", "batch", ("bob", "al")))
+        self.assertEqual(self.parse(username='"bob,al"').batch, None)
+        self.assertRaises(DataValidationError, self.parse, id="1,2", username="a,b")
+
+    def test_max_keys(self):
+        """It should limit the size of in lists and batches"""
+        self.assertEqual(len(PARSER.parse(MultiDict({"id": "1,2"}), max_keys=2).batch.value), 2)
+        for name in ["id", "id__in"]:
+            self.assertRaises(DataValidationError, PARSER.parse, MultiDict({name: "1,2,3"}), 2)
+
+    def test_prefix_sql(self):
+        """It should compile prefixes to a LIKE that an index can serve"""
+        criterion = PARSER.criterion(Customer, Condition("username", "prefix", "A_b%"))
+        sql = criterion.compile(dialect=postgresql.dialect())
+        self.assertEqual(str(sql), "lower(customer.username) LIKE %(lower_1)s ESCAPE '\\\\'")
+        self.assertEqual(sql.params, {"lower_1": "a\\_b\\%%"})
+
+    def test_doc(self):
+        """It should describe its parameters for Swagger"""
+        self.assertEqual(PARSER.doc()["username"], "username")
+        self.assertEqual(PARSER.doc()["distance"], "The number of typos to accept")
@@ -0,0 +1,67 @@
+"""
+Test cases for Query Plan Capture
+"""
+import json
+from unittest.mock import patch
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import OperationalError
+from wsgi import app
+from service.models import db, Customer
+from service.common import query_plans
+from .service_test_case import ServiceTestCase
+
+
+class TestQueryPlans(ServiceTestCase):
+    """Query Plan Capture Tests"""
+
+    def test_postgres_explain(self):
+        """It should EXPLAIN as JSON on Postgres, with ANALYZE and BUFFERS on demand"""
+        statement = db.select(Customer.id)
+        sql = str(query_plans.Explain(statement).compile(dialect=postgresql.dialect()))
+        self.assertTrue(sql.startswith("EXPLAIN (FORMAT JSON) SELECT"))
+        sql = str(query_plans.Explain(statement, analyze=True).compile(dialect=postgresql.dialect()))
+        self.assertTrue(sql.startswith("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) SELECT"))
+
+    def test_capture_plan(self):
+        """It should return the plan of the statement"""
+        plan = query_plans.capture_plan(db.select(Customer).where(Customer.id == 1))
+        # JSON nodes on Postgres, the steps on SQLite
+        self.assertIsInstance(plan, list)
+        self.assertIn("customer", json.dumps(plan))
+
+    def test_render_sql(self):
+        """It should render the SQL with its parameters"""
+        sql = query_plans.render_sql(db.select(Customer.id).where(Customer.username == "alice"))
+        self.assertIn("'alice'", sql)
+        # the % of a LIKE pattern is not escaped for the driver
+        sql = query_plans.render_sql(db.select(Customer.id).where(Customer.username.like("user18%")))
+        self.assertIn("LIKE 'user18%'", sql)
+        # an object without a literal form is shown as a parameter
+        sql = query_plans.render_sql(db.select(db.literal(object())))
+        self.assertIn("-- {", sql)
+
+    def test_log_if_slow(self):
+        """It should only log queries over the threshold, even without a plan"""
+        statement = db.select(Customer.id)
+        with patch.dict(app.config, {"SLOW_QUERY_MS": 100}), patch.object(app.logger, "warning") as warning:
+            query_plans.log_if_slow(statement, 0.05)
+            warning.assert_not_called()
+            with patch("service.common.query_plans.capture_plan", side_effect=OperationalError("", {}, None)):
+                query_plans.log_if_slow(statement, 0.2)
+            self.assertEqual(warning.call_args[0][-1], "unavailable")
+        with patch.dict(app.config, {"SLOW_QUERY_MS": 0}), patch.object(app.logger, "warning") as warning:
+            query_plans.log_if_slow(statement, 10)
+            warning.assert_not_called()
+
+    def test_log_if_slow_redacted(self):
+        """It should keep the values of a slow query out of the log"""
+        statement = db.select(Customer.id).where(Customer.email == "alice@example.com")
+        plan = [{"Plan": {"Filter": "((email)::text = 'alice@example.com'::text)"}}]
+        with patch.dict(app.config, {"SLOW_QUERY_MS": 1}), patch.object(app.logger, "warning") as warning, \
+                patch("service.common.query_plans.capture_plan", return_value=plan):
+            query_plans.log_if_slow(statement, 1)
+        message = warning.call_args[0][0] % warning.call_args[0][1:]
+        self.assertNotIn("alice", message)
+        self.assertIn("customer.email = :email_1", message)
+        self.assertIn("'?'::text", message)
+        self.assertEqual(query_plans.redact("name = 'O''Brien' AND x = 1"), "name = '?' AND x = 1")
@@ -0,0 +1,140 @@
+"""
+Test cases for Rate Limiting
+"""
+import os
+import logging
+import tempfile
+from unittest import TestCase
+from wsgi import app
+from service.common import status
+from service.common.rate_limit import MemoryBackend, SharedMemoryBackend, client_identity, limit_request
+
+BASE_URL = "/api/customers"
+
+
+######################################################################
+#  B A C K E N D   T E S T   C A S E S
+######################################################################
+class TestBackends(TestCase):
+    """Token Bucket Backend Tests"""
+
+    def setUp(self):
+        """Creates a scratch file for the shared backend"""
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+
+    def tearDown(self):
+        """Removes the scratch file"""
+        os.remove(self.path)
+
+    def test_memory_bucket(self):
+        """It should allow a burst and then ask the client to wait"""
+        backend = MemoryBackend()
+        self.assertEqual(backend.consume("a", 1.0, 2, 100.0), 0)
+        self.assertEqual(backend.consume("a", 1.0, 2, 100.0), 0)
+        self.assertAlmostEqual(backend.consume("a", 1.0, 2, 100.0), 1.0)
+        self.assertAlmostEqual(backend.consume("a", 1.0, 2, 100.5), 0.5)
+        self.assertEqual(backend.consume("a", 1.0, 2, 101.0), 0)
+        # other clients have their own bucket
+        self.assertEqual(backend.consume("b", 1.0, 2, 101.0), 0)
+
+    def test_memory_eviction(self):
+        """It should forget the oldest buckets when it holds too many"""
+        backend = MemoryBackend(max_keys=4)
+        for i in range(5):
+            backend.consume(f"key{i}", 1.0, 1, float(i))
+        self.assertEqual(len(backend._buckets), 3)
+        self.assertNotIn("key0", backend._buckets)
+        self.assertIn("key4", backend._buckets)
+
+    def test_shared_bucket(self):
+        """It should share buckets between backends mapping the same file"""
+        first = SharedMemoryBackend(self.path, slots=16)
+        second = SharedMemoryBackend(self.path, slots=16)
+        self.assertEqual(first.consume("a", 1.0, 2, 100.0), 0)
+        self.assertEqual(second.consume("a", 1.0, 2, 100.0), 0)
+        self.assertAlmostEqual(first.consume("a", 1.0, 2, 100.0), 1.0)
+        self.assertAlmostEqual(second.consume("a", 1.0, 2, 100.0), 1.0)
+        self.assertEqual(second.consume("b", 1.0, 2, 100.0), 0)
+        first.close()
+        second.close()
+
+    def test_shared_collision(self):
+        """It should start a fresh bucket when another key owns the slot"""
+        backend = SharedMemoryBackend(self.path, slots=1)
+        self.assertEqual(backend.consume("a", 1.0, 1, 100.0), 0)
+        self.assertEqual(backend.consume("b", 1.0, 1, 100.0), 0)
+        self.assertEqual(backend.consume("a", 1.0, 1, 100.0), 0)
+        backend.close()
+
+
+######################################################################
+#  R E Q U E S T   T E S T   C A S E S
+######################################################################
+class TestRateLimiting(TestCase):
+    """Rate Limited Request Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Run once before all tests"""
+        app.config["TESTING"] = True
+        app.logger.setLevel(logging.CRITICAL)
+
+    def setUp(self):
+        """Enables rate limiting with a tiny budget"""
+        self.client = app.test_client()
+        self.limits = app.config["RATE_LIMITS"]
+        self.backend = app.extensions["rate_limit"]
+        app.extensions["rate_limit"] = MemoryBackend()
+        app.config["RATE_LIMITS"] = {"customer_collection": (0.01, 2), "health": None}
+        app.config["RATE_LIMIT_ENABLED"] = True
+
+    def tearDown(self):
+        """Restores the rate limit configuration"""
+        app.config["RATE_LIMIT_ENABLED"] = False
+        app.config["RATE_LIMIT_PROXY_HOPS"] = 0
+        app.config["RATE_LIMITS"] = self.limits
+        app.extensions["rate_limit"] = self.backend
+
+    def test_rate_limited(self):
+        """It should return 429 with Retry-After once the budget is spent"""
+        for _ in range(2):
+            resp = self.client.get(BASE_URL)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.client.get(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(resp.headers["Retry-After"], "100")
+        self.assertEqual(resp.get_json()["error"], "Too Many Requests")
+
+    def test_api_key_identity(self):
+        """It should give each API key its own budget"""
+        for _ in range(2):
+            self.client.get(BASE_URL)
+        resp = self.client.get(BASE_URL, headers={"X-API-Key": "billing"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_forwarded_identity(self):
+        """It should identify clients by the X-Forwarded-For entry of the trusted proxy"""
+        app.config["RATE_LIMIT_PROXY_HOPS"] = 1
+        for spoofed in ["1.1.1.1", "2.2.2.2"]:
+            self.client.get(BASE_URL, headers={"X-Forwarded-For": f"{spoofed}, 10.0.0.1"})
+        resp = self.client.get(BASE_URL, headers={"X-Forwarded-For": "10.0.0.2"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.client.get(BASE_URL, headers={"X-Forwarded-For": "3.3.3.3, 10.0.0.1"})
+        self.assertEqual(resp.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        # two proxies, but the request only passed one
+        app.config["RATE_LIMIT_PROXY_HOPS"] = 2
+        with app.test_request_context(headers={"X-Forwarded-For": "10.0.0.3"}, environ_base={"REMOTE_ADDR": "10.0.0.9"}):
+            self.assertEqual(client_identity(), "ip:10.0.0.9")
+
+    def test_unlimited_route(self):
+        """It should not limit routes without a budget"""
+        for _ in range(5):
+            resp = self.client.get("/health")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_disabled(self):
+        """It should not limit anything when disabled"""
+        app.config["RATE_LIMIT_ENABLED"] = False
+        with app.test_request_context(BASE_URL):
+            self.assertIsNone(limit_request())
@@ -0,0 +1,68 @@
+"""
+Test cases for Request Timing
+"""
+from unittest.mock import patch
+from flask_restx import marshalling
+from wsgi import app
+from service.common import status
+from .customer_factory import CustomerFactory
+from .service_test_case import ServiceTestCase
+BASE_URL = "/api/customers"
+
+
+def server_timing(response):
+    """Parses a Server-Timing header into {name: milliseconds}"""
+    timings = {}
+    for metric in response.headers["Server-Timing"].split(", "):
+        name, duration = metric.split(";dur=")
+        timings[name] = float(duration)
+    return timings
+
+
+class TestRequestTiming(ServiceTestCase):
+    """Request Timing Tests"""
+
+    def setUp(self):
+        """Times every request"""
+        super().setUp()
+        app.config["REQUEST_TIMING_SAMPLE_RATE"] = 1.0
+
+    def tearDown(self):
+        """Stops timing the requests"""
+        app.config["REQUEST_TIMING_SAMPLE_RATE"] = 0.0
+        super().tearDown()
+
+    def test_request_id(self):
+        """It should propagate a usable X-Request-ID and make one up otherwise"""
+        response = self.client.get(BASE_URL, headers={"X-Request-ID": "abc-123.4"})
+        self.assertEqual(response.headers["X-Request-ID"], "abc-123.4")
+        for header in ({}, {"X-Request-ID": "bad idé"}, {"X-Request-ID": "x" * 129}):
+            response = self.client.get(BASE_URL, headers=header)
+            self.assertEqual(len(response.headers["X-Request-ID"]), 32)
+
+    def test_list_phases(self):
+        """It should time the phases of a list request"""
+        for customer in CustomerFactory.build_batch(3):
+            customer.create()
+        response = self.client.get(f"{BASE_URL}?gender__in=male,female,unknown")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        timings = server_timing(response)
+        for name in ("parse", "db", "serialize", "marshal", "render", "total"):
+            self.assertIn(name, timings)
+        # the marshalling is timed by the app's marshal_with, flask-restx is left alone
+        self.assertEqual(marshalling.marshal.__module__, "flask_restx.marshalling")
+        self.assertGreater(timings["db"], 0)
+        self.assertLessEqual(timings["db"], timings["total"])
+
+    def test_create_phases(self):
+        """It should time the decoding of JSON bodies"""
+        response = self.client.post(BASE_URL, json=CustomerFactory.build().serialize())
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertIn("parse", server_timing(response))
+
+    def test_not_sampled(self):
+        """It should only give the request an id when it is not sampled"""
+        with patch.dict(app.config, {"REQUEST_TIMING_SAMPLE_RATE": 0.0}):
+            response = self.client.get(BASE_URL)
+        self.assertIn("X-Request-ID", response.headers)
+        self.assertNotIn("Server-Timing", response.headers)
@@ -0,0 +1,93 @@
+"""
+Test cases for Single Flight request coalescing
+"""
+import time
+import threading
+from unittest import TestCase
+from service.common.single_flight import SingleFlight
+
+
+class TestSingleFlight(TestCase):
+    """Single Flight Tests"""
+
+    def setUp(self):
+        """Creates a single flight group and a gate to hold the leader"""
+        self.flight = SingleFlight()
+        self.gate = threading.Event()
+        self.runs = 0
+
+    def _run_concurrently(self, function, count=5):
+        """Calls the function from several threads while the leader is held"""
+        outcomes = []
+
+        def worker():
+            try:
+                outcomes.append(self.flight.do("key", function))
+            except ValueError as error:
+                outcomes.append(error)
+
+        threads = [threading.Thread(target=worker) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        while self.flight.calls < count:
+            time.sleep(0.001)
+        self.gate.set()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_share_result(self):
+        """It should run identical concurrent calls once and share the result"""
+
+        def slow_query():
+            self.runs += 1
+            self.gate.wait()
+            return ["row"]
+
+        outcomes = self._run_concurrently(slow_query)
+        self.assertEqual(self.runs, 1)
+        self.assertEqual(self.flight.shared, 4)
+        self.assertEqual(outcomes, [["row"]] * 5)
+
+    def test_share_error(self):
+        """It should raise the leader's exception in every waiting caller"""
+
+        def failing_query():
+            self.runs += 1
+            self.gate.wait()
+            raise ValueError("database is down")
+
+        outcomes = self._run_concurrently(failing_query)
+        self.assertEqual(self.runs, 1)
+        self.assertEqual(len(outcomes), 5)
+        for outcome in outcomes:
+            self.assertIsInstance(outcome, ValueError)
+            self.assertEqual(str(outcome), "database is down")
+        # every waiter raised its own copy
+        self.assertEqual(len({id(outcome) for outcome in outcomes}), 5)
+
+    def test_write_starts_generation(self):
+        """It should not share a call that started before a write"""
+        started = threading.Event()
+
+        def stale_query():
+            started.set()
+            self.gate.wait()
+            return "before"
+
+        outcomes = []
+        leader = threading.Thread(target=lambda: outcomes.append(self.flight.do("key", stale_query)))
+        leader.start()
+        started.wait()
+        self.flight.invalidate("update", {"id": 1})
+        self.assertEqual(self.flight.do("key", lambda: "after"), "after")
+        self.gate.set()
+        leader.join()
+        self.assertEqual(outcomes, ["before"])
+        self.assertEqual(self.flight.shared, 0)
+
+    def test_sequential_calls(self):
+        """It should run calls that do not overlap separately"""
+        self.assertEqual(self.flight.do("key", lambda: 1), 1)
+        self.assertEqual(self.flight.do("key", lambda: 2), 2)
+        self.assertEqual(self.flight.shared, 0)
@@ -0,0 +1,73 @@
+"""
+Test cases for the Statement Cache
+"""
+import uuid
+from types import SimpleNamespace
+from unittest import TestCase
+from sqlalchemy import event
+from wsgi import app
+from service.models import db, Customer, statements
+from service.common import statement_cache
+from service.common.statement_cache import StatementStats
+
+
+class TestStatementCache(TestCase):
+    """Statement Cache Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Counts the statements in an app context"""
+        cls.context = app.app_context()
+        cls.context.push()
+
+    @classmethod
+    def tearDownClass(cls):
+        """Leaves the app context"""
+        db.session.remove()
+        cls.context.pop()
+
+    def setUp(self):
+        """Listens for the executions with a fresh counter"""
+        self.stats = StatementStats()
+        event.listen(db.engine, "after_cursor_execute", self.stats.record)
+        self.addCleanup(event.remove, db.engine, "after_cursor_execute", self.stats.record)
+
+    def test_record(self):
+        """It should count the hits and misses of the compiled cache"""
+        statement = db.select(db.literal_column("1").label(f"x{uuid.uuid4().hex}"))
+        for _ in range(3):
+            db.session.execute(statement)
+        with db.engine.connect() as connection:
+            connection.exec_driver_sql("SELECT 1")
+        self.assertEqual((self.stats.hits, self.stats.misses, self.stats.uncached), (2, 1, 1))
+
+    def test_stats(self):
+        """It should report the hit rate and the size of the compiled cache"""
+        for _ in range(4):
+            Customer.find(0)
+        stats = self.stats.stats(db.engine, app.config)
+        self.assertEqual(stats["executions"], 4)
+        self.assertGreaterEqual(stats["hit_rate"], 0.75)
+        self.assertEqual(stats["compiled_capacity"], app.config["SQL_COMPILED_CACHE_SIZE"])
+        self.assertIn((db.engine.dialect.name, "find"), statements)
+        self.assertEqual(stats["prebuilt"], len(statements))
+        # psycopg prepares the statements by default, sqlite never does
+        self.assertEqual(stats["prepared"], db.engine.dialect.driver == "psycopg")
+        self.assertEqual(statement_cache.stats(app)["compiled"], stats["compiled"])
+
+    def test_limit_prepared(self):
+        """It should limit the prepared statements of psycopg connections only"""
+        psycopg_connection = SimpleNamespace(prepared_max=100)
+        statement_cache._limit_prepared(20, psycopg_connection, None)  # pylint: disable=protected-access
+        self.assertEqual(psycopg_connection.prepared_max, 20)
+        sqlite_connection = SimpleNamespace()
+        statement_cache._limit_prepared(20, sqlite_connection, None)  # pylint: disable=protected-access
+        self.assertFalse(hasattr(sqlite_connection, "prepared_max"))
+
+    def test_measure(self):
+        """It should return the wall and CPU time of a call"""
+        calls = []
+        wall, cpu = statement_cache.measure(lambda: calls.append(1), 5)
+        self.assertEqual(len(calls), 5)
+        self.assertGreaterEqual(wall, 0)
+        self.assertGreaterEqual(cpu, 0)
@@ -0,0 +1,107 @@
+"""
+Test cases for the Typo-tolerant Index
+"""
+import logging
+from unittest import TestCase
+from unittest.mock import patch, MagicMock, PropertyMock
+from sqlalchemy.dialects import postgresql
+from wsgi import app
+from service import models, routes
+from service.common.typo_index import TypoIndex, deletions, distance, init_typo_index
+
+
+class TestTypoIndex(TestCase):
+    """Typo Index Tests"""
+
+    def setUp(self):
+        """Creates an index with three customers"""
+        self.index = TypoIndex()
+        self.index.add(1, {"username": "jsmith", "last_name": "Smith"})
+        self.index.add(2, {"username": "jsmyth", "last_name": "Smyth"})
+        self.index.add(3, {"username": "adoe", "last_name": "Doe"})
+
+    def test_deletions(self):
+        """It should generate every deletion up to the distance"""
+        self.assertEqual(deletions("abc", 1), {"abc", "bc", "ac", "ab"})
+        self.assertEqual(len(deletions("abc", 2)), 7)
+        self.assertEqual(deletions("abc", 0), {"abc"})
+
+    def test_distance(self):
+        """It should count insertions, deletions, substitutions and swaps"""
+        self.assertEqual(distance("smith", "smith", 2), 0)
+        self.assertEqual(distance("smith", "smyth", 2), 1)
+        self.assertEqual(distance("smith", "smiht", 2), 1)
+        self.assertEqual(distance("smith", "mith", 2), 1)
+        self.assertEqual(distance("smith", "smithson", 2), 3)
+        self.assertEqual(distance("smith", "jones", 2), 3)
+
+    def test_lookup(self):
+        """It should find the customers within the distance"""
+        self.assertEqual(self.index.lookup("last_name", "SMITH", 0), {1: 0})
+        self.assertEqual(self.index.lookup("last_name", "smiht", 1), {1: 1})
+        self.assertEqual(self.index.lookup("last_name", "smiht", 2), {1: 1, 2: 2})
+        self.assertEqual(self.index.lookup("username", "jsmoth", 1), {1: 1, 2: 1})
+        self.assertEqual(self.index.lookup("last_name", "jones", 2), {})
+        self.assertRaises(ValueError, self.index.lookup, "last_name", "smith", 3)
+
+    def test_update_and_remove(self):
+        """It should follow changes to the customers"""
+        self.index.add(4, {"username": "bsmith", "last_name": "Smith"})
+        self.index.add(1, {"username": "jsmith", "last_name": "Jones"})
+        self.assertEqual(self.index.lookup("last_name", "smith", 0), {4: 0})
+        self.index.remove(4)
+        self.assertEqual(self.index.lookup("last_name", "smith", 0), {})
+        self.index.remove(1)
+        self.index.remove(2)
+        self.index.remove(3)
+        stats = self.index.stats()
+        self.assertEqual((stats["customers"], stats["values"], stats["deletions"]), (0, 0, 0))
+
+    def test_load(self):
+        """It should rebuild from streamed rows"""
+        self.index.load(iter([(5, "kdoe", "Doe"), (6, "mdoe", None)]))
+        self.assertEqual(self.index.lookup("last_name", "smith", 0), {})
+        self.assertEqual(self.index.lookup("last_name", "do", 1), {5: 1})
+        self.assertEqual(self.index.stats()["customers"], 2)
+
+
+class TestTypoIndexSetup(TestCase):
+    """Typo Index Setup Tests"""
+
+    def setUp(self):
+        """Enables the index on the app"""
+        app.config["TYPO_INDEX_ENABLED"] = True
+        app.config["TYPO_INDEX_REFRESH"] = 0
+        app.logger.setLevel(logging.CRITICAL)
+        self.listeners = list(models.write_listeners)
+
+    def tearDown(self):
+        """Removes the index from the app"""
+        app.config["TYPO_INDEX_ENABLED"] = False
+        app.extensions.pop("typo_index", None)
+        del models.write_listeners[len(self.listeners):]
+
+    def test_init_typo_index(self):
+        """It should build the index and follow the model's writes"""
+        init_typo_index(app)
+        index = app.extensions["typo_index"]
+        models.notify_write("create", {"id": 7, "username": "x", "last_name": "Smith"})
+        self.assertEqual(index.lookup("last_name", "smiht", 1), {7: 1})
+
+    def test_disabled(self):
+        """It should not build the index unless it is enabled"""
+        app.config["TYPO_INDEX_ENABLED"] = False
+        init_typo_index(app)
+        self.assertNotIn("typo_index", app.extensions)
+
+    def test_ids_criterion(self):
+        """It should bind the ids of the typo matches as one value"""
+        with app.app_context():
+            statement = models.db.select(models.Customer.id).where(routes.ids_criterion(range(70000)))
+            self.assertEqual(len(statement.compile().params), 1)
+            self.assertIsInstance(models.db.session.execute(statement).all(), list)
+            engine = MagicMock(dialect=postgresql.dialect())
+            with patch.object(type(models.db), "engine", new_callable=PropertyMock, return_value=engine):
+                criterion = routes.ids_criterion({2: 0, 1: 1})
+            self.assertIn("= ANY (", str(criterion.compile(dialect=postgresql.dialect())))
+            self.assertEqual(criterion.compile(dialect=postgresql.dialect()).params, {"param_1": [1, 2]})